@@ -0,0 +1,142 @@
+"""Резервные копии базы SQLite без остановки бота.
+
+Копия снимается API резервного копирования SQLite (Connection.backup) по BACKUP_PAGES
+страниц за шаг с паузой между шагами: между шагами блокировка чтения отпускается, и в
+режиме WAL запись в базу не ждет копирования. Если базу изменили во время копирования,
+SQLite начинает копию заново; после MAX_RESTARTS таких перезапусков оставшееся
+копируется одним шагом — это одна транзакция чтения, которая в WAL тоже не мешает записи.
+
+Копия сжимается gzip в файл subscriptions-<UTC-время>.db.gz в каталоге копий, где
+остаются только последние keep файлов. Каждая копия проверяется: она распаковывается во
+временную базу, проходит PRAGMA quick_check, а число строк в каждой таблице сравнивается
+с числом в несжатой копии. Все функции синхронные, bot.py вызывает их в пуле потоков.
+"""
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'subscriptions-'
+SUFFIX = '.db.gz'
+BACKUP_PAGES = 256
+STEP_PAUSE = 0.01
+MAX_RESTARTS = 5
+
+
+class BackupError(Exception):
+    pass
+
+
+def _row_counts(conn: sqlite3.Connection) -> dict:
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+    return {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+
+def _copy(db_path: str, target_path: str) -> int:
+    """Копирует базу по шагам; возвращает число перезапусков копирования."""
+    restarts = 0
+    remaining_before = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, remaining_before
+        # Оставшихся страниц стало больше — SQLite начал копию заново после записи в базу
+        if remaining_before is not None and remaining > remaining_before:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise BackupError('too many restarts')
+        remaining_before = remaining
+
+    source = sqlite3.connect(db_path, timeout=20)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            try:
+                source.backup(target, pages=BACKUP_PAGES, progress=progress, sleep=STEP_PAUSE)
+            except BackupError:
+                source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return restarts
+
+
+def create(db_path: str, backup_dir: str) -> tuple:
+    """Снимает сжатую копию базы; возвращает (путь к копии, {таблица: строк})."""
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.perf_counter()
+    name = f"{PREFIX}{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}{SUFFIX}"
+    path = os.path.join(backup_dir, name)
+    fd, copy_path = tempfile.mkstemp(dir=backup_dir, prefix='.backup-', suffix='.db')
+    os.close(fd)
+    try:
+        restarts = _copy(db_path, copy_path)
+        conn = sqlite3.connect(copy_path)
+        try:
+            counts = _row_counts(conn)
+        finally:
+            conn.close()
+        fd, gzip_path = tempfile.mkstemp(dir=backup_dir, prefix='.backup-', suffix=SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(filename=name[:-3], mode='wb', fileobj=raw) as f:
+                with open(copy_path, 'rb') as source:
+                    shutil.copyfileobj(source, f, 1024 * 1024)
+            os.replace(gzip_path, path)
+        except BaseException:
+            os.unlink(gzip_path)
+            raise
+    finally:
+        os.unlink(copy_path)
+    logger.info(f"Backup {path}: {os.path.getsize(path) // 1024} KB, {sum(counts.values())} rows, "
+                f"{restarts} restarts, {time.perf_counter() - started:.2f}s")
+    return path, counts
+
+
+def verify(path: str, expected: dict):
+    """Восстанавливает копию во временную базу и сверяет ее с expected; BackupError при расхождении."""
+    fd, restore_path = tempfile.mkstemp(prefix='.restore-', suffix='.db')
+    try:
+        with os.fdopen(fd, 'wb') as target, gzip.open(path, 'rb') as source:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        conn = sqlite3.connect(restore_path)
+        try:
+            check = conn.execute('PRAGMA quick_check').fetchone()[0]
+            if check != 'ok':
+                raise BackupError(f"{os.path.basename(path)}: quick_check failed: {check}")
+            counts = _row_counts(conn)
+        finally:
+            conn.close()
+    finally:
+        os.unlink(restore_path)
+    if counts != expected:
+        mismatched = sorted(table for table in set(counts) | set(expected) if counts.get(table) != expected.get(table))
+        raise BackupError(f"{os.path.basename(path)}: row counts differ in {', '.join(mismatched)}")
+
+
+def rotate(backup_dir: str, keep: int) -> list:
+    """Удаляет копии сверх последних keep; возвращает удаленные пути."""
+    paths = sorted(glob.glob(os.path.join(backup_dir, f"{PREFIX}*{SUFFIX}")))
+    removed = paths[:-keep] if keep > 0 else []
+    for path in removed:
+        os.unlink(path)
+    return removed
+
+
+def run(db_path: str, backup_dir: str, keep: int) -> tuple:
+    """Копия, ее проверка и ротация; возвращает (путь, {таблица: строк})."""
+    path, counts = create(db_path, backup_dir)
+    try:
+        verify(path, counts)
+    except BaseException:
+        # Непроверенная копия не должна вытеснить рабочие при ротации
+        os.unlink(path)
+        raise
+    rotate(backup_dir, keep)
+    return path, counts
@@ -0,0 +1,198 @@
+"""Микробенчмарки операций с базой данных.
+
+Генерирует синтетические таблицы users/payments заданного размера во временной
+базе, замеряет функции database.py (их же вызывает SQLite-бэкенд storage.py) на разных уровнях
+конкурентности и сохраняет результаты в JSON, чтобы сравнивать изменения схемы,
+индексов и работы с соединениями между собой.
+
+Пример:
+    python benchmarks/bench_db.py --sizes 10000,100000 --concurrency 1,4,16
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без plans.json основной канал берется из окружения
+os.environ.setdefault('CHANNEL_ID', '-1001000000000')
+
+import database  # noqa: E402
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+PAYMENT_STATUSES = ['pending', 'pending', 'canceled', 'succeeded']
+
+def seed(db_path: str, users: int, payments_per_user: int, seed_value: int = 42):
+    """Заполняет базу синтетическими пользователями и платежами."""
+    rnd = random.Random(seed_value)
+    now = datetime.now()
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    batch = 10000
+    for start in range(1, users + 1, batch):
+        user_rows = []
+        payment_rows = []
+        for user_id in range(start, min(start + batch, users + 1)):
+            join_date = now - timedelta(days=rnd.randint(0, 365), seconds=rnd.randint(0, 86400))
+            trial_used = rnd.random() < 0.7
+            subscription_end = None
+            if trial_used:
+                subscription_end = (now + timedelta(days=rnd.randint(-60, 30))).strftime(DATE_FORMAT)
+            active = int(subscription_end is None or subscription_end > now.strftime(DATE_FORMAT))
+            user_rows.append((user_id, f'user{user_id}', join_date.strftime(DATE_FORMAT),
+                              active, subscription_end, int(trial_used)))
+            for n in range(payments_per_user):
+                payment_rows.append((f'bench-{user_id}-{n}', user_id, 1000.0,
+                                     (join_date + timedelta(days=30 * n)).strftime(DATE_FORMAT),
+                                     rnd.choice(PAYMENT_STATUSES)))
+        conn.executemany('INSERT INTO users (user_id, username, join_date, active, subscription_end, trial_used) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', user_rows)
+        conn.executemany('INSERT INTO payments (payment_id, user_id, amount, date, status) '
+                         'VALUES (?, ?, ?, ?, ?)', payment_rows)
+        conn.commit()
+    conn.close()
+
+
+def build_operations(users: int):
+    """Возвращает словарь имя -> (функция(seq), признак полного сканирования)."""
+    new_user_base = users + 1
+    ops = {
+        'database.add_user.new': (lambda seq: database.add_user(new_user_base + seq, f'new{seq}'), False),
+        'database.add_user.existing': (lambda seq: database.add_user(random.randint(1, users), 'x'), False),
+        'database.check_user_access': (lambda seq: database.check_user_access(random.randint(1, users)), False),
+        'database.get_user_entitlements': (
+            lambda seq: database.get_user_entitlements(random.randint(1, users)), False),
+        'database.get_due_entitlements': (
+            lambda seq: database.get_due_entitlements((datetime.now() + timedelta(days=4)).strftime(DATE_FORMAT)), True),
+        'database.update_subscription': (
+            lambda seq: database.update_subscription(random.randint(1, users), f'bench-upd-{seq}', 1000.0), False),
+        'database.add_payment': (
+            lambda seq: database.add_payment(f'bench-new-{seq}', random.randint(1, users), 1000.0), False),
+        'database.set_payment_status': (
+            lambda seq: database.set_payment_status(f'bench-{random.randint(1, users)}-0', 'pending'), False),
+        'database.get_last_payment': (lambda seq: database.get_last_payment(random.randint(1, users)), False),
+        'database.get_active_users': (lambda seq: database.get_active_users(), True),
+    }
+    return ops
+
+
+def measure(func, total_ops: int, concurrency: int, seq_offset: int):
+    """Запускает total_ops вызовов в concurrency потоках и собирает задержки."""
+    latencies = []
+    errors = 0
+
+    def worker(indexes):
+        # Каждый поток считает свои ошибки: общий счетчик без блокировки терял бы приращения
+        local, local_errors = [], 0
+        for i in indexes:
+            started = time.perf_counter()
+            try:
+                func(seq_offset + i)
+            except Exception:
+                local_errors += 1
+            local.append(time.perf_counter() - started)
+        return local, local_errors
+
+    chunks = [range(n, total_ops, concurrency) for n in range(concurrency)]
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for local, local_errors in pool.map(worker, chunks):
+            latencies.extend(local)
+            errors += local_errors
+    wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        'ops': total_ops,
+        'errors': errors,
+        'wall_s': round(wall, 4),
+        'ops_per_s': round(total_ops / wall, 1) if wall else None,
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'p50_ms': round(pct(0.50), 3),
+        'p95_ms': round(pct(0.95), 3),
+        'p99_ms': round(pct(0.99), 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000', help='Размеры таблицы users через запятую')
+    parser.add_argument('--payments-per-user', type=int, default=2)
+    parser.add_argument('--concurrency', default='1,4,16', help='Число потоков через запятую')
+    parser.add_argument('--ops', type=int, default=1000, help='Вызовов на точечную операцию')
+    parser.add_argument('--scan-ops', type=int, default=10, help='Вызовов на запрос с полным сканированием')
+    parser.add_argument('--only', default='', help='Подстрока имени операции для фильтра')
+    parser.add_argument('--output', default=None, help='Путь к JSON с результатами')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+    report = {
+        'benchmark': 'database',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'params': vars(args),
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            database.DB_PATH = os.path.join(tmp, f'bench_{size}.db')
+            database.init_db()
+            seed_started = time.perf_counter()
+            seed(database.DB_PATH, size, args.payments_per_user)
+            # Повторная инициализация переносит подписки из users в entitlements
+            database.init_db()
+            print(f"Seeded {size} users in {time.perf_counter() - seed_started:.1f}s")
+
+            seq_offset = 0
+            for name, (func, full_scan) in build_operations(size).items():
+                if args.only and args.only not in name:
+                    continue
+                for level in levels:
+                    total = args.scan_ops if full_scan else args.ops
+                    # database.py печатает каждое обновление подписки — глушим вывод на время замера
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result = measure(func, total, level, seq_offset)
+                    seq_offset += total
+                    result.update({'operation': name, 'users': size, 'concurrency': level})
+                    report['results'].append(result)
+                    print(f"{name:40} users={size:<8} threads={level:<3} "
+                          f"{result['ops_per_s']:>9} ops/s  p50={result['p50_ms']}ms  p99={result['p99_ms']}ms")
+
+    output = args.output or os.path.join('bench_results', f"db-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
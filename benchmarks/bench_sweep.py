@@ -0,0 +1,213 @@
+"""Бенчмарк ежедневной проверки подписок (check_subscriptions) на больших объемах.
+
+Создает временную базу с N пользователями и реалистичным распределением окончания
+подписок, запускает check_subscriptions из bot.py против локальных заглушек Bot API
+и ЮKassa и сообщает время прохода, число вызовов API, число коммитов в БД, пиковый
+RSS и сообщений в секунду.
+
+Распределение пользователей:
+    * ~30% — неактивные (давно истекшие), в проход не попадают;
+    * ~10% — в пробном периоде (join_date за последние TRIAL_DAYS + 2 дня);
+    * остальные — платные, окончание равномерно в интервале [-2; +30] дней.
+
+Пример:
+    python benchmarks/bench_sweep.py --users 10000,100000 --api-latency-ms 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices  # noqa: E402
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+TRIAL_DAYS = 5
+
+BENCH_ENV = {
+    'TELEGRAM_BOT_TOKEN': '123456:BENCH',
+    'CHANNEL_ID': '-1001000000000',
+    'CHAT_LINK': 'https://t.me/+chat',
+    'LINK_CLOSED_CHANNEL': 'https://t.me/+channel',
+    'SUBSCRIPTION_PRICE': '1000',
+    'TRIAL_DAYS': str(TRIAL_DAYS),
+    'ADMIN_ID': '1000',
+    'FRIEND_ID': '0',
+    'YOOKASSA_SHOP_ID': '1',
+    'YOOKASSA_SECRET_KEY': 'test_bench',
+}
+
+
+def seed_users(db_path: str, users: int, seed_value: int = 42):
+    """Заполняет таблицу users с реалистичным распределением окончания подписок."""
+    rnd = random.Random(seed_value)
+    now = datetime.now()
+    rows = []
+    for user_id in range(1, users + 1):
+        kind = rnd.random()
+        if kind < 0.30:
+            join_date = now - timedelta(days=rnd.randint(60, 400))
+            rows.append((user_id, f'user{user_id}', join_date.strftime(DATE_FORMAT), 0,
+                         (now - timedelta(days=rnd.randint(3, 300))).strftime(DATE_FORMAT), 1))
+        elif kind < 0.40:
+            join_date = now - timedelta(days=rnd.uniform(0, TRIAL_DAYS + 2))
+            rows.append((user_id, f'user{user_id}', join_date.strftime(DATE_FORMAT), 1, None, 0))
+        else:
+            join_date = now - timedelta(days=rnd.randint(30, 400))
+            subscription_end = now + timedelta(days=rnd.uniform(-2, 30))
+            rows.append((user_id, f'user{user_id}', join_date.strftime(DATE_FORMAT), 1,
+                         subscription_end.strftime(DATE_FORMAT), 1))
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO users (user_id, username, join_date, active, subscription_end, trial_used) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+
+def peak_rss_mb() -> float:
+    # На Linux ru_maxrss в килобайтах, на macOS — в байтах
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def install_commit_counter(bot_module, database_module):
+    """Оборачивает get_db_connection, чтобы считать COMMIT через trace callback."""
+    counter = {'commits': 0, 'connections': 0}
+    original = database_module.get_db_connection
+
+    def counting_connection():
+        conn = original()
+        counter['connections'] += 1
+
+        def trace(statement):
+            if statement.strip().upper().startswith('COMMIT'):
+                counter['commits'] += 1
+
+        conn.set_trace_callback(trace)
+        return conn
+
+    bot_module.get_db_connection = counting_connection
+    database_module.get_db_connection = counting_connection
+    return counter
+
+
+async def run_sweep(bot_module, services: FakeServices):
+    from telegram.ext import Application, CallbackContext
+
+    application = Application.builder().token(BENCH_ENV['TELEGRAM_BOT_TOKEN']) \
+        .base_url(services.bot_base_url).build()
+    await application.initialize()
+    try:
+        services.reset()
+        context = CallbackContext(application)
+        # Сообщения пользователям уходят через outbox: доставляем их сразу, без паузы между
+        # пачками, чтобы время прохода включало отправку, как раньше
+        bot_module.OUTBOX_BATCH_INTERVAL = 0
+        # Ссылки на оплату из прохода по базе другого размера не переиспользуем
+        bot_module.hot_state.clear()
+        started = time.perf_counter()
+        await bot_module.check_subscriptions(context)
+        await bot_module.dispatch_outbox(context)
+        return time.perf_counter() - started
+    finally:
+        await application.shutdown()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', default='1000,10000', help='Размеры базы через запятую')
+    parser.add_argument('--api-latency-ms', type=float, default=0.0,
+                        help='Искусственная задержка ответа заглушек Bot API и ЮKassa')
+    parser.add_argument('--output', default=None, help='Путь к JSON с результатами')
+    args = parser.parse_args()
+
+    os.environ.update(BENCH_ENV)
+    services = FakeServices(latency_ms=args.api_latency_ms).start()
+    report = {
+        'benchmark': 'check_subscriptions',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'params': vars(args),
+        'results': [],
+    }
+    output = os.path.abspath(args.output or os.path.join(
+        ROOT, 'bench_results', f"sweep-{datetime.now():%Y%m%d-%H%M%S}.json"))
+
+    workdir = tempfile.mkdtemp(prefix='bench_sweep_')
+    os.chdir(workdir)
+    # bot.configure() настраивает логирование в bot.log — делаем это во временном каталоге
+    import database
+    import bot
+    bot.configure()
+    bot.yookassa_api().Configuration.api_url = services.yookassa_api_url
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    counter = install_commit_counter(bot, database)
+
+    try:
+        for size in [int(s) for s in args.users.split(',') if s]:
+            db_path = os.path.join(workdir, f'sweep_{size}.db')
+            database.DB_PATH = db_path
+            database.init_db()
+            seed_users(db_path, size)
+            # Повторная инициализация переносит подписки из users в entitlements
+            database.init_db()
+
+            counter.update(commits=0, connections=0)
+            rss_before = peak_rss_mb()
+            wall = asyncio.run(run_sweep(bot, services))
+            calls = dict(services.calls)
+            messages = calls.get('bot.sendMessage', 0)
+            result = {
+                'users': size,
+                'wall_s': round(wall, 3),
+                'api_calls_total': sum(calls.values()),
+                'api_calls': calls,
+                'db_commits': counter['commits'],
+                'db_connections': counter['connections'],
+                'messages_sent': messages,
+                'messages_per_s': round(messages / wall, 1) if wall else None,
+                'peak_rss_mb': peak_rss_mb(),
+                'peak_rss_before_mb': rss_before,
+            }
+            report['results'].append(result)
+            print(f"users={size:<8} wall={result['wall_s']}s api_calls={result['api_calls_total']} "
+                  f"commits={result['db_commits']} msgs/s={result['messages_per_s']} "
+                  f"peak_rss={result['peak_rss_mb']}MB")
+    finally:
+        services.stop()
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Локальные заглушки Telegram Bot API и ЮKassa для бенчмарков.
+
+Один HTTP-сервер отвечает на запросы вида /bot<token>/<method> как Bot API и на
+/v3/payments как ЮKassa, считает вызовы по методам и может добавлять искусственную
+задержку, чтобы имитировать сетевые походы.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeServices:
+    def __init__(self, latency_ms: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self.payments = {}
+        # Сохраненные способы оплаты, списания по которым отклоняются (проверка автопродления)
+        self.declined_methods = set()
+        # Ключи идемпотентности: повтор запроса с тем же ключом возвращает тот же платеж
+        self.idempotence_keys = {}
+        # Сколько следующих платежей создать и оборвать соединение, не ответив (сбой связи)
+        self.drop_payments = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def bot_base_url(self) -> str:
+        return f"{self.url}/bot"
+
+    @property
+    def yookassa_api_url(self) -> str:
+        return f"{self.url}/v3"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    # --- Bot API ---
+
+    def bot_method(self, method: str, params: dict):
+        self._count(f"bot.{method}")
+        now = int(time.time())
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return {"message_id": self._next_message_id(), "date": now,
+                    "chat": {"id": int(params.get('chat_id', 0)), "type": "private"},
+                    "text": params.get('text', '')}
+        if method == 'sendDocument':
+            return {"message_id": self._next_message_id(), "date": now,
+                    "chat": {"id": int(params.get('chat_id', 0)), "type": "private"},
+                    "document": {"file_id": "doc", "file_unique_id": "doc"}}
+        if method == 'createChatInviteLink':
+            return {"invite_link": f"https://t.me/+{uuid.uuid4().hex[:16]}", "creator": BOT_USER,
+                    "creates_join_request": False, "is_primary": False, "is_revoked": False,
+                    "member_limit": 1}
+        if method == 'getChat':
+            return {"id": int(params.get('chat_id', 0)), "type": "private", "username": "user",
+                    "accent_color_id": 0, "max_reaction_count": 0}
+        if method == 'getChatMember':
+            return {"status": "left", "user": {"id": int(params.get('user_id', 0)), "is_bot": False,
+                                               "first_name": "User"}}
+        # banChatMember, unbanChatMember, answerCallbackQuery, setWebhook, deleteWebhook и т.п.
+        return True
+
+    # --- ЮKassa ---
+
+    def create_payment(self, body: dict, idempotence_key: str = None):
+        self._count("yookassa.create_payment")
+        with self._lock:
+            if idempotence_key in self.idempotence_keys:
+                return self.payments[self.idempotence_keys[idempotence_key]]
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "test": True,
+            "refundable": False,
+            "amount": body.get("amount", {"value": "0.00", "currency": "RUB"}),
+            "description": body.get("description", ""),
+            "metadata": body.get("metadata", {}),
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            "confirmation": {"type": "redirect",
+                             "confirmation_url": f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}"},
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+        }
+        if body.get("payment_method_id"):
+            declined = body["payment_method_id"] in self.declined_methods
+            payment["status"] = "canceled" if declined else "succeeded"
+            payment["paid"] = not declined
+            payment.pop("confirmation")
+            if declined:
+                payment["cancellation_details"] = {"party": "payment_network", "reason": "insufficient_funds"}
+        if body.get("save_payment_method"):
+            payment["payment_method"] = {"type": "bank_card", "id": str(uuid.uuid4()), "saved": True}
+        with self._lock:
+            self.payments[payment_id] = payment
+            if idempotence_key:
+                self.idempotence_keys[idempotence_key] = payment_id
+        return payment
+
+    def _take_drop(self) -> bool:
+        with self._lock:
+            if self.drop_payments:
+                self.drop_payments -= 1
+                return True
+            return False
+
+    def find_payment(self, payment_id: str):
+        self._count("yookassa.find_payment")
+        with self._lock:
+            return self.payments.get(payment_id)
+
+    def set_payment_status(self, payment_id: str, status: str):
+        with self._lock:
+            self.payments[payment_id]["status"] = status
+            self.payments[payment_id]["paid"] = status == 'succeeded'
+
+    def _make_handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _read_params(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if 'json' in content_type and raw:
+                    return json.loads(raw)
+                if 'multipart/form-data' in content_type:
+                    return {}
+                return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+            def _reply(self, status: int, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _dispatch(self):
+                if services.latency:
+                    time.sleep(services.latency)
+                params = self._read_params() if self.command == 'POST' else {}
+                path = self.path.split('?')[0]
+                if path.startswith('/bot'):
+                    method = path.rsplit('/', 1)[-1]
+                    return self._reply(200, {"ok": True, "result": services.bot_method(method, params)})
+                if path == '/v3/payments' and self.command == 'POST':
+                    payment = services.create_payment(params, self.headers.get('Idempotence-Key'))
+                    if services._take_drop():
+                        # Платеж создан, но ответ потерян
+                        self.close_connection = True
+                        return
+                    return self._reply(200, payment)
+                if path.startswith('/v3/payments/'):
+                    payment = services.find_payment(path.rsplit('/', 1)[-1])
+                    if payment is None:
+                        return self._reply(404, {"type": "error", "code": "not_found"})
+                    return self._reply(200, payment)
+                if path == '/v3/me':
+                    services._count("yookassa.me")
+                    return self._reply(200, {"account_id": "1", "status": "enabled", "test": True})
+                self._reply(404, {"ok": False, "description": "Not Found"})
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+        return Handler
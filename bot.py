@@ -1,64 +1,355 @@
 from math import ceil
-from datetime import datetime, timedelta
-from multiprocessing import context
+from datetime import datetime, timedelta, time as day_time
 import pytz
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, ChatMemberHandler
-from telegram.error import TelegramError
+from telegram.ext import MessageHandler, filters
+from telegram.error import TelegramError, RetryAfter
 from telegram.constants import ParseMode
-from yookassa import Configuration, Payment
-from dotenv import load_dotenv
-from database import get_db_connection, init_db, add_user, check_user_access, update_subscription
+from config import get_settings
+from storage import get_storage
+from messages import load_messages, reload_if_changed, render, button, static_row, url_row
+from server_config import load_server_config
+from update_processor import PerUserUpdateProcessor
+from circuit_breaker import CircuitBreaker, CircuitOpenError, BreakerRequest, health as circuit_health
+import hot_state
+import user_index
+import trial_guard
+import promo
+import event_log
+import bulk_access
+from plans import load_plans, get_channels, get_channel, get_default_channel, get_plans, get_plan, get_default_plan
 import os
+import html
 import logging
+from logging.handlers import RotatingFileHandler
 import asyncio
-import sqlite3 # Python 3.9.13  Ok
-
-
-# Настройка логирования с явной кодировкой UTF-8
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+import signal
+import socket
+import time
+import csv
+import io
+import tempfile
+
+
 logger = logging.getLogger(__name__)
 
-# Загрузка переменных окружения
-load_dotenv()
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
-CHAT_LINK = os.getenv('CHAT_LINK')
-LINK_CLOSED_CHANNEL = os.getenv('LINK_CLOSED_CHANNEL')
-SUBSCRIPTION_PRICE = float(os.getenv('SUBSCRIPTION_PRICE', 1000))
-TRIAL_DAYS = int(os.getenv('TRIAL_DAYS', 5))
-ADMIN_ID = int(os.getenv('ADMIN_ID'))
-FRIEND_ID = int(os.getenv('FRIEND_ID', 0))
-
-# Проверка переменных окружения
-if not all([TOKEN, CHANNEL_ID, CHAT_LINK, LINK_CLOSED_CHANNEL, SUBSCRIPTION_PRICE, TRIAL_DAYS, ADMIN_ID]):
-    raise ValueError("Missing required environment variables in .env")
-
-# Настройка ЮKassa
-Configuration.account_id = os.getenv('YOOKASSA_SHOP_ID')
-Configuration.secret_key = os.getenv('YOOKASSA_SECRET_KEY')
+# Настройки из окружения, каналы, тексты и хранилище заполняет configure() при создании
+# приложения, а не импорт модуля: так модуль импортируется без побочных эффектов
+TOKEN = None
+CHANNEL_ID = None
+CHAT_LINK = None
+LINK_CLOSED_CHANNEL = None
+SUBSCRIPTION_PRICE = None
+TRIAL_DAYS = None
+ADMIN_ID = None
+FRIEND_ID = 0
+# Прием обновлений (вебхук или polling), параллельность и адрес Bot API — server_config.py.
+# Адреса API можно переопределить для локального Bot API сервера или заглушек в тестах
+SERVER = None
+BOT_API_BASE_URL = None
+# Хранилище (SQLite или PostgreSQL, см. storage.py); схема создается в post_init
+storage = None
+
+# Предохранители ЮKassa и Bot API (circuit_breaker.py): после CIRCUIT_FAILURES сбоев подряд
+# вызовы сразу отклоняются, а через CIRCUIT_RESET_TIMEOUT секунд проходит один пробный вызов.
+# SDK ЮKassa ждет ответа без таймаута, поэтому ожидание ограничено YOOKASSA_TIMEOUT.
+# Пороги из окружения выставляет configure(). Уведомление админам о сбое сервиса —
+# не чаще раза в CIRCUIT_ALERT_INTERVAL секунд
+CIRCUIT_ALERT_INTERVAL = 600
+CIRCUIT_TITLES = {'yookassa': 'ЮKassa', 'bot_api': 'Telegram Bot API'}
+
+def yookassa_outage(error: Exception) -> bool:
+    # Ошибки в самом запросе (4xx) не говорят о недоступности ЮKassa
+    from yookassa.domain.exceptions import BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError
+    return not isinstance(error, (BadRequestError, ForbiddenError, NotFoundError, UnauthorizedError))
+
+yookassa_breaker = CircuitBreaker('yookassa', is_failure=yookassa_outage)
+bot_api_breaker = CircuitBreaker('bot_api')
 
 # Временная зона Москвы
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
-# Инициализация базы данных
-init_db()
-
-async def generate_invite_link(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str:
+# Плановые задачи выполняет только процесс, держащий аренду в базе (см. workers.py)
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE = 'scheduler'
+LEADER_LEASE_TTL = 90
+SWEEP_INTERVAL = 86400
+# Первый проход проверки подписок после запуска (SWEEP_START_DELAY): не сразу, чтобы старт
+# после деплоя не конкурировал с обработкой накопившихся обновлений
+SWEEP_START_DELAY = 300
+# Позиция прохода проверки подписок сохраняется в job_state каждые SWEEP_CHECKPOINT_ROWS
+# доступов или SWEEP_CHECKPOINT_INTERVAL секунд и при остановке
+SWEEP_CHECKPOINT_ROWS = 500
+SWEEP_CHECKPOINT_INTERVAL = 5.0
+
+# Снимок ссылок на оплату и приглашений (hot_state.py, SNAPSHOT_FILE): пишется раз в
+# SNAPSHOT_INTERVAL секунд, если что-то изменилось, и при остановке; читается при запуске
+SNAPSHOT_FILE = 'hot_state.json'
+SNAPSHOT_INTERVAL = 60
+
+# Индекс доступов в памяти (user_index.py, USER_INDEX): строится при запуске, изменения
+# других процессов подтягиваются раз в USER_INDEX_REFRESH секунд. Окно USER_INDEX_OVERLAP
+# перекрывает транзакции, записавшие updated_at раньше, чем стали видны
+USER_INDEX = True
+USER_INDEX_REFRESH = 10.0
+USER_INDEX_OVERLAP = 60
+USER_INDEX_BATCH_SIZE = 10000
+_user_index_since = None
+
+# Повторные пробные периоды (trial_guard.py, TRIAL_GUARD): off — не проверять, flag — выдать
+# и сообщить админам, deny — не выдавать. Новые признаки других процессов попадают в фильтр
+# раз в TRIAL_GUARD_REFRESH секунд
+TRIAL_GUARD = 'flag'
+TRIAL_GUARD_REFRESH = 60
+TRIAL_SIGNAL_TITLES = {'username': "имя пользователя как у", 'invite': "вход по приглашению для"}
+_trial_guard_since = None
+
+# Автопродление (AUTO_RENEW, нужны рекуррентные платежи в магазине ЮKassa): первый платеж
+# сохраняет способ оплаты, а renew_subscriptions раз в RENEW_INTERVAL секунд списывает оплату
+# по доступам, истекающим в ближайшие RENEW_AHEAD секунд, пачками по RENEW_BATCH_SIZE.
+# Неудачное списание повторяется через RENEW_RETRY_INTERVAL, после RENEW_MAX_FAILURES подряд
+# автопродление отключается и пользователь продлевает подписку сам
+AUTO_RENEW = False
+RENEW_AHEAD = 86400
+RENEW_INTERVAL = 3600
+RENEW_BATCH_SIZE = 20
+RENEW_BATCH_INTERVAL = 1.0
+RENEW_RETRY_INTERVAL = 6 * 3600
+RENEW_MAX_FAILURES = 3
+
+# Промокоды (promo.py) и приглашения: пригласивший получает REFERRAL_DAYS дней после первой
+# оплаты приглашенного (0 — программа отключена). Коды, созданные в других процессах,
+# подгружаются раз в PROMO_REFRESH секунд
+REFERRAL_DAYS = 7
+PROMO_REFRESH = 60
+
+# Журнал событий доступа (event_log.py): snapshot_events раз в EVENT_SNAPSHOT_INTERVAL секунд
+# сворачивает новые события в снимки пачками по EVENT_SNAPSHOT_BATCH; /history показывает
+# последние HISTORY_LIMIT событий пользователя
+EVENT_SNAPSHOT_INTERVAL = 300
+EVENT_SNAPSHOT_BATCH = 10000
+HISTORY_LIMIT = 20
+
+# Хранение данных: неоплаченные платежи и доставленные сообщения outbox старше RETENTION_DAYS
+# (0 — не удалять) удаляются пачками по RETENTION_BATCH_SIZE с паузой RETENTION_BATCH_INTERVAL,
+# чтобы не держать блокировку записи. Затем база сжимается: VACUUM, если свободно не меньше
+# VACUUM_FREE_RATIO страниц, и обрезка WAL. Проход — раз в сутки в MAINTENANCE_HOUR по Москве
+RETENTION_DAYS = 30
+RETENTION_BATCH_SIZE = 500
+RETENTION_BATCH_INTERVAL = 0.2
+VACUUM_FREE_RATIO = 0.2
+MAINTENANCE_HOUR = 4
+
+# Резервные копии SQLite (backup.py): раз в BACKUP_INTERVAL часов (0 — отключены) в BACKUP_DIR,
+# хранятся последние BACKUP_KEEP. /backup снимает копию по запросу и присылает ее документом,
+# если она меньше BACKUP_DOCUMENT_LIMIT (ограничение Bot API на отправку файлов)
+BACKUP_DIR = 'data/backups'
+BACKUP_INTERVAL = 6.0
+BACKUP_KEEP = 8
+BACKUP_DOCUMENT_LIMIT = 50 * 1024 * 1024
+# Создается в on_startup: после перезапуска main работает в новом цикле событий
+_backup_lock = None
+
+# Массовые операции админа (bulk_access.py): CSV не больше BULK_FILE_LIMIT байт, прогресс
+# доставки сообщений обновляется раз в BULK_PROGRESS_INTERVAL секунд, но не дольше BULK_PROGRESS_TIMEOUT
+BULK_FILE_LIMIT = 1024 * 1024
+BULK_PROGRESS_INTERVAL = 5
+BULK_PROGRESS_TIMEOUT = 3600
+BULK_REPORT_LIMIT = 20
+
+# Перезапуск после ошибок запуска: 5, 10, 20... секунд, не больше 5 минут.
+# Если бот проработал дольше STARTUP_STABLE_SECONDS, отсчет начинается заново
+PREFLIGHT_TIMEOUT = 20
+STARTUP_RETRY_BASE = 5
+STARTUP_RETRY_MAX = 300
+STARTUP_STABLE_SECONDS = 600
+
+# После SIGTERM: сколько секунд даем обработчикам обновлений на завершение, прежде чем
+# отменить их (SHUTDOWN_TIMEOUT). Плановые задачи сохраняют прогресс и выходят на ближайшей границе шага
+SHUTDOWN_TIMEOUT = 25.0
+
+# Outbox: опрос очереди, размер пачки (с паузой между полными пачками — лимит Bot API),
+# аренда сообщения на время отправки и повторы 10 с, 20 с, 40 с... не дольше часа
+OUTBOX_INTERVAL = 2
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_BATCH_INTERVAL = 1.0
+OUTBOX_LEASE = 60
+OUTBOX_RETRY_BASE = 10
+OUTBOX_RETRY_MAX = 3600
+OUTBOX_MAX_ATTEMPTS = 8
+
+# Отчет об активных пользователях: строк на странице (влезает в лимит 4096 символов)
+ACTIVE_USERS_PAGE_SIZE = 50
+
+# Сверка базы с участниками каналов: get_chat_member пачками с паузой (лимит Bot API ~30 запросов/с)
+RECONCILE_BATCH_SIZE = 20
+RECONCILE_BATCH_INTERVAL = 1.0
+RECONCILE_EXPIRED_DAYS = 7
+RECONCILE_ENFORCE = False
+RECONCILE_REPORT_LIMIT = 20
+# Ручная сверка (/reconcile, кнопка в админ-меню) идет фоновой задачей, по одной за раз
+_manual_reconcile = None
+
+def setup_logging(worker: int = None):
+    """Лог в LOG_FILE с ротацией по размеру (LOG_MAX_BYTES, LOG_BACKUPS старых файлов) и в консоль.
+    У рабочего процесса свой файл: один файл процессы ротировали бы вразнобой."""
+    settings = get_settings()
+    log_file = settings.log_file
+    if worker is not None:
+        name, ext = os.path.splitext(log_file)
+        log_file = f"{name}-{worker}{ext}"
+    # Настройка логирования с явной кодировкой UTF-8
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        handlers=[
+            RotatingFileHandler(log_file, maxBytes=settings.log_max_bytes, backupCount=settings.log_backups,
+                                encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
+def configure(worker: int = None):
+    """Загружает настройки (config.py), каналы и тарифы, тексты и создает хранилище.
+
+    Вызывается из main, build_application и workers.run_worker (с номером процесса worker)
+    до первого обращения к этим значениям; повторный вызов ничего не делает."""
+    global TOKEN, CHANNEL_ID, CHAT_LINK, LINK_CLOSED_CHANNEL, SUBSCRIPTION_PRICE, TRIAL_DAYS, ADMIN_ID, FRIEND_ID
+    global SERVER, BOT_API_BASE_URL, SWEEP_START_DELAY, SNAPSHOT_FILE, SHUTDOWN_TIMEOUT, RECONCILE_ENFORCE, storage
+    global USER_INDEX, USER_INDEX_REFRESH, TRIAL_GUARD, AUTO_RENEW, REFERRAL_DAYS, RETENTION_DAYS, MAINTENANCE_HOUR
+    global BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP
+    if storage is not None:
+        return
+    setup_logging(worker)
+    settings = get_settings()
+    TOKEN = settings.token
+    # Каналы и тарифы: plans.json или один канал из CHANNEL_ID/SUBSCRIPTION_PRICE
+    load_plans()
+    # Тексты сообщений: встроенные или из messages.json, проверяются при запуске
+    load_messages()
+    CHANNEL_ID = get_default_channel().channel_id
+    CHAT_LINK = get_default_channel().chat_link
+    LINK_CLOSED_CHANNEL = get_default_channel().link
+    SUBSCRIPTION_PRICE = get_default_plan().price
+    TRIAL_DAYS = settings.trial_days
+    ADMIN_ID = settings.admin_id
+    FRIEND_ID = settings.friend_id
+
+    # Проверка переменных окружения
+    if not all([TOKEN, CHANNEL_ID, CHAT_LINK, LINK_CLOSED_CHANNEL, SUBSCRIPTION_PRICE, TRIAL_DAYS, ADMIN_ID]):
+        raise ValueError("Missing required environment variables in .env")
+
+    if settings.trial_guard not in ('off', 'flag', 'deny'):
+        raise ValueError(f"TRIAL_GUARD must be off, flag or deny, not {settings.trial_guard!r}")
+
+    SERVER = load_server_config()
+    BOT_API_BASE_URL = SERVER.base_url
+    for breaker in (yookassa_breaker, bot_api_breaker):
+        breaker.failure_threshold = settings.circuit_failures
+        breaker.reset_timeout = settings.circuit_reset_timeout
+    yookassa_breaker.call_timeout = settings.yookassa_timeout
+    SWEEP_START_DELAY = settings.sweep_start_delay
+    SNAPSHOT_FILE = settings.snapshot_file
+    SHUTDOWN_TIMEOUT = settings.shutdown_timeout
+    RECONCILE_ENFORCE = settings.reconcile_enforce
+    USER_INDEX = settings.user_index
+    USER_INDEX_REFRESH = settings.user_index_refresh
+    TRIAL_GUARD = settings.trial_guard
+    AUTO_RENEW = settings.auto_renew
+    REFERRAL_DAYS = settings.referral_days
+    RETENTION_DAYS = settings.retention_days
+    MAINTENANCE_HOUR = settings.maintenance_hour
+    BACKUP_DIR = settings.backup_dir
+    BACKUP_INTERVAL = settings.backup_interval
+    BACKUP_KEEP = settings.backup_keep
+    storage = get_storage()
+
+_yookassa = None
+
+def yookassa_api():
+    """SDK ЮKassa, импортированный и настроенный при первом обращении: импорт занимает
+    около 0,1 с, а нужен он только для платежей."""
+    global _yookassa
+    if _yookassa is None:
+        import yookassa
+        settings = get_settings()
+        # Настройка ЮKassa
+        yookassa.Configuration.account_id = settings.yookassa_shop_id
+        yookassa.Configuration.secret_key = settings.yookassa_secret_key
+        if settings.yookassa_api_url:
+            yookassa.Configuration.api_url = settings.yookassa_api_url
+        _yookassa = yookassa
+    return _yookassa
+
+def price_text(plan, price: float = None) -> str:
+    """Цена тарифа; price — цена для пользователя со скидкой (promo.price)."""
+    price = plan.price if price is None else price
+    if plan.days == 30:
+        return f"{price} руб/месяц"
+    return f"{price} руб за {plan.title}"
+
+async def get_entitlement(user_id: int, channel_id: int = None):
+    """Доступ из индекса в памяти, пока индекс не построен — из базы."""
+    if user_index.is_ready():
+        return user_index.get(user_id, channel_id or get_default_channel().channel_id)
+    return await storage.get_entitlement(user_id, channel_id)
+
+async def get_user_entitlements(user_id: int) -> list:
+    if user_index.is_ready():
+        return user_index.get_user(user_id)
+    return await storage.get_user_entitlements(user_id)
+
+async def sync_user_index(user_id: int):
+    """Переносит в индекс доступы пользователя после записи этого процесса."""
+    if user_index.is_ready():
+        user_index.put_user(user_id, await storage.get_user_entitlements(user_id))
+
+async def get_subscription_status(user_id: int, channel_id: int = None, fresh: bool = False):
+    """Возвращает (sub_type, days_left, end_date) для доступа пользователя к каналу.
+
+    fresh=True читает доступ из базы в обход индекса (индекс может отставать от записей
+    других процессов на USER_INDEX_REFRESH секунд)."""
+    if fresh:
+        entitlement = await storage.get_entitlement(user_id, channel_id)
+    else:
+        entitlement = await get_entitlement(user_id, channel_id)
+    now = datetime.now(MOSCOW_TZ)
+    if entitlement:
+        plan_id, subscription_end, is_trial, active = entitlement
+        if active and subscription_end:
+            end_date = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
+            if end_date > now:
+                days_left = max(0, ceil((end_date - now).total_seconds() / (24 * 3600)))
+                return ('trial' if is_trial else 'paid'), days_left, end_date
+    return 'none', 0, None
+
+async def get_active_channels(user_id: int) -> list:
+    """Каналы, к которым у пользователя сейчас есть доступ, в порядке конфигурации."""
+    now = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    active_ids = {
+        channel_id for channel_id, plan_id, subscription_end, is_trial, active in await get_user_entitlements(user_id)
+        if active and subscription_end and subscription_end > now
+    }
+    return [channel for channel in get_channels() if channel.channel_id in active_ids]
+
+async def generate_invite_link(context: ContextTypes.DEFAULT_TYPE, user_id: int, channel_id: int = None) -> str:
+    channel_id = channel_id or CHANNEL_ID
+    # Неиспользованное приглашение выдаем повторно; вход или выход из канала его сбрасывает
+    cached = hot_state.get_invite_link(user_id, channel_id)
+    if cached:
+        return cached
     try:
+        expire_date = int((datetime.now(MOSCOW_TZ) + timedelta(days=1)).timestamp())
         link = await context.bot.create_chat_invite_link(
-            chat_id=CHANNEL_ID,
+            chat_id=channel_id,
             member_limit=1,
-            expire_date=int((datetime.now(MOSCOW_TZ) + timedelta(days=1)).timestamp())
+            expire_date=expire_date,
+            # По названию событие входа покажет, для кого приглашение создано
+            name=trial_guard.invite_name(user_id)
         )
+        hot_state.put_invite_link(user_id, channel_id, link.invite_link, expire_date)
         return link.invite_link
     except Exception as e:
         logger.error(f"Error generating invite link for user {user_id}: {e}")
@@ -75,11 +366,32 @@ async def generate_invite_link(context: ContextTypes.DEFAULT_TYPE, user_id: int)
             )
         return ""
 
-async def create_payment(user_id: int, bot_username: str):
+def payment_outbox(user_id: int, plan, payment_id: str, amount: float, kind: str = 'payment_confirmed') -> list:
+    """Подтверждение пользователю и уведомления админам. Пишутся в outbox в одной транзакции
+    с продлением и доставляются dispatch_outbox с повторами. amount — фактически оплаченная сумма."""
+    outbox = [(user_id, kind, {'channel_id': plan.channel_id, 'plan_id': plan.plan_id, 'amount': amount},
+               f"{kind}:{payment_id}")]
+    for admin_id in (ADMIN_ID, FRIEND_ID):
+        if admin_id:
+            outbox.append((admin_id, 'new_payment',
+                           {'user_id': user_id, 'plan_id': plan.plan_id, 'payment_id': payment_id, 'amount': amount},
+                           f"new_payment:{payment_id}:{admin_id}"))
+    return outbox
+
+async def create_payment(user_id: int, bot_username: str, plan_id: str = None):
     try:
-        payment = Payment.create({
+        plan = get_plan(plan_id) or get_default_plan()
+        # Недавний неоплаченный платеж по тому же тарифу выдаем повторно, без запроса в ЮKassa
+        cached = hot_state.get_payment_link(user_id, plan.plan_id)
+        if cached:
+            return cached
+        price, promo_code = promo.price(user_id, plan)
+        metadata = {"user_id": str(user_id), "plan_id": plan.plan_id}
+        if promo_code:
+            metadata["promo"] = promo_code
+        payment = await yookassa_breaker.call(asyncio.to_thread, yookassa_api().Payment.create, {
             "amount": {
-                "value": f"{SUBSCRIPTION_PRICE:.2f}",
+                "value": f"{price:.2f}",
                 "currency": "RUB"
             },
             "confirmation": {
@@ -87,40 +399,37 @@ async def create_payment(user_id: int, bot_username: str):
                 "return_url": f"https://t.me/{bot_username}?start=payment_{user_id}"
             },
             "capture": True,
-            "description": "Подписка на HappyFaceClub",
-            "metadata": {"user_id": str(user_id)}
+            # Способ оплаты сохраняется для автопродления (ЮKassa спрашивает согласие на странице оплаты)
+            "save_payment_method": AUTO_RENEW,
+            "description": f"Подписка на {get_channel(plan.channel_id).title}",
+            "metadata": metadata
         })
         logger.info(f"Created payment {payment.id} for user {user_id}")
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO payments (payment_id, user_id, amount, status)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(payment_id) DO NOTHING
-        ''', (payment.id, user_id, SUBSCRIPTION_PRICE, 'pending'))
-        conn.commit()
-        conn.close()
+        await storage.add_payment(payment.id, user_id, price, plan.plan_id)
+        hot_state.put_payment_link(user_id, plan.plan_id, payment.id, payment.confirmation.confirmation_url)
 
         return payment.confirmation.confirmation_url, payment.id
+    except CircuitOpenError:
+        logger.warning(f"YooKassa unavailable, no payment link for user {user_id}")
+        return None, None
     except Exception as e:
+        # Об отказе ЮKassa админы узнают один раз от предохранителя (notify_circuit_change)
         logger.error(f"Payment creation error for user {user_id}: {e}")
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"⚠️ Ошибка создания платежа для пользователя {user_id}: {e}",
-            parse_mode=ParseMode.HTML
-        )
-        if FRIEND_ID:
-            await context.bot.send_message(
-                chat_id=FRIEND_ID,
-                text=f"⚠️ Ошибка создания платежа для пользователя {user_id}: {e}",
-                parse_mode=ParseMode.HTML
-            )
         return None, None
 
+def payment_row(key: str, payment_link: str, plan_id: str, lang: str = None) -> tuple:
+    """Кнопка оплаты, а без ссылки (ЮKassa недоступна) — кнопка повторной попытки через buy:<plan_id>."""
+    if payment_link:
+        return (button(key, lang, url=payment_link),)
+    return (button('btn_payment_retry', lang, callback_data=f"buy:{plan_id}"),)
+
+def payment_unavailable(payment_link: str, lang: str = None) -> str:
+    return "" if payment_link else "\n\n" + render('payment_unavailable', lang)
+
 async def check_payment_status(payment_id: str, user_id: int, context: ContextTypes.DEFAULT_TYPE):
     try:
-        payment = Payment.find_one(payment_id)
+        payment = await yookassa_breaker.call(asyncio.to_thread, yookassa_api().Payment.find_one, payment_id)
         if not payment:
             logger.error(f"Payment {payment_id} not found for user {user_id}")
             return False
@@ -129,79 +438,46 @@ async def check_payment_status(payment_id: str, user_id: int, context: ContextTy
             logger.error(f"Payment {payment_id} does not belong to user {user_id}")
             return False
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-        UPDATE payments SET status = ?, date = datetime('now')
-        WHERE payment_id = ?
-        ''', (payment.status, payment.id))
+        # Статус succeeded выставляет update_subscription вместе с продлением доступа
+        await storage.set_payment_status(payment.id, payment.status)
+        if payment.status != 'pending':
+            hot_state.drop_payment_links(user_id)
+        result = await storage.get_payment(payment.id)
 
         if payment.status == 'succeeded':
-            update_subscription(user_id, payment_id, SUBSCRIPTION_PRICE)
-
-            cursor.execute('''
-            SELECT subscription_end FROM users WHERE user_id = ?
-            ''', (user_id,))
-            result = cursor.fetchone()
-            new_end_date = None
-            if result and result[0]:
-                new_end_date = datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-            else:
-                new_end_date = datetime.now(MOSCOW_TZ) + timedelta(days=30)
-            conn.commit()
-            conn.close()
-
-            invite_link = await generate_invite_link(context, user_id)
-            if not invite_link:
-                logger.error(f"Failed to generate invite link for user {user_id}")
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="⚠️ Ошибка при создании ссылки на группу. Пожалуйста, свяжитесь с поддержкой.",
-                    parse_mode=ParseMode.HTML
-                )
+            plan = get_plan(payment.metadata.get('plan_id') or (result and result[4])) or get_default_plan()
+            method = getattr(payment, 'payment_method', None)
+            if AUTO_RENEW and method and getattr(method, 'saved', False):
+                # До продления: подтверждение оплаты уже сообщает об автопродлении
+                await storage.save_payment_method(user_id, method.id, getattr(method, 'title', None))
+            promo_code = payment.metadata.get('promo')
+            amount = float(payment.amount.value)
+            new_end_date = await storage.update_subscription(user_id, payment_id, amount, plan.plan_id,
+                                                             payment_outbox(user_id, plan, payment.id, amount),
+                                                             promo_code, REFERRAL_DAYS)
+            await sync_user_index(user_id)
+            if promo_code:
+                promo.drop_user_code(user_id, promo_code)
+            if new_end_date is None:
+                # Платеж уже зачтен ранее: повторно не продлеваем, только присылаем свежую ссылку
+                message = await render_payment_confirmed(context, user_id, {'channel_id': plan.channel_id})
+                if message:
+                    text, reply_markup = message
+                    await context.bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.HTML,
+                                                   reply_markup=reply_markup)
                 return True
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ <b>Оплата подтверждена!</b>\n\n"
-                     f"🔓 Ваша подписка продлена до {new_end_date.strftime('%d.%m.%Y')}\n"
-                     f"🔗 Ссылка в группу: {invite_link}\n\n"
-                     f"Спасибо за доверие! ❤️",
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)]
-                ])
-            )
-
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"💳 <b>Новый платеж</b>\n"
-                     f"👤 Пользователь: {user_id} (@{(await context.bot.get_chat(user_id)).username or 'без имени'})\n"
-                     f"💰 Сумма: {SUBSCRIPTION_PRICE} RUB\n"
-                     f"🆔 ID платежа: {payment.id}",
-                parse_mode=ParseMode.HTML
-            )
-            if FRIEND_ID:
-                await context.bot.send_message(
-                    chat_id=FRIEND_ID,
-                    text=f"💳 <b>Новый платеж</b>\n"
-                         f"👤 Пользователь: {user_id} (@{(await context.bot.get_chat(user_id)).username or 'без имени'})\n"
-                         f"💰 Сумма: {SUBSCRIPTION_PRICE} RUB\n"
-                         f"🆔 ID платежа: {payment.id}",
-                    parse_mode=ParseMode.HTML
-                )
+            wake_outbox(context)
             logger.info(f"Payment {payment_id} succeeded for user {user_id}")
             return True
         else:
-            conn.commit()
-            conn.close()
             logger.info(f"Payment {payment_id} status: {payment.status}")
             return False
+    except CircuitOpenError:
+        logger.warning(f"YooKassa unavailable, payment {payment_id} of user {user_id} not checked")
+        return False
     except Exception as e:
         logger.error(f"Payment processing error for user {user_id}: {e}")
-        if 'conn' in locals():
-            conn.close()
         return False
 
 async def handle_payment_return(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -212,15 +488,7 @@ async def handle_payment_return(update: Update, context: ContextTypes.DEFAULT_TY
                 await update.message.reply_text("⚠️ Эта ссылка не для вас", parse_mode=ParseMode.HTML)
                 return
 
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            SELECT payment_id FROM payments
-            WHERE user_id = ?
-            ORDER BY date DESC LIMIT 1
-            ''', (user_id,))
-            payment = cursor.fetchone()
-            conn.close()
+            payment = await storage.get_last_payment(user_id)
 
             if payment:
                 payment_id = payment[0]
@@ -257,106 +525,78 @@ async def handle_payment_return(update: Update, context: ContextTypes.DEFAULT_TY
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
+        lang = user.language_code
         logger.info(f"User: {user.id} @{user.username}")
 
-        add_user(user.id, user.username)
+        # Фильтр в памяти отсеивает чистые ключи: в базе проверяются только подозрительные
+        suspect_keys = trial_guard.suspect_keys(user.id, user.username) if TRIAL_GUARD != 'off' else []
+        matches = await storage.add_user(user.id, user.username, suspect_keys, deny_trial=TRIAL_GUARD == 'deny')
+        trial_denied = False
+        if matches is not None:
+            # Новый пользователь: переносим его доступ в индекс, имя — в фильтр
+            await sync_user_index(user.id)
+            if user.username:
+                trial_guard.add(trial_guard.username_key(user.username))
+            if matches:
+                trial_denied = TRIAL_GUARD == 'deny'
+                context.application.create_task(notify_trial_abuse(context.bot, user, matches, trial_denied))
+            # Приглашение засчитывается только новому пользователю
+            if REFERRAL_DAYS and context.args and context.args[0].startswith('ref_'):
+                referrer_id = context.args[0][len('ref_'):]
+                if referrer_id.isdigit():
+                    await storage.add_referral(user.id, int(referrer_id))
 
         if context.args and context.args[0].startswith('payment_'):
             await handle_payment_return(update, context)
             return
+        if context.args and context.args[0].startswith('promo_'):
+            await redeem_promo(update, context, context.args[0][len('promo_'):])
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT subscription_end, trial_used, join_date, active FROM users WHERE user_id = ?
-        ''', (user.id,))
-        result = cursor.fetchone()
-        conn.close()
-
-        sub_type = 'none'
-        days_left = 0
-        end_date = None
-        active = False
-
-        now = datetime.now(MOSCOW_TZ)
-        if result:
-            subscription_end, trial_used, join_date, active = result
-            if subscription_end:
-                sub_end = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                if sub_end > now and active:
-                    sub_type = 'paid'
-                    days_left = max(0, ceil((sub_end - now).total_seconds() / (24 * 3600)))
-                    end_date = subscription_end
-            if not trial_used:
-                join = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                trial_end = join + timedelta(days=TRIAL_DAYS)
-                days_left = max(0, ceil((trial_end - now).total_seconds() / (24 * 3600)))
-                if days_left >= 0:
-                    sub_type = 'trial'
-                    end_date = trial_end.strftime('%Y-%m-%d %H:%M:%S')
-                    active = True
+        sub_type, days_left, end_date = await get_subscription_status(user.id)
+        price = promo.price(user.id, get_default_plan())[0]
 
+        # Без ссылки на оплату (ЮKassa недоступна) приветствие все равно уходит, с кнопкой повтора
         payment_link, payment_id = await create_payment(user.id, context.bot.username)
-        if not payment_link:
-            await update.message.reply_text(
-                "⚠️ Ошибка при создании платежа. Пожалуйста, попробуйте позже.",
-                parse_mode=ParseMode.HTML
-            )
-            return
-
-        welcome_text = (
-            f"✨ <b>Добро пожаловать в Happy Face Club</b> ✨\n\n"
-            f"🌿 Это место, где ты можешь быть собой.\n"
-            f"Здесь вы найдёте простые, но мощные инструменты для улучшения самочувствия и красоты\n\n"
-            f"💆‍♀️ Массаж и телесные практики\n"
-            f"🥗 Вкусные и полезные рецепты\n"
-            f"🫶 Поддержку комьюнити\n\n"
-        )
 
         keyboard = [
-            [InlineKeyboardButton("🔐 Перейти в группу", url=LINK_CLOSED_CHANNEL)],
-            [InlineKeyboardButton("💬 Чат сообщества", url=CHAT_LINK)],
-            [InlineKeyboardButton("💳 Оплатить/продлить подписку", url=payment_link)],
-            [
-                InlineKeyboardButton("🔍 Проверить подписку", callback_data="check"),
-                InlineKeyboardButton("🔄 Вернуться в группу", callback_data="rejoin")
-            ],
-            [
-                InlineKeyboardButton("💸 Статус платежа", callback_data="check_payment"),
-                InlineKeyboardButton("❓ Помощь", callback_data="help")
-            ]
+            url_row('btn_go_to_group', LINK_CLOSED_CHANNEL, lang),
+            url_row('btn_community_chat', CHAT_LINK, lang),
+            payment_row('btn_pay', payment_link, get_default_plan().plan_id, lang),
+            static_row('check_rejoin', lang),
+            static_row('payment_help', lang),
         ]
+        if len(get_plans()) > 1:
+            keyboard.append(static_row('plans', lang))
 
         if sub_type in ['paid', 'trial']:
             invite_link = await generate_invite_link(context, user.id)
             if not invite_link:
-                await update.message.reply_text("⚠️ Ошибка создания ссылки", parse_mode=ParseMode.HTML)
+                await update.message.reply_text(render('error_invite_link', lang), parse_mode=ParseMode.HTML)
                 return
 
-            text = welcome_text
+            parts = [render('start_welcome', lang)]
             if sub_type == 'paid':
-                text += (
-                    f"⭐️ <b>Ваша подписка активна</b>\n"
-                    f"Тип: Платная\n"
-                    f"Осталось дней: {days_left}\n"
-                    f"Завершается: {datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ).strftime('%d.%m.%Y')}\n\n"
-                    f"Вы можете продлить подписку, оплатив еще один месяц.\n\n"
-                )
+                parts.append(render('start_paid', lang, days_left=days_left, end_date=end_date.strftime('%d.%m.%Y')))
+                parts.append(render('start_links_paid', lang, invite_link=invite_link, chat_link=CHAT_LINK,
+                                    price=price))
             else:
-                text += (
-                    f"✨ <b>У тебя есть {days_left} дней бесплатного доступа</b> - почувствуй, как тебе здесь.\n\n"
-                )
+                parts.append(render('start_trial', lang, days_left=days_left))
+                parts.append(render('start_links_trial', lang, invite_link=invite_link, chat_link=CHAT_LINK,
+                                    price=price))
 
-            text += (
-                f"🔗 Ссылка в группу: {invite_link}\n"
-                f"💬 Чат сообщества: {CHAT_LINK}\n\n"
-                f"💳 {'Продлить подписку' if sub_type == 'paid' else 'Оплатить подписку'}: {SUBSCRIPTION_PRICE} руб/месяц"
-            )
+            # Ссылки в остальные группы, к которым у пользователя есть доступ
+            for channel in await get_active_channels(user.id):
+                if channel.channel_id == CHANNEL_ID:
+                    continue
+                channel_link = await generate_invite_link(context, user.id, channel.channel_id)
+                if channel_link:
+                    parts.append(render('start_other_channel', lang, title=channel.title, invite_link=channel_link))
+            parts.append(payment_unavailable(payment_link, lang))
 
-            keyboard[0][0] = InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)
+            keyboard[0] = (button('btn_go_to_group', lang, url=invite_link),)
 
             await update.message.reply_text(
-                text=text,
+                text="".join(parts),
                 parse_mode=ParseMode.HTML,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 disable_web_page_preview=True
@@ -364,77 +604,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Пользователь без активной подписки
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT trial_used, join_date FROM users WHERE user_id = ?
-        ''', (user.id,))
-        result = cursor.fetchone()
-        conn.close()
-
-        if result and not result[0]:
-            join = datetime.strptime(result[1], '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-            trial_end = join + timedelta(days=TRIAL_DAYS)
-            days_left = max(0, ceil((trial_end - now).total_seconds() / (24 * 3600)))
-            if days_left >= 0:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('''
-                UPDATE users SET subscription_end = ?, active = 1
-                WHERE user_id = ?
-                ''', (trial_end.strftime('%Y-%m-%d %H:%M:%S'), user.id))
-                conn.commit()
-                conn.close()
-
-                invite_link = await generate_invite_link(context, user.id)
-                if not invite_link:
-                    await update.message.reply_text("⚠️ Ошибка создания ссылки", parse_mode=ParseMode.HTML)
-                    return
-
-                text = welcome_text + (
-                    f"✨ <b>У тебя есть {days_left} дней бесплатного доступа</b> - почувствуй, как тебе здесь.\n\n"
-                    f"🔗 Ссылка в группу: {invite_link}\n"
-                    f"💬 Чат сообщества: {CHAT_LINK}\n\n"
-                    f"💳 После пробного периода: {SUBSCRIPTION_PRICE} руб/месяц"
-                )
-
-                keyboard[0][0] = InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)
-
-                await update.message.reply_text(
-                    text=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    disable_web_page_preview=True
-                )
-            else:
-                text = welcome_text + (
-                    f"🔒 Для доступа к материалам требуется подписка\n\n"
-                    f"💳 Стоимость: {SUBSCRIPTION_PRICE} руб/месяц"
-                )
-
-                await update.message.reply_text(
-                    text=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    disable_web_page_preview=True
-                )
-        else:
-            text = welcome_text + (
-                f"🔒 Для доступа к материалам требуется подписка\n\n"
-                f"💳 Стоимость: {SUBSCRIPTION_PRICE} руб/месяц"
-            )
-
-            await update.message.reply_text(
-                text=text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                disable_web_page_preview=True
-            )
+        await update.message.reply_text(
+            text=render('start_welcome', lang) + render('start_no_subscription', lang, price=price)
+                 + (render('trial_denied', lang) if trial_denied else "")
+                 + payment_unavailable(payment_link, lang),
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            disable_web_page_preview=True
+        )
 
     except Exception as e:
         logger.error(f"Error in start for user {user.id}: {str(e)}")
         await update.message.reply_text(
-            "⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+            render('error_generic', user.language_code),
             parse_mode=ParseMode.HTML
         )
         await context.bot.send_message(
@@ -449,6 +631,44 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
 
+async def send_active_subscription(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, channel,
+                                   sub_type: str, days_left: int, end_date, invite_link: str, lang: str = None):
+    """Сообщение об активной подписке с новой ссылкой (для /check и /rejoin)."""
+    plan_id = get_default_plan(channel.channel_id).plan_id
+    payment_link, _ = await create_payment(user_id, context.bot.username, plan_id)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=render(
+            'subscription_active', lang,
+            channel_line=render('channel_line', lang, title=channel.title) if len(get_channels()) > 1 else "",
+            sub_type=render('sub_type_paid' if sub_type == 'paid' else 'sub_type_trial', lang),
+            days_left=days_left,
+            end_date=end_date.strftime('%d.%m.%Y'),
+            invite_link=invite_link
+        ) + payment_unavailable(payment_link, lang),
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([
+            (button('btn_go_to_group', lang, url=invite_link),),
+            payment_row('btn_extend', payment_link, plan_id, lang) + static_row('help', lang)
+        ])
+    )
+
+async def send_subscription_expired(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int,
+                                    template: str, lang: str = None):
+    """Сообщение об истекшей подписке со ссылкой на оплату (для /check и /rejoin)."""
+    payment_link, _ = await create_payment(user_id, context.bot.username)
+    keyboard = [payment_row('btn_extend', payment_link, get_default_plan().plan_id, lang)]
+    if len(get_plans()) > 1:
+        keyboard.append(static_row('plans', lang))
+    keyboard.append(static_row('help', lang))
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=render(template, lang, price=promo.price(user_id, get_default_plan())[0])
+        + payment_unavailable(payment_link, lang),
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
 async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
@@ -458,89 +678,31 @@ async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             user = update.effective_user
             chat_id = user.id
+        lang = user.language_code
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT subscription_end, trial_used, join_date, active FROM users WHERE user_id = ?
-        ''', (user.id,))
-        result = cursor.fetchone()
-        conn.close()
-
-        sub_type = 'none'
-        days_left = 0
-        end_date = None
-        active = False
-
-        now = datetime.now(MOSCOW_TZ)
-        if result:
-            subscription_end, trial_used, join_date, active = result
-            if subscription_end:
-                sub_end = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                if sub_end > now and active:
-                    sub_type = 'paid'
-                    days_left = max(0, ceil((sub_end - now).total_seconds() / (24 * 3600)))
-                    end_date = subscription_end
-            if not trial_used:
-                join = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                trial_end = join + timedelta(days=TRIAL_DAYS)
-                days_left = max(0, ceil((trial_end - now).total_seconds() / (24 * 3600)))
-                if days_left >= 0:
-                    sub_type = 'trial'
-                    end_date = trial_end.strftime('%Y-%m-%d %H:%M:%S')
-                    active = True
+        active_channels = await get_active_channels(user.id)
 
-        if sub_type in ['paid', 'trial']:
-            invite_link = await generate_invite_link(context, user.id)
+        for channel in active_channels:
+            sub_type, days_left, end_date = await get_subscription_status(user.id, channel.channel_id)
+            invite_link = await generate_invite_link(context, user.id, channel.channel_id)
             if not invite_link:
                 await context.bot.send_message(
                     chat_id=chat_id,
-                    text="⚠️ Ошибка создания ссылки",
+                    text=render('error_invite_link', lang),
                     parse_mode=ParseMode.HTML
                 )
                 return
 
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"✅ <b>Ваша подписка активна</b>\n\n"
-                     f"Тип: {'Платная' if sub_type == 'paid' else 'Пробный период'}\n"
-                     f"Осталось дней: {days_left}\n"
-                     f"Завершается: {datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ).strftime('%d.%m.%Y')}\n\n"
-                     f"🔗 Новая ссылка в группу: {invite_link}",
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)],
-                    [
-                        InlineKeyboardButton("💳 Продлить подписку", url=(await create_payment(user.id, context.bot.username))[0]),
-                        InlineKeyboardButton("❓ Помощь", callback_data="help")
-                    ]
-                ])
-            )
-        else:
-            payment_link, _ = await create_payment(user.id, context.bot.username)
-            if payment_link:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"❌ <b>Ваша подписка истекла</b>\n\n"
-                         f"Для продолжения доступа, пожалуйста, продлите подписку.\n"
-                         f"💳 Стоимость: {SUBSCRIPTION_PRICE} руб/месяц",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("💳 Продлить подписку", url=payment_link)],
-                        [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-                    ])
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text="⚠️ Ошибка при создании платежа. Пожалуйста, попробуйте позже.",
-                    parse_mode=ParseMode.HTML
-                )
+            await send_active_subscription(context, chat_id, user.id, channel, sub_type, days_left, end_date,
+                                           invite_link, lang)
+
+        if not active_channels:
+            await send_subscription_expired(context, chat_id, user.id, 'expired_check', lang)
     except Exception as e:
         logger.error(f"Error in check_access for user {user.id}: {e}")
         await context.bot.send_message(
             chat_id=chat_id,
-            text="⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+            text=render('error_generic', user.language_code),
             parse_mode=ParseMode.HTML
         )
         await context.bot.send_message(
@@ -564,103 +726,43 @@ async def rejoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             user = update.effective_user
             chat_id = user.id
+        lang = user.language_code
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT subscription_end, trial_used, join_date, active
-        FROM users
-        WHERE user_id = ?
-        ''', (user.id,))
-        result = cursor.fetchone()
-        conn.close()
+        active_channels = await get_active_channels(user.id)
 
-        sub_type = 'none'
-        days_left = 0
-        end_date = None
-        active = False
-
-        now = datetime.now(MOSCOW_TZ)
-        if result:
-            subscription_end, trial_used, join_date, active = result
-            if subscription_end:
-                sub_end = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                if sub_end > now and active:
-                    sub_type = 'paid'
-                    days_left = max(0, ceil((sub_end - now).total_seconds() / (24 * 3600)))
-                    end_date = subscription_end
-            if not trial_used:
-                join = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                trial_end = join + timedelta(days=TRIAL_DAYS)
-                days_left = max(0, ceil((trial_end - now).total_seconds() / (24 * 3600)))
-                if days_left >= 0:
-                    sub_type = 'trial'
-                    end_date = trial_end.strftime('%Y-%m-%d %H:%M:%S')
-                    active = True
-
-        if sub_type in ['paid', 'trial']:
+        for channel in active_channels:
+            sub_type, days_left, end_date = await get_subscription_status(user.id, channel.channel_id)
             try:
-                chat_member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user.id)
+                chat_member = await context.bot.get_chat_member(chat_id=channel.channel_id, user_id=user.id)
                 if chat_member.status in ['member', 'administrator', 'creator']:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text="✅ Вы уже состоите в группе. Новая ссылка не требуется.",
-                        parse_mode=ParseMode.HTML
-                    )
-                    return
+                    if len(get_channels()) > 1:
+                        text = render('already_member_channel', lang, title=channel.title)
+                    else:
+                        text = render('already_member', lang)
+                    await context.bot.send_message(chat_id=chat_id, text=text)
+                    continue
             except Exception:
                 pass
 
-            invite_link = await generate_invite_link(context, user.id)
+            invite_link = await generate_invite_link(context, user.id, channel.channel_id)
             if not invite_link:
                 await context.bot.send_message(
                     chat_id=chat_id,
-                    text="⚠️ Ошибка создания ссылки",
+                    text=render('error_invite_link', lang),
                     parse_mode=ParseMode.HTML
                 )
                 return
 
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"✅ <b>Ваша подписка активна</b>\n\n"
-                     f"Тип: {'Платная' if sub_type == 'paid' else 'Пробный период'}\n"
-                     f"Осталось дней: {days_left}\n"
-                     f"Завершается: {datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ).strftime('%d.%m.%Y')}\n\n"
-                     f"🔗 Новая ссылка в группу: {invite_link}",
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)],
-                    [
-                        InlineKeyboardButton("💳 Продлить подписку", url=(await create_payment(user.id, context.bot.username))[0]),
-                        InlineKeyboardButton("❓ Помощь", callback_data="help")
-                    ]
-                ])
-            )
-        else:
-            payment_link, _ = await create_payment(user.id, context.bot.username)
-            if payment_link:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"❌ <b>Ваша подписка истекла</b>\n\n"
-                         f"Для возвращения в группу, пожалуйста, продлите подписку.\n"
-                         f"💳 Стоимость: {SUBSCRIPTION_PRICE} руб/месяц",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("💳 Продлить подписку", url=payment_link)],
-                        [InlineKeyboardButton("❓ Помощь", callback_data="help")]
-                    ])
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text="⚠️ Ошибка при создании платежа. Пожалуйста, попробуйте позже.",
-                    parse_mode=ParseMode.HTML
-                )
+            await send_active_subscription(context, chat_id, user.id, channel, sub_type, days_left, end_date,
+                                           invite_link, lang)
+
+        if not active_channels:
+            await send_subscription_expired(context, chat_id, user.id, 'expired_rejoin', lang)
     except Exception as e:
         logger.error(f"Error in rejoin for user {user.id}: {e}")
         await context.bot.send_message(
             chat_id=chat_id,
-            text="⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+            text=render('error_generic', user.language_code),
             parse_mode=ParseMode.HTML
         )
         await context.bot.send_message(
@@ -675,6 +777,155 @@ async def rejoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
 
+async def plans_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        query = update.callback_query
+        chat_id = query.message.chat_id if query else update.effective_user.id
+
+        lines = ["🗂 <b>Тарифы</b>\n"]
+        keyboard = []
+        for channel in get_channels():
+            lines.append(f"<b>{channel.title}</b>")
+            for plan in get_plans(channel.channel_id):
+                lines.append(f"• {plan.title} — {price_text(plan, promo.price(chat_id, plan)[0])}")
+                keyboard.append([InlineKeyboardButton(f"💳 {channel.title}: {plan.title}", callback_data=f"buy:{plan.plan_id}")])
+            lines.append("")
+
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="\n".join(lines),
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except Exception as e:
+        logger.error(f"Error in plans_menu: {e}")
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+            parse_mode=ParseMode.HTML
+        )
+
+async def buy_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_id: str):
+    query = update.callback_query
+    plan = get_plan(plan_id)
+    if not plan:
+        await query.message.reply_text("⚠️ Тариф не найден. Откройте список тарифов заново.", parse_mode=ParseMode.HTML)
+        return
+
+    payment_link, _ = await create_payment(query.from_user.id, context.bot.username, plan.plan_id)
+    if not payment_link:
+        await query.message.reply_text(
+            render('payment_unavailable', query.from_user.language_code),
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([(button('btn_payment_retry', query.from_user.language_code,
+                                                       callback_data=f"buy:{plan.plan_id}"),)])
+        )
+        return
+
+    await query.message.reply_text(
+        f"💳 <b>{get_channel(plan.channel_id).title}: {plan.title}</b>\n\n"
+        f"Стоимость: {price_text(plan, promo.price(query.from_user.id, plan)[0])}\n"
+        f"После оплаты вернитесь в бота — ссылка в группу придёт автоматически.",
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("💳 Оплатить", url=payment_link)],
+            [InlineKeyboardButton("💸 Статус платежа", callback_data="check_payment")]
+        ])
+    )
+
+async def autorenew_command(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str = None):
+    """Состояние автопродления и кнопка переключения; action — 'on'/'off' из кнопки."""
+    try:
+        query = update.callback_query
+        chat_id = query.message.chat_id if query else update.effective_user.id
+        user_id = update.effective_user.id
+        lang = update.effective_user.language_code
+
+        if action:
+            await storage.set_auto_renew(user_id, action == 'on')
+        method = await storage.get_payment_method(user_id)
+        if not method:
+            text, reply_markup = render('auto_renew_none', lang), None
+        else:
+            method_id, title, auto_renew = method[:3]
+            state = 'on' if auto_renew else 'off'
+            text = render(f'auto_renew_{state}', lang, method=html.escape(title or 'карта'))
+            reply_markup = InlineKeyboardMarkup([(button(
+                'btn_auto_renew_off' if auto_renew else 'btn_auto_renew_on', lang,
+                callback_data="autorenew:off" if auto_renew else "autorenew:on"),)])
+
+        if query:
+            await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        else:
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+                                           reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error in autorenew_command: {e}")
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+            parse_mode=ParseMode.HTML
+        )
+
+async def redeem_promo(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str):
+    """Активирует промокод пользователя и отвечает результатом."""
+    user = update.effective_user
+    lang = user.language_code
+    code = promo.normalize(code)
+    if not code:
+        await update.message.reply_text(render('promo_not_found', lang), parse_mode=ParseMode.HTML)
+        return
+    status, percent, bonus_days, subscription_end = await storage.redeem_promo_code(user.id, code)
+    if status != 'ok':
+        await update.message.reply_text(render(f'promo_{status}', lang), parse_mode=ParseMode.HTML)
+        return
+    logger.info(f"User {user.id} redeemed promo code {code}")
+    parts = []
+    if bonus_days:
+        await sync_user_index(user.id)
+        end_date = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y')
+        parts.append(render('promo_days', lang, code=code, days=bonus_days, end_date=end_date))
+    if percent:
+        promo.set_user_code(user.id, code, percent)
+        # Ссылки на оплату по прежней цене больше не выдаем
+        hot_state.drop_payment_links(user.id)
+        parts.append(render('promo_discount', lang, code=code, percent=percent,
+                            price=promo.price(user.id, get_default_plan())[0]))
+    await update.message.reply_text("\n\n".join(parts), parse_mode=ParseMode.HTML)
+
+async def promo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/promo КОД — активация промокода."""
+    try:
+        if not context.args:
+            await update.message.reply_text(render('promo_usage', update.effective_user.language_code),
+                                            parse_mode=ParseMode.HTML)
+            return
+        await redeem_promo(update, context, context.args[0])
+    except Exception as e:
+        logger.error(f"Error in promo_command: {e}")
+        await update.message.reply_text(render('error_generic', update.effective_user.language_code),
+                                        parse_mode=ParseMode.HTML)
+
+async def referral_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/referral — ссылка для приглашения друзей и их число."""
+    try:
+        user_id = update.effective_user.id
+        lang = update.effective_user.language_code
+        if not REFERRAL_DAYS:
+            await update.message.reply_text(render('referral_off', lang), parse_mode=ParseMode.HTML)
+            return
+        invited, credited = await storage.count_referrals(user_id)
+        await update.message.reply_text(
+            render('referral_info', lang, days=REFERRAL_DAYS, invited=invited, credited=credited,
+                   link=f"https://t.me/{context.bot.username}?start=ref_{user_id}"),
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True
+        )
+    except Exception as e:
+        logger.error(f"Error in referral_command: {e}")
+        await update.message.reply_text(render('error_generic', update.effective_user.language_code),
+                                        parse_mode=ParseMode.HTML)
+
 async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
@@ -685,26 +936,13 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user = update.effective_user
             chat_id = user.id
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT payment_id, status FROM payments
-        WHERE user_id = ?
-        ORDER BY date DESC LIMIT 1
-        ''', (user.id,))
-        payment = cursor.fetchone()
+        payment = await storage.get_last_payment(user.id)
 
         if payment:
             payment_id, status = payment
             if status == 'pending':
                 await check_payment_status(payment_id, user.id, context)
-                cursor.execute('''
-                SELECT status FROM payments
-                WHERE payment_id = ?
-                ''', (payment_id,))
-                status = cursor.fetchone()[0]
-
-        conn.close()
+                status = (await storage.get_payment(payment_id))[3]
 
         if payment:
             payment_id, _ = payment
@@ -766,12 +1004,27 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/check - Проверить статус подписки\n"
             "/rejoin - Получить новую ссылку в группу, если вы вышли\n"
             "/check_payment - Проверить статус последнего платежа\n"
+            "/plans - Тарифы и группы\n"
+            "/autorenew - Автопродление подписки\n"
+            "/promo - Активировать промокод\n"
+            "/referral - Пригласить друга\n"
             "/help - Показать это сообщение с командами\n"
         )
         if update.effective_user.id in [ADMIN_ID, FRIEND_ID]:
             text += (
                 "/admin - Открыть меню администратора для управления ботом\n"
                 "   ℹ️ В меню админа используйте кнопки для действий, например, просмотр активных пользователей.\n"
+                "/stats - Статистика подписок и платежей\n"
+                "/reconcile [full] [enforce] - Сверить базу с участниками каналов\n"
+                "/health - Состояние ЮKassa и Bot API\n"
+                "/promo_add - Создать промокод\n"
+                "/promos - Промокоды и активации\n"
+                "/history &lt;user_id&gt; - История доступа пользователя\n"
+                "/backup - Копия базы данных файлом\n"
+                "/grant &lt;дни&gt; id… - Выдать доступ списку пользователей\n"
+                "/extend &lt;дни&gt; id… - Продлить доступ списку пользователей\n"
+                "/revoke id… - Отозвать доступ и исключить из группы\n"
+                "   ℹ️ Вместо списка можно прислать CSV-файл с командой в подписи.\n"
             )
 
         await context.bot.send_message(
@@ -806,7 +1059,9 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         keyboard = [
-            [InlineKeyboardButton("📋 Список зарегистрированных пользователей", callback_data="remove_inactive")]
+            [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
+            [InlineKeyboardButton("📋 Список зарегистрированных пользователей", callback_data="remove_inactive")],
+            [InlineKeyboardButton("🔍 Сверка с участниками каналов", callback_data="reconcile")]
         ]
         await update.message.reply_text(
             "🔧 <b>Меню администратора</b>\n\n"
@@ -833,39 +1088,420 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
 
-async def remove_inactive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def active_users_page(after_user_id: int = None, before_user_id: int = None):
+    """Текст и клавиатура одной страницы отчета об активных пользователях.
+
+    Страница выбирается по user_id соседней страницы (keyset), поэтому каждое нажатие
+    читает из базы не больше ACTIVE_USERS_PAGE_SIZE + 1 строк."""
+    rows = await storage.get_active_users_page(after_user_id, before_user_id, ACTIVE_USERS_PAGE_SIZE + 1)
+    if before_user_id is not None:
+        has_prev, has_next = len(rows) > ACTIVE_USERS_PAGE_SIZE, True
+        rows = rows[-ACTIVE_USERS_PAGE_SIZE:]
+    else:
+        has_prev, has_next = after_user_id is not None, len(rows) > ACTIVE_USERS_PAGE_SIZE
+        rows = rows[:ACTIVE_USERS_PAGE_SIZE]
+    if not rows and (after_user_id is not None or before_user_id is not None):
+        # Пользователи соседней страницы успели потерять доступ — начинаем сначала
+        return await active_users_page()
+    if not rows:
+        return "ℹ️ Нет активных пользователей в базе данных.", None
+
+    total = await storage.count_active_users()
+    user_list = "\n".join(
+        f"👤 ID: {user_id}, Username: @{username or 'без имени'}"
+        for user_id, username in rows
+    )
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"users:prev:{rows[0][0]}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"users:next:{rows[-1][0]}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("📥 Скачать CSV", callback_data="users:csv")])
+    text = (
+        f"📋 <b>Активные пользователи ({total}):</b>\n\n"
+        f"{user_list}\n\n"
+        f"ℹ️ Сверка этого списка с участниками каналов: /reconcile"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def send_active_users_csv(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """Выгружает активных пользователей в CSV пачками из базы, не собирая список в памяти."""
+    # Строки пишутся во временный файл по мере чтения пачек; в память попадает только готовый файл при отправке
+    with tempfile.TemporaryFile() as buffer:
+        text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(['user_id', 'username'])
+        count = 0
+        async for batch in storage.iter_active_users():
+            writer.writerows(batch)
+            count += len(batch)
+        text.flush()
+        text.detach()
+        buffer.seek(0)
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=buffer,
+            filename=f"active_users_{datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M')}.csv",
+            caption=f"📋 Активные пользователи: {count}"
+        )
+
+async def stats_text() -> str:
+    """Сводка для админа из агрегатов статистики (без запросов по payments и users)."""
+    counters, daily, monthly = await storage.get_stats(days=7, months=6)
+    value = lambda name: int(counters.get(name, 0))
+    users_total, users_paid = value('users_total'), value('users_paid')
+    conversion = f"{users_paid / users_total * 100:.1f}%" if users_total else "—"
+    current_month = datetime.utcnow().strftime('%Y-%m')
+    month_churn = {metric: int(amount) for period, metric, amount in monthly if period == current_month}
+
+    statuses = sorted(
+        (name[len('payments_'):], int(amount)) for name, amount in counters.items()
+        if name.startswith('payments_') and amount
+    )
+    revenue_by_day = [(period, amount) for period, metric, amount in daily if metric == 'revenue']
+    revenue_by_month = [(period, amount) for period, metric, amount in monthly if metric == 'revenue']
+    summary_lines = ""
+    if user_index.is_ready():
+        # Когорта по индексу в памяти, без запроса по всем доступам
+        now = datetime.now(MOSCOW_TZ)
+        expiring = user_index.cohort(now.strftime('%Y-%m-%d %H:%M:%S'),
+                                     (now + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S'))
+        trial = sum(1 for user_id, channel_id, is_trial in expiring if is_trial)
+        summary_lines = f"⏳ Истекает в ближайшие 24 ч: платных {len(expiring) - trial}, пробных {trial}\n"
+    if value('promo_redemptions') or value('referrals_credited'):
+        summary_lines += (f"🎟 Промокодов активировано: {value('promo_redemptions')}, "
+                          f"оплаченных приглашений: {value('referrals_credited')}\n")
+    if value('purged_payments') or value('purged_outbox'):
+        summary_lines += (f"🧹 Удалено устаревших записей: платежей {value('purged_payments')}, "
+                          f"сообщений {value('purged_outbox')}\n")
+    if value('trials_flagged') or value('trials_denied'):
+        summary_lines += (f"🕵️ Повторные пробные: выдано с пометкой {value('trials_flagged')}, "
+                          f"отклонено {value('trials_denied')}\n")
+
+    text = (
+        "📊 <b>Статистика</b>\n\n"
+        f"💎 Активные платные доступы: {value('active_paid')}\n"
+        f"🎁 Активные пробные доступы: {value('active_trial')}\n"
+        f"🔁 Конверсия пробный → платный: {users_paid} из {users_total} ({conversion})\n"
+        f"📉 Отток за месяц: платных {month_churn.get('churned_paid', 0)}, "
+        f"пробных {month_churn.get('churned_trial', 0)} "
+        f"(всего {value('churned_paid')} / {value('churned_trial')})\n"
+        f"{summary_lines}\n"
+        "💳 <b>Платежи по статусам:</b>\n"
+    )
+    text += "\n".join(f"  {status}: {count}" for status, count in statuses) or "  нет платежей"
+    text += "\n\n💰 <b>Выручка по дням (UTC):</b>\n"
+    text += "\n".join(f"  {period}: {amount:.0f} руб" for period, amount in revenue_by_day) or "  нет оплат"
+    text += "\n\n💰 <b>Выручка по месяцам:</b>\n"
+    text += "\n".join(f"  {period}: {amount:.0f} руб" for period, amount in revenue_by_month) or "  нет оплат"
+    return text
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         if user_id not in [ADMIN_ID, FRIEND_ID]:
             await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
             return
+        await update.message.reply_text(await stats_text(), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Error in stats_command: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"⚠️ Ошибка в stats_command: {e}",
+            parse_mode=ParseMode.HTML
+        )
+        if FRIEND_ID:
+            await context.bot.send_message(
+                chat_id=FRIEND_ID,
+                text=f"⚠️ Ошибка в stats_command: {e}",
+                parse_mode=ParseMode.HTML
+            )
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT user_id, username FROM users WHERE active = 1
-        ''')
-        active_users = cursor.fetchall()
-        conn.close()
+def health_text() -> str:
+    """Отчет о предохранителях внешних сервисов для /health."""
+    states = {'closed': "✅ работает", 'half_open': "🟡 проверка восстановления", 'open': "❌ недоступен"}
+    lines = ["🩺 <b>Внешние сервисы</b>"]
+    for item in circuit_health():
+        line = f"\n<b>{CIRCUIT_TITLES.get(item['name'], item['name'])}</b>: {states[item['state']]}"
+        if item['opened_since']:
+            line += f" с {datetime.fromtimestamp(item['opened_since'], MOSCOW_TZ).strftime('%d.%m %H:%M')}"
+        line += (f"\n  Вызовов: {item['calls']}, сбоев: {item['failures']}, "
+                 f"отклонено: {item['rejected']}")
+        if item['last_error']:
+            line += f"\n  Последний сбой: {html.escape(item['last_error'][:200])}"
+        lines.append(line)
+    if USER_INDEX:
+        size = user_index.size()
+        lines.append("\n📇 <b>Индекс доступов</b>: " + (
+            f"{size['entries']} записей, {size['bytes'] // 1024} КБ" if user_index.is_ready() else "строится"))
+    if TRIAL_GUARD != 'off':
+        size = trial_guard.size()
+        lines.append("🕵️ <b>Фильтр повторных пробных</b>: " + (
+            f"{size['keys']} ключей, {size['bytes'] // 1024} КБ" if trial_guard.is_ready() else "строится"))
+    return "\n".join(lines)
+
+async def health_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user_id = update.effective_user.id
+        if user_id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+        await update.message.reply_text(health_text(), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Error in health_command: {e}")
 
-        if not active_users:
+async def promo_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/promo_add КОД [N%] [Nd] [лимит] [ГГГГ-ММ-ДД] — новый промокод: скидка N% на следующую
+    оплату и/или N дней доступа, лимит активаций и последний день действия."""
+    try:
+        if update.effective_user.id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+        args = context.args or []
+        code = promo.normalize(args[0]) if args else None
+        percent, bonus_days, max_redemptions, expires_at = 0, 0, None, None
+        try:
+            for arg in args[1:]:
+                if arg.endswith('%'):
+                    percent = int(arg[:-1])
+                elif arg.lower().endswith('d'):
+                    bonus_days = int(arg[:-1])
+                elif '-' in arg:
+                    expires_at = (datetime.strptime(arg, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+                else:
+                    max_redemptions = int(arg)
+        except ValueError:
+            code = None
+        if not code or not 0 <= percent < 100 or bonus_days < 0 or not (percent or bonus_days):
             await update.message.reply_text(
-                "ℹ️ Нет активных пользователей в базе данных.",
+                "ℹ️ Формат: /promo_add КОД [N%] [Nd] [лимит] [ГГГГ-ММ-ДД]\n"
+                "Например: /promo_add SPRING 20% 100 2026-12-31 или /promo_add GIFT 7d 50\n"
+                "Код — 3–32 символа: латиница, цифры, _ и -; скидка — меньше 100%.",
                 parse_mode=ParseMode.HTML
             )
             return
-
-        user_list = "\n".join(
-            f"👤 ID: {user[0]}, Username: @{user[1] or 'без имени'}"
-            for user in active_users
-        )
+        if not await storage.add_promo_code(code, percent, bonus_days, max_redemptions, expires_at):
+            await update.message.reply_text(f"⚠️ Промокод {code} уже существует.", parse_mode=ParseMode.HTML)
+            return
+        promo.add_code(code, percent)
         await update.message.reply_text(
-            f"📋 <b>Активные пользователи ({len(active_users)}):</b>\n\n"
-            f"{user_list}\n\n"
-            f"ℹ️ Telegram не позволяет ботам видеть участников приватной группы. "
-            f"Пожалуйста, проверьте участников группы вручную в настройках Telegram и сравните с этим списком.",
-            parse_mode=ParseMode.HTML
+            f"✅ Промокод <b>{code}</b> создан\n"
+            f"Ссылка: https://t.me/{context.bot.username}?start=promo_{code}",
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True
         )
+    except Exception as e:
+        logger.error(f"Error in promo_add_command: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+                                        parse_mode=ParseMode.HTML)
+
+async def promos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/promos — промокоды и число активаций."""
+    try:
+        if update.effective_user.id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+        lines = ["🎟 <b>Промокоды</b>\n"]
+        for code, percent, bonus_days, max_redemptions, redemptions, expires_at in await storage.get_promo_codes():
+            terms = ", ".join(part for part in (f"-{percent}%" if percent else "",
+                                                f"+{bonus_days} дн." if bonus_days else "") if part)
+            line = f"• <b>{code}</b>: {terms}; активаций {redemptions}"
+            if max_redemptions is not None:
+                line += f" из {max_redemptions}"
+            if expires_at:
+                line += f"; до {(datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S') - timedelta(days=1)):%d.%m.%Y}"
+            lines.append(line)
+        if len(lines) == 1:
+            lines.append("Промокодов нет. Создать: /promo_add")
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Error in promos_command: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+                                        parse_mode=ParseMode.HTML)
+
+def format_event(event: tuple) -> str:
+    event_id, user_id, channel_id, kind, payload, created_at = event
+    channel = get_channel(channel_id)
+    details = ", ".join(f"{key}={value}" for key, value in payload.items())
+    return (f"#{event_id} {created_at} <b>{kind}</b> ({html.escape(channel.title if channel else str(channel_id))})"
+            + (f": {html.escape(details)}" if details else ""))
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history <user_id> — события доступа пользователя и состояние, восстановленное из журнала."""
+    try:
+        if update.effective_user.id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+        if len(context.args or []) != 1 or not context.args[0].isdigit():
+            await update.message.reply_text("Использование: /history &lt;user_id&gt;", parse_mode=ParseMode.HTML)
+            return
+        user_id = int(context.args[0])
+        events = await storage.get_user_events(user_id)
+        states = event_log.replay(user_id, await storage.get_user_snapshots(user_id), events)
+        entitlements = {row[0]: row[1:] for row in await storage.get_user_entitlements(user_id)}
+        lines = [f"📜 <b>История {user_id}</b>\n"]
+        if len(events) > HISTORY_LIMIT:
+            lines.append(f"… еще {len(events) - HISTORY_LIMIT} событий раньше")
+        lines.extend(format_event(event) for event in events[-HISTORY_LIMIT:])
+        if not events:
+            lines.append("Событий нет")
+        for channel_id in sorted(set(states) | set(entitlements)):
+            state = states.get(channel_id, event_log.empty_state())
+            channel = get_channel(channel_id)
+            status = "активен" if state['active'] else "не активен"
+            line = (f"\n🔎 {html.escape(channel.title if channel else str(channel_id))}: {status}, "
+                    f"до {state['subscription_end'] or '—'}"
+                    f"{' (пробный)' if state['is_trial'] else ''}, в канале: {state['member'] or '—'}")
+            mismatched = event_log.differences(state, entitlements.get(channel_id))
+            if mismatched:
+                line += f"\n⚠️ Расходится с базой: {', '.join(mismatched)}"
+            lines.append(line)
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Error in history_command: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+                                        parse_mode=ParseMode.HTML)
+
+def bulk_usage(action: str) -> str:
+    if action == 'revoke':
+        return "Использование: /revoke user_id или @имя … — или CSV-файл с подписью /revoke"
+    return f"Использование: /{action} &lt;дни&gt; user_id или @имя … — или CSV-файл с подписью /{action} &lt;дни&gt;"
+
+def bulk_report(action: str, days: int, channel, changes: list, found: dict, missing: list, invalid: list) -> str:
+    title = {'grant': f"выдан доступ на {days} дн.", 'extend': f"продлено на {days} дн.",
+             'revoke': "доступ отозван"}[action]
+    skipped = {'grant': "уже есть доступ", 'extend': "", 'revoke': "нет доступа"}[action]
+    lines = [f"✅ <b>{html.escape(channel.title)}</b>: {title} — {len(changes)} польз."]
+    if len(found) > len(changes):
+        lines.append(f"⏭ Пропущено ({skipped}): {len(found) - len(changes)}")
+    for label, values in (("Не найдены", missing), ("Не распознаны", invalid)):
+        if values:
+            shown = ", ".join(html.escape(str(value)) for value in values[:BULK_REPORT_LIMIT])
+            more = f" и еще {len(values) - BULK_REPORT_LIMIT}" if len(values) > BULK_REPORT_LIMIT else ""
+            lines.append(f"⚠️ {label} ({len(values)}): {shown}{more}")
+    return "\n".join(lines)
+
+async def report_bulk_progress(status_message, report: str, batch_id: str, total: int):
+    """Обновляет отчет операции, пока dispatch_outbox доставляет ее сообщения."""
+    started = time.monotonic()
+    shown = None
+    while not shutting_down() and time.monotonic() - started < BULK_PROGRESS_TIMEOUT:
+        await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+        try:
+            progress = await storage.get_outbox_progress(bulk_access.outbox_prefix(batch_id))
+            pending = progress.get('pending', 0)
+            text = (f"{report}\n📨 Сообщения: доставлено {progress.get('sent', 0)} из {total}"
+                    + (f", не доставлено {progress['dead']}" if progress.get('dead') else "")
+                    + (" ⏳" if pending else " ✅"))
+            if text != shown:
+                await status_message.edit_text(text, parse_mode=ParseMode.HTML)
+                shown = text
+            if not pending:
+                return
+        except Exception as e:
+            logger.error(f"Error reporting bulk progress {batch_id}: {e}")
+            return
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/grant <дни>, /extend <дни>, /revoke — для списка user_id и @имен в команде или в CSV-файле
+    с командой в подписи. Изменения применяются одной транзакцией, сообщения и исключения из
+    канала уходят через outbox."""
+    try:
+        if update.effective_user.id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+        message = update.message
+        words = (message.text or message.caption or '').split()
+        action = words[0][1:].split('@')[0].lower()
+        args = words[1:]
+        days = 0
+        if action != 'revoke':
+            if not args or not args[0].isdigit() or not 1 <= int(args[0]) <= bulk_access.MAX_DAYS:
+                await message.reply_text(bulk_usage(action), parse_mode=ParseMode.HTML)
+                return
+            days = int(args.pop(0))
+        user_ids, usernames, invalid = bulk_access.parse_identifiers(args)
+        if message.document:
+            if message.document.file_size and message.document.file_size > BULK_FILE_LIMIT:
+                await message.reply_text(f"⚠️ Файл больше {BULK_FILE_LIMIT // 1024} КБ.", parse_mode=ParseMode.HTML)
+                return
+            data = await (await message.document.get_file()).download_as_bytearray()
+            file_ids, file_names, file_invalid = bulk_access.parse_csv(bytes(data))
+            user_ids = list(dict.fromkeys(user_ids + file_ids))
+            usernames = list(dict.fromkeys(usernames + file_names))
+            invalid += file_invalid
+        if not user_ids and not usernames:
+            await message.reply_text(bulk_usage(action), parse_mode=ParseMode.HTML)
+            return
+
+        status_message = await message.reply_text(
+            f"⏳ Ищу пользователей: {len(user_ids) + len(usernames)}…", parse_mode=ParseMode.HTML)
+        found, missing = await storage.resolve_users(user_ids, usernames)
+        await status_message.edit_text(f"⏳ Применяю к {len(found)} пользователям…", parse_mode=ParseMode.HTML)
+        channel = get_default_channel()
+        batch_id = f"{action}:{message.chat_id}:{message.message_id}"
+        changes = await storage.bulk_update_access(action, list(found), channel.channel_id, days, batch_id)
+        # Индекс и приглашения этого процесса; другие процессы подтянут изменения по updated_at
+        for user_id, subscription_end, is_trial, active, previous in changes:
+            if user_index.is_ready():
+                user_index.put(user_id, channel.channel_id, previous[0] if previous else None,
+                               subscription_end, is_trial, active)
+            if not active:
+                hot_state.drop_invite_link(user_id, channel.channel_id)
+        logger.info(f"Bulk {action} by {update.effective_user.id}: {len(changes)} changed, "
+                    f"{len(found) - len(changes)} skipped, {len(missing)} not found")
+        report = bulk_report(action, days, channel, changes, found, missing, invalid)
+        await status_message.edit_text(report + ("\n📨 Сообщения в очереди ⏳" if changes else ""),
+                                       parse_mode=ParseMode.HTML)
+        if changes:
+            wake_outbox(context)
+            context.application.create_task(report_bulk_progress(status_message, report, batch_id, len(changes)))
+    except Exception as e:
+        logger.error(f"Error in bulk_command: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+                                        parse_mode=ParseMode.HTML)
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/backup — снять проверенную копию базы и прислать ее документом."""
+    try:
+        if update.effective_user.id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+        if storage.name != 'sqlite':
+            await update.message.reply_text(
+                "ℹ️ Копии снимаются только для SQLite. Для PostgreSQL используйте pg_dump.",
+                parse_mode=ParseMode.HTML)
+            return
+        await update.message.reply_text("⏳ Снимаю копию базы…", parse_mode=ParseMode.HTML)
+        path, counts = await make_backup()
+        caption = (f"💾 Копия базы проверена: {sum(counts.values())} строк, "
+                   f"пользователей {counts.get('users', 0)}, платежей {counts.get('payments', 0)}")
+        if os.path.getsize(path) > BACKUP_DOCUMENT_LIMIT:
+            await update.message.reply_text(f"{caption}\nФайл слишком большой для отправки: {html.escape(path)}",
+                                            parse_mode=ParseMode.HTML)
+            return
+        with open(path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=os.path.basename(path),
+                caption=caption
+            )
+    except Exception as e:
+        logger.error(f"Error in backup_command: {e}")
+        await update.message.reply_text("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+                                        parse_mode=ParseMode.HTML)
+
+async def remove_inactive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user_id = update.effective_user.id
+        if user_id not in [ADMIN_ID, FRIEND_ID]:
+            await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+            return
+
+        text, reply_markup = await active_users_page()
+        await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     except Exception as e:
         logger.error(f"Error in remove_inactive: {e}")
         await update.message.reply_text(
@@ -897,38 +1533,44 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await check_payment(update, context)
         elif query.data == "help":
             await help_command(update, context)
+        elif query.data == "plans":
+            await plans_menu(update, context)
+        elif query.data.startswith("buy:"):
+            await buy_plan(update, context, query.data.split(":", 1)[1])
+        elif query.data.startswith("autorenew:"):
+            await autorenew_command(update, context, query.data.split(":", 1)[1])
         elif query.data == "remove_inactive":
             user_id = query.from_user.id
             if user_id not in [ADMIN_ID, FRIEND_ID]:
                 await query.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
                 return
 
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            SELECT user_id, username FROM users WHERE active = 1
-            ''')
-            active_users = cursor.fetchall()
-            conn.close()
-
-            if not active_users:
-                await query.message.reply_text(
-                    "ℹ️ Нет активных пользователей в базе данных.",
-                    parse_mode=ParseMode.HTML
-                )
+            text, reply_markup = await active_users_page()
+            await query.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        elif query.data == "stats":
+            if query.from_user.id not in [ADMIN_ID, FRIEND_ID]:
+                await query.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+                return
+            await query.message.reply_text(await stats_text(), parse_mode=ParseMode.HTML)
+        elif query.data == "reconcile":
+            if query.from_user.id not in [ADMIN_ID, FRIEND_ID]:
+                await query.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+                return
+            await start_manual_reconcile(query.message, context)
+        elif query.data.startswith("users:"):
+            if query.from_user.id not in [ADMIN_ID, FRIEND_ID]:
+                await query.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
                 return
 
-            user_list = "\n".join(
-                f"👤 ID: {user[0]}, Username: @{user[1] or 'без имени'}"
-                for user in active_users
-            )
-            await query.message.reply_text(
-                f"📋 <b>Активные пользователи ({len(active_users)}):</b>\n\n"
-                f"{user_list}\n\n"
-                f"ℹ️ Telegram не позволяет ботам видеть участников приватной группы. "
-                f"Пожалуйста, проверьте участников группы вручную в настройках Telegram и сравните с этим списком.",
-                parse_mode=ParseMode.HTML
-            )
+            action, _, user_id = query.data.split(":", 1)[1].partition(":")
+            if action == "csv":
+                await send_active_users_csv(query.message.chat_id, context)
+                return
+            if action == "next":
+                text, reply_markup = await active_users_page(after_user_id=int(user_id))
+            else:
+                text, reply_markup = await active_users_page(before_user_id=int(user_id))
+            await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
         else:
             await query.message.reply_text(
                 "⚠️ Неизвестная команда. Пожалуйста, используйте кнопки из меню.",
@@ -953,132 +1595,130 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
 
-async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, username, subscription_end, trial_used, join_date, active FROM users WHERE active = 1')
-        users = cursor.fetchall()
-
-        now = datetime.now(MOSCOW_TZ)
-        for user_id, username, subscription_end, trial_used, join_date, active in users:
-            end_date = None
-            days_left = None
-            if subscription_end:
-                end_date = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                days_left = max(0, ceil((end_date - now).total_seconds() / (24 * 3600)))
-            elif not trial_used:
-                join = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                trial_end = join + timedelta(days=TRIAL_DAYS)
-                days_left = max(0, ceil((trial_end - now).total_seconds() / (24 * 3600)))
-                end_date = trial_end
-
-            if days_left is not None and days_left >= 0:
-                if days_left in [1, 3]:
-                    payment_link, _ = await create_payment(user_id, context.bot.username)
-                    if payment_link:
-                        try:
-                            await context.bot.send_message(
-                                chat_id=user_id,
-                                text=f"⚠️ <b>Ваша подписка заканчивается через {days_left} день(дня)!</b>\n\n"
-                                     f"Пожалуйста, продлите подписку, чтобы продолжить доступ в группе.\n"
-                                     f"💳 Стоимость: {SUBSCRIPTION_PRICE} руб/месяц",
-                                parse_mode=ParseMode.HTML,
-                                reply_markup=InlineKeyboardMarkup([
-                                    [InlineKeyboardButton("💳 Продлить подписку", url=payment_link)]
-                                ])
-                            )
-                        except TelegramError as e:
-                            if "chat not found" in str(e).lower():
-                                logger.info(f"Skipping subscription reminder for user {user_id}: Chat not found")
-                            else:
-                                logger.error(f"Error sending subscription reminder to user {user_id}: {e}")
-                                await context.bot.send_message(
-                                    chat_id=ADMIN_ID,
-                                    text=f"⚠️ Ошибка отправки напоминания пользователю {user_id}: {e}",
-                                    parse_mode=ParseMode.HTML
-                                )
-                                if FRIEND_ID:
-                                    await context.bot.send_message(
-                                        chat_id=FRIEND_ID,
-                                        text=f"⚠️ Ошибка отправки напоминания пользователю {user_id}: {e}",
-                                        parse_mode=ParseMode.HTML
-                                    )
-            if end_date and end_date < now and active:
-                # Обновляем статус в базе перед попыткой исключения
-                cursor.execute('UPDATE users SET active = 0 WHERE user_id = ?', (user_id,))
-                conn.commit()
-                logger.info(f"User {user_id} (@{username or 'без имени'}) marked as inactive in database")
+async def process_due_entitlement(context: ContextTypes.DEFAULT_TYPE, entitlement, now: datetime,
+                                  auto_renew: bool = False):
+    """Напоминание или исключение по одному истекающему доступу. Повторный вызов безопасен:
+    отключение и бан идемпотентны, а сообщения в outbox не дублируются по ключу.
+    auto_renew — доступ продлит renew_subscriptions, напоминать не нужно."""
+    user_id, username, channel_id, plan_id, subscription_end, is_trial = entitlement
+    channel = get_channel(channel_id)
+    if not channel:
+        logger.warning(f"Skipping entitlement of user {user_id} for unknown channel {channel_id}")
+        return
+    plan = get_plan(plan_id)
+    if not plan or plan.channel_id != channel_id:
+        plan = get_default_plan(channel_id)
+
+    end_date = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
+    days_left = max(0, ceil((end_date - now).total_seconds() / (24 * 3600)))
+
+    if days_left in [1, 3] and not auto_renew:
+        # Ключ дедупликации: повторный проход после перезапуска не шлет напоминание второй раз
+        await storage.enqueue_outbox([(
+            user_id, 'subscription_reminder',
+            {'channel_id': channel_id, 'plan_id': plan.plan_id, 'days_left': days_left},
+            f"reminder:{user_id}:{channel_id}:{subscription_end}:{days_left}"
+        )])
+    if end_date < now:
+        # Обновляем статус в базе перед попыткой исключения; уведомление пользователю
+        # ставится в outbox в той же транзакции. Доступ, продленный после чтения списка
+        # (оплата, промокод, выдача админом), не отключается
+        if not await storage.deactivate_entitlement(user_id, channel_id, [(
+            user_id, 'subscription_expired', {'channel_id': channel_id, 'plan_id': plan.plan_id},
+            f"expired:{user_id}:{channel_id}:{subscription_end}"
+        )], now.strftime('%Y-%m-%d %H:%M:%S')):
+            logger.info(f"Access of user {user_id} to channel {channel_id} was extended, skipping removal")
+            return
+        user_index.deactivate(user_id, channel_id)
+        logger.info(f"User {user_id} (@{username or 'без имени'}) marked as inactive for channel {channel_id}")
 
-                try:
-                    await context.bot.ban_chat_member(
-                        chat_id=CHANNEL_ID,
-                        user_id=user_id
-                    )
-                    logger.info(f"User {user_id} (@{username or 'без имени'}) removed from group due to expired subscription")
+        try:
+            await context.bot.ban_chat_member(
+                chat_id=channel_id,
+                user_id=user_id
+            )
+            logger.info(f"User {user_id} (@{username or 'без имени'}) removed from group {channel_id} due to expired subscription")
+            # Продолжение прерванного прохода банит пользователя повторно, а ключ дедупликации
+            # не дает повторить уведомление админам
+            await storage.enqueue_outbox([
+                (admin_id, 'member_removed', {'user_id': user_id, 'username': username, 'channel_id': channel_id},
+                 f"expired-admin:{user_id}:{channel_id}:{subscription_end}:{admin_id}")
+                for admin_id in (ADMIN_ID, FRIEND_ID) if admin_id
+            ])
+        except TelegramError as e:
+            if "participant_id_invalid" in str(e).lower():
+                logger.info(f"User {user_id} (@{username or 'без имени'}) not in group, skipping ban")
+            else:
+                logger.error(f"Error banning user {user_id}: {e}")
+                await context.bot.send_message(
+                    chat_id=ADMIN_ID,
+                    text=f"⚠️ Ошибка при удалении пользователя {user_id} (@{username or 'без имени'}): {e}",
+                    parse_mode=ParseMode.HTML
+                )
+                if FRIEND_ID:
                     await context.bot.send_message(
-                        chat_id=ADMIN_ID,
-                        text=f"✅ Пользователь {user_id} (@{username or 'без имени'}) удалён из группы из-за истёкшей подписки",
+                        chat_id=FRIEND_ID,
+                        text=f"⚠️ Ошибка при удалении пользователя {user_id} (@{username or 'без имени'}): {e}",
                         parse_mode=ParseMode.HTML
                     )
-                    if FRIEND_ID:
-                        await context.bot.send_message(
-                            chat_id=FRIEND_ID,
-                            text=f"✅ Пользователь {user_id} (@{username or 'без имени'}) удалён из группы из-за истёкшей подписки",
-                            parse_mode=ParseMode.HTML
-                        )
-                except TelegramError as e:
-                    if "participant_id_invalid" in str(e).lower():
-                        logger.info(f"User {user_id} (@{username or 'без имени'}) not in group, skipping ban")
-                    else:
-                        logger.error(f"Error banning user {user_id}: {e}")
-                        await context.bot.send_message(
-                            chat_id=ADMIN_ID,
-                            text=f"⚠️ Ошибка при удалении пользователя {user_id} (@{username or 'без имени'}): {e}",
-                            parse_mode=ParseMode.HTML
-                        )
-                        if FRIEND_ID:
-                            await context.bot.send_message(
-                                chat_id=FRIEND_ID,
-                                text=f"⚠️ Ошибка при удалении пользователя {user_id} (@{username or 'без имени'}): {e}",
-                                parse_mode=ParseMode.HTML
-                            )
-
-                payment_link, _ = await create_payment(user_id, context.bot.username)
-                if payment_link:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=f"❌ <b>Ваша подписка истекла</b>\n\n"
-                                 f"Вы были исключены из группы HappyFaceClub.\n"
-                                 f"Для продолжения доступа, пожалуйста, продлите подписку.\n"
-                                 f"💳 Стоимость: {SUBSCRIPTION_PRICE} руб/месяц",
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("💳 Продлить подписку", url=payment_link)]
-                            ])
-                        )
-                    except TelegramError as e:
-                        if "chat not found" in str(e).lower():
-                            logger.info(f"Skipping expiration notification for user {user_id} (@{username or 'без имени'}): Chat not found")
-                        else:
-                            logger.error(f"Error notifying user {user_id} about expiration: {e}")
-                            await context.bot.send_message(
-                                chat_id=ADMIN_ID,
-                                text=f"⚠️ Ошибка уведомления пользователя {user_id} (@{username or 'без имени'}) об истечении подписки: {e}",
-                                parse_mode=ParseMode.HTML
-                            )
-                            if FRIEND_ID:
-                                await context.bot.send_message(
-                                    chat_id=FRIEND_ID,
-                                    text=f"⚠️ Ошибка уведомления пользователя {user_id} (@{username or 'без имени'}) об истечении подписки: {e}",
-                                    parse_mode=ParseMode.HTML
-                                )
-        conn.close()
+
+async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    """Напоминает об окончании подписки и исключает пользователей с истекшим доступом.
+
+    Доступы обрабатываются по возрастанию (subscription_end, user_id, channel_id), и позиция
+    последнего обработанного сохраняется в job_state каждые SWEEP_CHECKPOINT_ROWS доступов или
+    SWEEP_CHECKPOINT_INTERVAL секунд и при остановке бота. Следующий запуск продолжает проход
+    с этой позиции и с тем же моментом «сейчас»; доступы после нее обрабатываются заново, в том
+    числе уже отключенные этим проходом, но, возможно, не исключенные из канала. Уведомления
+    пользователю и админам при этом не повторяются: они идут через outbox с ключами дедупликации."""
+    try:
+        checkpoint = await storage.get_job_checkpoint('check_subscriptions')
+        now = datetime.now(MOSCOW_TZ)
+        deactivated_since = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        after = None
+        resumed = False
+        if checkpoint:
+            started = MOSCOW_TZ.localize(datetime.strptime(checkpoint['now'], '%Y-%m-%d %H:%M:%S'))
+            # Проход старше суток не продолжаем: напоминания в нем уже неактуальны
+            if now - started < timedelta(days=1):
+                now = started
+                deactivated_since = checkpoint.get('started_at', deactivated_since)
+                after = checkpoint.get('after')
+                resumed = True
+                logger.info(f"Resuming check_subscriptions after {after}")
+        started_text = now.strftime('%Y-%m-%d %H:%M:%S')
+        # Напоминания уходят за 1 и 3 дня, поэтому достаточно доступов, истекающих в ближайшие 4 дня
+        cutoff = (now + timedelta(days=4)).strftime('%Y-%m-%d %H:%M:%S')
+        if resumed:
+            entitlements = [tuple(row) for row in await storage.get_due_entitlements(
+                cutoff, after, deactivated_since, started_text)]
+        else:
+            entitlements = [tuple(row) for row in await storage.get_due_entitlements(cutoff)]
+        # Платные доступы с автопродлением продлеваются без напоминаний
+        auto_renew = await storage.get_auto_renew_user_ids(
+            list({row[0] for row in entitlements if not row[5]})) if AUTO_RENEW else set()
+
+        async def save_checkpoint():
+            await storage.set_job_checkpoint('check_subscriptions', {
+                'now': started_text, 'started_at': deactivated_since, 'after': after})
+
+        processed, saved_at = 0, time.monotonic()
+        for entitlement in entitlements:
+            if shutting_down():
+                await save_checkpoint()
+                logger.info(f"check_subscriptions interrupted by shutdown after {processed} entitlements")
+                return
+            if processed % SWEEP_CHECKPOINT_ROWS == 0 or time.monotonic() - saved_at >= SWEEP_CHECKPOINT_INTERVAL:
+                await save_checkpoint()
+                saved_at = time.monotonic()
+            await process_due_entitlement(context, entitlement, now,
+                                          entitlement[0] in auto_renew and not entitlement[5])
+            after = [entitlement[4], entitlement[0], entitlement[2]]
+            processed += 1
+        await storage.set_job_checkpoint('check_subscriptions', None)
+        wake_outbox(context)
     except Exception as e:
         logger.error(f"Error in check_subscriptions: {e}")
-        if 'conn' in locals():
-            conn.close()
         await context.bot.send_message(
             chat_id=ADMIN_ID,
             text=f"⚠️ Ошибка в check_subscriptions: {e}",
@@ -1091,6 +1731,546 @@ async def check_subscriptions(context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
 
+async def charge_renewal(context: ContextTypes.DEFAULT_TYPE, renewal) -> str:
+    """Одно списание по сохраненному способу оплаты; возвращает статус платежа или error,
+    если ЮKassa не ответила.
+
+    Ключ идемпотентности зависит от окончания доступа и числа отказов. Сбой связи отказом не
+    считается: списание могло пройти, и повтор с тем же ключом вернет тот же платеж, а не
+    спишет оплату второй раз. Новый платеж создается только после отказа ЮKassa."""
+    user_id, channel_id, plan_id, subscription_end, method_id, failures, pending_payment_id = renewal
+    plan = get_plan(plan_id)
+    if not plan or plan.channel_id != channel_id:
+        plan = get_default_plan(channel_id)
+    # Неиспользованная скидка по промокоду действует и на автопродление, как в create_payment
+    price, promo_code = promo.price(user_id, plan)
+    metadata = {"user_id": str(user_id), "plan_id": plan.plan_id, "renewal": "1"}
+    if promo_code:
+        metadata["promo"] = promo_code
+    try:
+        if pending_payment_id:
+            payment = await yookassa_breaker.call(asyncio.to_thread, yookassa_api().Payment.find_one,
+                                                  pending_payment_id)
+        else:
+            payment = await yookassa_breaker.call(asyncio.to_thread, yookassa_api().Payment.create, {
+                "amount": {
+                    "value": f"{price:.2f}",
+                    "currency": "RUB"
+                },
+                "capture": True,
+                "payment_method_id": method_id,
+                "description": f"Автопродление подписки на {get_channel(plan.channel_id).title}",
+                "metadata": metadata
+            }, f"renew-{user_id}-{channel_id}-{subscription_end.replace(' ', 'T')}-{failures}")
+            # Статус succeeded выставляет только update_subscription вместе с продлением
+            await storage.add_payment(payment.id, user_id, price, plan.plan_id)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error(f"Renewal charge failed for user {user_id} in channel {channel_id}: {e}")
+        status, payment = 'error', None
+    else:
+        status = payment.status
+
+    if status == 'succeeded':
+        # Сумму и скидку берем из самого платежа: отложенный платеж мог быть создан по другой цене
+        amount = float(payment.amount.value)
+        promo_code = payment.metadata.get('promo')
+        await storage.update_subscription(user_id, payment.id, amount, plan.plan_id,
+                                          payment_outbox(user_id, plan, payment.id, amount, 'subscription_renewed'),
+                                          promo_code)
+        await sync_user_index(user_id)
+        if promo_code:
+            promo.drop_user_code(user_id, promo_code)
+        logger.info(f"Subscription of user {user_id} in channel {channel_id} renewed by payment {payment.id}")
+    elif status not in ('pending', 'error'):
+        await storage.set_payment_status(payment.id, status)
+    disabled = await storage.record_renewal_attempt(user_id, status, payment and payment.id, RENEW_MAX_FAILURES)
+    if disabled:
+        logger.info(f"Auto-renewal disabled for user {user_id} after {RENEW_MAX_FAILURES} failed charges")
+        await storage.enqueue_outbox([(user_id, 'auto_renew_failed',
+                                       {'channel_id': channel_id, 'plan_id': plan.plan_id},
+                                       f"auto_renew_failed:{user_id}:{channel_id}:{subscription_end}")])
+    return status
+
+async def renew_subscriptions(context: ContextTypes.DEFAULT_TYPE):
+    """Списывает оплату по сохраненным способам за RENEW_AHEAD секунд до окончания доступа.
+
+    Каждая попытка отмечается в payment_methods, поэтому прерванный проход продолжается
+    следующим запуском без контрольной точки, а доступ без ответа ЮKassa повторяется
+    через RENEW_RETRY_INTERVAL."""
+    started = time.time()
+    cutoff = (datetime.now(MOSCOW_TZ) + timedelta(seconds=RENEW_AHEAD)).strftime('%Y-%m-%d %H:%M:%S')
+    counts = {}
+    try:
+        while not shutting_down():
+            renewals = await storage.get_due_renewals(cutoff, started - RENEW_RETRY_INTERVAL, RENEW_BATCH_SIZE)
+            if not renewals:
+                break
+            for status in await asyncio.gather(*(charge_renewal(context, renewal) for renewal in renewals)):
+                counts[status] = counts.get(status, 0) + 1
+            wake_outbox(context)
+            await asyncio.sleep(RENEW_BATCH_INTERVAL)
+    except CircuitOpenError:
+        logger.warning("YooKassa unavailable, renewals postponed")
+    except Exception as e:
+        logger.error(f"Error in renew_subscriptions: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"⚠️ Ошибка в renew_subscriptions: {e}",
+            parse_mode=ParseMode.HTML
+        )
+        if FRIEND_ID:
+            await context.bot.send_message(
+                chat_id=FRIEND_ID,
+                text=f"⚠️ Ошибка в renew_subscriptions: {e}",
+                parse_mode=ParseMode.HTML
+            )
+    if counts:
+        logger.info(f"Renewals: {counts}")
+
+async def snapshot_events(context: ContextTypes.DEFAULT_TYPE):
+    """Сворачивает события журнала, еще не учтенные снимками, в event_snapshots.
+
+    Номер последнего учтенного события хранится в самих снимках, поэтому прерванный проход
+    продолжается со следующей пачки без контрольной точки."""
+    folded = 0
+    try:
+        position = await storage.get_snapshot_position()
+        while not shutting_down():
+            events = await storage.get_events(position, EVENT_SNAPSHOT_BATCH)
+            if not events:
+                break
+            snapshots = await storage.get_event_snapshots({(event[1], event[2]) for event in events})
+            states = event_log.fold(snapshots, events)
+            position = events[-1][0]
+            touched = {(event[1], event[2]) for event in events}
+            await storage.save_event_snapshots([(user_id, channel_id, state, position)
+                                                for (user_id, channel_id), state in states.items()
+                                                if (user_id, channel_id) in touched])
+            folded += len(events)
+    except Exception as e:
+        logger.error(f"Error in snapshot_events: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"⚠️ Ошибка в snapshot_events: {e}",
+            parse_mode=ParseMode.HTML
+        )
+        if FRIEND_ID:
+            await context.bot.send_message(
+                chat_id=FRIEND_ID,
+                text=f"⚠️ Ошибка в snapshot_events: {e}",
+                parse_mode=ParseMode.HTML
+            )
+    if folded:
+        logger.info(f"Folded {folded} events into snapshots")
+
+async def make_backup() -> tuple:
+    """Снимает, проверяет и ротирует копию базы; одновременно — только одна копия в процессе."""
+    async with _backup_lock:
+        return await storage.backup(BACKUP_DIR, BACKUP_KEEP)
+
+async def backup_database(context: ContextTypes.DEFAULT_TYPE):
+    """Плановая резервная копия базы SQLite."""
+    try:
+        await make_backup()
+    except Exception as e:
+        logger.error(f"Error in backup_database: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"⚠️ Ошибка в backup_database: {e}",
+            parse_mode=ParseMode.HTML
+        )
+        if FRIEND_ID:
+            await context.bot.send_message(
+                chat_id=FRIEND_ID,
+                text=f"⚠️ Ошибка в backup_database: {e}",
+                parse_mode=ParseMode.HTML
+            )
+
+async def maintain_storage(context: ContextTypes.DEFAULT_TYPE):
+    """Удаляет устаревшие неоплаченные платежи и доставленные сообщения, затем сжимает базу.
+
+    Каждая пачка — отдельная короткая транзакция, поэтому прерванный проход просто
+    продолжается на следующие сутки."""
+    purged = {}
+    try:
+        if RETENTION_DAYS:
+            before = (datetime.utcnow() - timedelta(days=RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+            for name, purge in (('payments', storage.purge_payments), ('outbox', storage.purge_outbox)):
+                while not shutting_down():
+                    deleted = await purge(before, RETENTION_BATCH_SIZE)
+                    count = sum(deleted.values()) if isinstance(deleted, dict) else deleted
+                    purged[name] = purged.get(name, 0) + count
+                    if count < RETENTION_BATCH_SIZE:
+                        break
+                    await asyncio.sleep(RETENTION_BATCH_INTERVAL)
+        if shutting_down():
+            return
+        result = await storage.compact(VACUUM_FREE_RATIO)
+        logger.info(f"Storage maintenance: purged {purged}, size {result['size_before'] // 1024} KB -> "
+                    f"{result['size_after'] // 1024} KB, vacuum: {result['vacuumed']}, "
+                    f"WAL truncated: {result['wal_truncated']}")
+    except Exception as e:
+        logger.error(f"Error in maintain_storage: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"⚠️ Ошибка в maintain_storage: {e}",
+            parse_mode=ParseMode.HTML
+        )
+        if FRIEND_ID:
+            await context.bot.send_message(
+                chat_id=FRIEND_ID,
+                text=f"⚠️ Ошибка в maintain_storage: {e}",
+                parse_mode=ParseMode.HTML
+            )
+
+# --- Outbox: доставка сообщений пользователям ---
+
+async def render_payment_confirmed(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    channel = get_channel(payload['channel_id']) or get_default_channel()
+    # Оплату мог зачесть другой процесс: его запись индекс увидит только при следующем обновлении
+    sub_type, days_left, end_date = await get_subscription_status(chat_id, channel.channel_id, fresh=True)
+    if not end_date:
+        return None
+    invite_link = await generate_invite_link(context, chat_id, channel.channel_id)
+    if not invite_link:
+        raise RuntimeError(f"Failed to generate invite link for user {chat_id}")
+    end_date = end_date.replace(tzinfo=MOSCOW_TZ)
+    method = await storage.get_payment_method(chat_id) if AUTO_RENEW else None
+    return (
+        f"✅ <b>Оплата подтверждена!</b>\n\n"
+        f"🔓 Ваша подписка продлена до {end_date.strftime('%d.%m.%Y')}\n"
+        f"🔗 Ссылка в группу {channel.title}: {invite_link}\n\n"
+        f"Спасибо за доверие! ❤️" + (render('auto_renew_note') if method and method[2] else ""),
+        InlineKeyboardMarkup([[InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)]])
+    )
+
+async def render_new_payment(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    plan = get_plan(payload['plan_id']) or get_default_plan()
+    channel = get_channel(plan.channel_id)
+    username = (await context.bot.get_chat(payload['user_id'])).username
+    return (
+        f"💳 <b>Новый платеж</b>\n"
+        f"👤 Пользователь: {payload['user_id']} (@{username or 'без имени'})\n"
+        f"📦 Тариф: {channel.title}, {plan.title}\n"
+        f"💰 Сумма: {payload.get('amount', plan.price)} RUB\n"
+        f"🆔 ID платежа: {payload['payment_id']}",
+        None
+    )
+
+async def render_member_removed(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    channel = get_channel(payload['channel_id'])
+    title = channel.title if channel else payload['channel_id']
+    return (
+        f"✅ Пользователь {payload['user_id']} (@{payload['username'] or 'без имени'}) удалён из группы "
+        f"{title} из-за истёкшей подписки",
+        None
+    )
+
+async def render_subscription_notice(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    """Напоминание (есть days_left) или уведомление об исключении со ссылкой на оплату."""
+    channel = get_channel(payload['channel_id'])
+    plan = get_plan(payload['plan_id']) or get_default_plan(payload['channel_id'])
+    payment_link, _ = await create_payment(chat_id, context.bot.username, plan.plan_id)
+    # Цена та же, что в ссылке create_payment: со скидкой пользователя, если она есть
+    price = price_text(plan, promo.price(chat_id, plan)[0])
+    if 'days_left' in payload:
+        text = render('reminder', days_left=payload['days_left'], title=channel.title, price=price)
+    else:
+        text = render('expired_removed', title=channel.title, price=price)
+    # Пока ЮKassa недоступна, уведомление уходит вовремя, а ссылку пользователь получит по кнопке повтора
+    return text + payment_unavailable(payment_link), InlineKeyboardMarkup([
+        payment_row('btn_extend', payment_link, plan.plan_id)])
+
+async def render_subscription_renewed(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    channel = get_channel(payload['channel_id']) or get_default_channel()
+    plan = get_plan(payload['plan_id']) or get_default_plan(channel.channel_id)
+    sub_type, days_left, end_date = await get_subscription_status(chat_id, channel.channel_id, fresh=True)
+    if not end_date:
+        return None
+    return render('auto_renewed', title=channel.title, price=price_text(plan, payload.get('amount')),
+                  end_date=end_date.strftime('%d.%m.%Y')), None
+
+async def render_auto_renew_failed(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    channel = get_channel(payload['channel_id']) or get_default_channel()
+    plan = get_plan(payload['plan_id']) or get_default_plan(channel.channel_id)
+    payment_link, _ = await create_payment(chat_id, context.bot.username, plan.plan_id)
+    text = render('auto_renew_failed', title=channel.title, price=price_text(plan, promo.price(chat_id, plan)[0]))
+    return text + payment_unavailable(payment_link), InlineKeyboardMarkup([
+        payment_row('btn_extend', payment_link, plan.plan_id)])
+
+async def render_referral_credited(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    await sync_user_index(chat_id)
+    sub_type, days_left, end_date = await get_subscription_status(chat_id, fresh=True)
+    if not end_date:
+        return None
+    return render('referral_credited', days=payload['days'], end_date=end_date.strftime('%d.%m.%Y')), None
+
+async def render_access_granted(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    channel = get_channel(payload['channel_id']) or get_default_channel()
+    sub_type, days_left, end_date = await get_subscription_status(chat_id, channel.channel_id, fresh=True)
+    if not end_date:
+        return None
+    invite_link = await generate_invite_link(context, chat_id, channel.channel_id)
+    if not invite_link:
+        raise RuntimeError(f"Failed to generate invite link for user {chat_id}")
+    return (render('access_granted', title=channel.title, end_date=end_date.strftime('%d.%m.%Y'),
+                   invite_link=invite_link),
+            InlineKeyboardMarkup([[InlineKeyboardButton("🔐 Перейти в группу", url=invite_link)]]))
+
+async def render_access_revoked(context: ContextTypes.DEFAULT_TYPE, chat_id: int, payload: dict):
+    """Исключает из канала и сообщает об отзыве; если доступ уже вернули, ничего не делает."""
+    channel = get_channel(payload['channel_id']) or get_default_channel()
+    entitlement = await storage.get_entitlement(chat_id, channel.channel_id)
+    if entitlement and entitlement[3]:
+        return None
+    try:
+        await context.bot.ban_chat_member(chat_id=channel.channel_id, user_id=chat_id)
+        await storage.record_member_status(chat_id, channel.channel_id, 'kicked', 'probe')
+    except TelegramError as e:
+        if "participant_id_invalid" not in str(e).lower():
+            raise
+    return render('access_revoked', title=channel.title), None
+
+# kind -> функция (context, chat_id, payload), возвращающая (текст, клавиатура) или None, если
+# сообщение больше не нужно. Исключение — повтор с задержкой
+OUTBOX_RENDERERS = {
+    'payment_confirmed': render_payment_confirmed,
+    'new_payment': render_new_payment,
+    'subscription_reminder': render_subscription_notice,
+    'subscription_expired': render_subscription_notice,
+    'subscription_renewed': render_subscription_renewed,
+    'auto_renew_failed': render_auto_renew_failed,
+    'referral_credited': render_referral_credited,
+    'access_granted': render_access_granted,
+    'access_revoked': render_access_revoked,
+    'member_removed': render_member_removed,
+}
+
+async def deliver_outbox_message(context: ContextTypes.DEFAULT_TYPE, outbox_id: int, chat_id: int,
+                                 kind: str, payload: dict, attempts: int) -> str:
+    """Отправляет одно сообщение outbox. Возвращает 'sent', 'retry', 'blocked' или 'dead'."""
+    try:
+        message = await OUTBOX_RENDERERS[kind](context, chat_id, payload)
+        if message:
+            text, reply_markup = message
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+                                           reply_markup=reply_markup)
+        await storage.complete_outbox(outbox_id)
+        return 'sent'
+    except Exception as e:
+        error = str(e)
+        if isinstance(e, telegram.error.Forbidden) or "chat not found" in error.lower():
+            # Пользователь заблокировал бота или не начинал диалог — повторять бессмысленно
+            logger.info(f"Skipping outbox message {outbox_id} ({kind}) for {chat_id}: {error}")
+            await storage.fail_outbox(outbox_id, error)
+            return 'blocked'
+        if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+            logger.error(f"Outbox message {outbox_id} ({kind}) for {chat_id} moved to dead letters: {error}")
+            await storage.fail_outbox(outbox_id, error)
+            return 'dead'
+        if isinstance(e, RetryAfter):
+            delay = e.retry_after
+        else:
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** attempts)
+        logger.warning(f"Outbox message {outbox_id} ({kind}) for {chat_id} failed, retry in {delay}s: {error}")
+        await storage.fail_outbox(outbox_id, error, time.time() + delay)
+        return 'retry'
+
+async def dispatch_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Доставляет сообщения из outbox пачками: разным чатам параллельно, одному чату по порядку.
+
+    Сообщения забираются с арендой, поэтому несколько процессов не отправят одно и то же,
+    а сообщение, чья отправка прервалась вместе с процессом, вернется в очередь."""
+    try:
+        while not shutting_down():
+            rows = await storage.claim_outbox(OUTBOX_BATCH_SIZE, OUTBOX_LEASE)
+            if not rows:
+                return
+            by_chat = {}
+            for row in rows:
+                by_chat.setdefault(row[1], []).append(row)
+
+            async def deliver_chat(chat_rows):
+                return [await deliver_outbox_message(context, *row) for row in chat_rows]
+
+            results = [result for chat_results in await asyncio.gather(*(deliver_chat(r) for r in by_chat.values()))
+                       for result in chat_results]
+            dead = results.count('dead')
+            if dead:
+                await context.bot.send_message(
+                    chat_id=ADMIN_ID,
+                    text=f"⚠️ {dead} сообщений пользователям не доставлено после {OUTBOX_MAX_ATTEMPTS} попыток (outbox, status = 'dead')",
+                    parse_mode=ParseMode.HTML
+                )
+                if FRIEND_ID:
+                    await context.bot.send_message(
+                        chat_id=FRIEND_ID,
+                        text=f"⚠️ {dead} сообщений пользователям не доставлено после {OUTBOX_MAX_ATTEMPTS} попыток (outbox, status = 'dead')",
+                        parse_mode=ParseMode.HTML
+                    )
+            if len(rows) < OUTBOX_BATCH_SIZE:
+                return
+            await asyncio.sleep(OUTBOX_BATCH_INTERVAL)
+    except Exception as e:
+        logger.error(f"Error in dispatch_outbox: {e}")
+
+def wake_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Запускает доставку сразу, не дожидаясь очередного опроса outbox."""
+    context.job_queue.run_once(dispatch_outbox, 0)
+
+def member_status(member) -> str:
+    """Статус участника; restricted без членства в канале считается вышедшим."""
+    if member.status == 'restricted' and not getattr(member, 'is_member', True):
+        return 'left'
+    return member.status
+
+async def probe_member(context: ContextTypes.DEFAULT_TYPE, channel_id: int, user_id: int):
+    """Статус пользователя в канале через get_chat_member или None при ошибке."""
+    for attempt in range(2):
+        try:
+            member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+            return member_status(member)
+        except RetryAfter as e:
+            if attempt:
+                raise
+            await asyncio.sleep(e.retry_after)
+        except TelegramError as e:
+            error = str(e).lower()
+            if "user not found" in error or "participant_id_invalid" in error:
+                return 'left'
+            logger.error(f"Error probing user {user_id} in channel {channel_id}: {e}")
+            return None
+
+async def reconcile_channel(context: ContextTypes.DEFAULT_TYPE, channel, full: bool, enforce: bool) -> str:
+    """Проверяет участников одного канала и возвращает раздел отчета (None — прервано остановкой)."""
+    now = datetime.now(MOSCOW_TZ)
+    expired_after = (now - timedelta(days=RECONCILE_EXPIRED_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    # Проверяем только тех, чей доступ менялся после последнего известного статуса в канале
+    candidates = await storage.get_reconcile_candidates(channel.channel_id, expired_after, full)
+    errors = 0
+    for i in range(0, len(candidates), RECONCILE_BATCH_SIZE):
+        if shutting_down():
+            # Проверенные статусы уже записаны, после перезапуска сверка продолжит с остальных
+            return None
+        if i:
+            await asyncio.sleep(RECONCILE_BATCH_INTERVAL)
+        batch = candidates[i:i + RECONCILE_BATCH_SIZE]
+        statuses = await asyncio.gather(*(probe_member(context, channel.channel_id, user_id) for user_id in batch))
+        for user_id, status in zip(batch, statuses):
+            if status is None:
+                errors += 1
+            else:
+                await storage.record_member_status(user_id, channel.channel_id, status, 'probe')
+
+    without_access, not_in_channel = await storage.get_membership_diff(
+        channel.channel_id, now.strftime('%Y-%m-%d %H:%M:%S'))
+
+    removed = 0
+    if enforce:
+        for i, (user_id, username, status) in enumerate(without_access):
+            if i and i % RECONCILE_BATCH_SIZE == 0:
+                await asyncio.sleep(RECONCILE_BATCH_INTERVAL)
+            try:
+                await context.bot.ban_chat_member(chat_id=channel.channel_id, user_id=user_id)
+                await storage.record_member_status(user_id, channel.channel_id, 'kicked', 'probe')
+                removed += 1
+                logger.info(f"User {user_id} (@{username or 'без имени'}) removed from {channel.channel_id} by reconciliation")
+            except TelegramError as e:
+                logger.error(f"Error removing user {user_id} from {channel.channel_id}: {e}")
+
+    def user_lines(rows):
+        lines = [f"👤 {user_id} (@{username or 'без имени'})" for user_id, username, status in rows[:RECONCILE_REPORT_LIMIT]]
+        if len(rows) > RECONCILE_REPORT_LIMIT:
+            lines.append(f"… и ещё {len(rows) - RECONCILE_REPORT_LIMIT}")
+        return "\n".join(lines)
+
+    text = (
+        f"🔍 <b>Сверка: {channel.title}</b>\n"
+        f"Проверено через Telegram: {len(candidates)} (ошибок: {errors})\n\n"
+        f"🚫 В канале без доступа: {len(without_access)}\n"
+    )
+    if without_access:
+        text += user_lines(without_access) + "\n"
+    if enforce:
+        text += f"Исключено: {removed}\n"
+    text += f"\n⚠️ С доступом, но не в канале: {len(not_in_channel)}\n"
+    if not_in_channel:
+        text += user_lines(not_in_channel) + "\n"
+    return text
+
+async def reconcile_members(context: ContextTypes.DEFAULT_TYPE, full: bool = False, enforce: bool = None,
+                            manual: bool = False):
+    """Сверяет активных и недавно истекших пользователей с участниками каналов и шлет отчет админам.
+
+    Статусы берутся из событий chat_member, а для пользователей, чей доступ изменился
+    после последнего известного статуса, — из get_chat_member. enforce исключает из канала
+    участников без доступа (по умолчанию RECONCILE_ENFORCE). Ручной запуск (manual) не трогает
+    контрольную точку плановой задачи: он может идти одновременно с ней, в том числе в другом
+    процессе, и после остановки бота не продолжается."""
+    if enforce is None:
+        enforce = RECONCILE_ENFORCE
+    try:
+        # Каналы, сверенные до остановки бота, при продолжении пропускаются
+        checkpoint = {} if manual else await storage.get_job_checkpoint('reconcile_members') or {}
+        channels_done = checkpoint.get('channels_done', [])
+        sections = checkpoint.get('sections', [])
+        for channel in get_channels():
+            if channel.channel_id in channels_done:
+                continue
+            section = await reconcile_channel(context, channel, full, enforce)
+            if section is None:
+                if manual:
+                    logger.info("Manual reconcile interrupted by shutdown")
+                    return
+                await storage.set_job_checkpoint('reconcile_members', {
+                    'channels_done': channels_done, 'sections': sections})
+                logger.info("reconcile_members interrupted by shutdown, progress saved")
+                return
+            channels_done.append(channel.channel_id)
+            sections.append(section)
+        if not manual:
+            await storage.set_job_checkpoint('reconcile_members', None)
+        for section in sections:
+            await context.bot.send_message(chat_id=ADMIN_ID, text=section, parse_mode=ParseMode.HTML)
+            if FRIEND_ID:
+                await context.bot.send_message(chat_id=FRIEND_ID, text=section, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Error in reconcile_members: {e}")
+        await context.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"⚠️ Ошибка в reconcile_members: {e}",
+            parse_mode=ParseMode.HTML
+        )
+        if FRIEND_ID:
+            await context.bot.send_message(
+                chat_id=FRIEND_ID,
+                text=f"⚠️ Ошибка в reconcile_members: {e}",
+                parse_mode=ParseMode.HTML
+            )
+
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reconcile [full] [enforce] — ручной запуск сверки для администраторов."""
+    if update.effective_user.id not in [ADMIN_ID, FRIEND_ID]:
+        await update.message.reply_text("⚠️ Доступ запрещён!", parse_mode=ParseMode.HTML)
+        return
+    args = [arg.lower() for arg in context.args or []]
+    await start_manual_reconcile(update.message, context, full='full' in args,
+                                 enforce=True if 'enforce' in args else None)
+
+async def start_manual_reconcile(message, context: ContextTypes.DEFAULT_TYPE, full: bool = False,
+                                 enforce: bool = None):
+    """Запускает сверку фоновой задачей: обработчик не ждет ее окончания и не держит очередь
+    обновлений админа."""
+    global _manual_reconcile
+    if _manual_reconcile and not _manual_reconcile.done():
+        await message.reply_text("⏳ Сверка уже идет, отчет придет отдельным сообщением.")
+        return
+    await message.reply_text("🔍 Сверка запущена, отчет придет отдельным сообщением.")
+    _manual_reconcile = context.application.create_task(
+        reconcile_members(context, full=full, enforce=enforce, manual=True))
+
 async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         chat_member_update = update.chat_member
@@ -1102,52 +2282,42 @@ async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAUL
         new_status = chat_member_update.new_chat_member.status
         old_status = chat_member_update.old_chat_member.status
 
+        # История событий для сверки базы с участниками канала
+        if get_channel(chat.id):
+            member = chat_member_update.new_chat_member
+            await storage.record_member_status(member.user.id, chat.id, member_status(member), 'event')
+            hot_state.drop_invite_link(member.user.id, chat.id)
+            # Вход по приглашению, созданному для другого пользователя, связывает аккаунты
+            invite = chat_member_update.invite_link
+            owner_id = trial_guard.invite_owner(invite.name) if invite else None
+            if owner_id and owner_id != member.user.id:
+                logger.warning(f"User {member.user.id} joined channel {chat.id} with invite link of user {owner_id}")
+                key = trial_guard.account_key(member.user.id)
+                await storage.add_trial_signal(key, owner_id, 'invite')
+                trial_guard.add(key)
+
         # Проверяем, что пользователь только что вступил в канал
         if new_status in ['member', 'administrator', 'creator'] and old_status in ['left', 'kicked']:
-            # Проверяем, что событие произошло в нужном канале
-            if str(chat.id) != str(CHANNEL_ID):
-                logger.info(f"User {user.id} joined chat {chat.id}, but it's not the target channel {CHANNEL_ID}")
+            # Проверяем, что событие произошло в одном из платных каналов
+            channel = get_channel(chat.id)
+            if not channel:
+                logger.info(f"User {user.id} joined chat {chat.id}, but it's not one of the paid channels")
                 return
 
-            # Проверяем статус подписки
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-            SELECT subscription_end, trial_used, join_date, active FROM users WHERE user_id = ?
-            ''', (user.id,))
-            result = cursor.fetchone()
-            conn.close()
-
-            sub_type = 'none'
-            days_left = 0
-            end_date = None
-            active = False
-            now = datetime.now(MOSCOW_TZ)
-
-            if result:
-                subscription_end, trial_used, join_date, active = result
-                if subscription_end:
-                    sub_end = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                    if sub_end > now and active:
-                        sub_type = 'paid'
-                        days_left = max(0, ceil((sub_end - now).total_seconds() / (24 * 3600)))
-                        end_date = subscription_end
-                if not trial_used:
-                    join = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ)
-                    trial_end = join + timedelta(days=TRIAL_DAYS)
-                    days_left = max(0, ceil((trial_end - now).total_seconds() / (24 * 3600)))
-                    if days_left >= 0:
-                        sub_type = 'trial'
-                        end_date = trial_end.strftime('%Y-%m-%d %H:%M:%S')
-                        active = True
+            # Проверяем статус подписки; перед баном — по базе, а не по индексу: доступ
+            # могли только что продлить в другом процессе
+            sub_type, days_left, end_date = await get_subscription_status(user.id, channel.channel_id)
+            if sub_type not in ['paid', 'trial']:
+                sub_type, days_left, end_date = await get_subscription_status(user.id, channel.channel_id, fresh=True)
 
             if sub_type not in ['paid', 'trial']:
                 logger.info(f"User {user.id} (@{user.username or 'без имени'}) attempted to join without active subscription")
                 try:
                     await context.bot.ban_chat_member(chat_id=chat.id, user_id=user.id)
+                    await storage.record_member_status(user.id, chat.id, 'kicked', 'event')
                     await context.bot.send_message(
                         chat_id=user.id,
-                        text="❌ У вас нет активной подписки. Пожалуйста, оформите подписку с помощью /start.",
+                        text=render('join_no_subscription', user.language_code),
                         parse_mode=ParseMode.HTML
                     )
                 except TelegramError as e:
@@ -1155,17 +2325,12 @@ async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAUL
                 return
 
             # Отправляем приветственное сообщение
-            welcome_text = (
-                "Добро пожаловать в Happy Face Club! 🌿\n\n"
-                "Рада знать, что ты хочешь позаботиться о своём теле и душе✨\n"
-                "Ты присоединилась только что, и поэтому пока не видишь контента — это нормально!\n"
-                "Контент в клубе виден только с момента твоего вступления, всё, что было раньше — остаётся закрытым.\n\n"
-                "Но не переживай: каждый день мы добавляем новые практики, и ты скоро всё увидишь и почувствуешь!\n\n"
-                f"Тип подписки: {'Платная' if sub_type == 'paid' else 'Пробный период'}\n"
-                f"Осталось дней: {days_left}\n"
-                f"Завершается: {datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S').replace(tzinfo=MOSCOW_TZ).strftime('%d.%m.%Y')}\n\n"
-                f"Если возникнут вопросы, ты можешь задать их в нашем чате: {CHAT_LINK}\n\n"
-                "С любовью ДАША HAPPY FACE ❤️"
+            welcome_text = render(
+                'join_welcome', user.language_code,
+                sub_type=render('join_sub_type_paid' if sub_type == 'paid' else 'join_sub_type_trial', user.language_code),
+                days_left=days_left,
+                end_date=end_date.strftime('%d.%m.%Y'),
+                chat_link=channel.chat_link or CHAT_LINK
             )
             try:
                 await context.bot.send_message(
@@ -1174,7 +2339,7 @@ async def handle_chat_member_update(update: Update, context: ContextTypes.DEFAUL
                     parse_mode=ParseMode.HTML,
                     disable_web_page_preview=True
                 )
-                logger.info(f"Sent welcome message to user {user.id} (@{user.username or 'без имени'}) upon joining channel {CHANNEL_ID}")
+                logger.info(f"Sent welcome message to user {user.id} (@{user.username or 'без имени'}) upon joining channel {channel.channel_id}")
             except TelegramError as e:
                 logger.error(f"Error sending welcome message to user {user.id}: {e}")
                 await context.bot.send_message(
@@ -1287,47 +2452,425 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Failed to send conflict notification: {e}")
         raise SystemExit("Stopping bot due to Conflict error")
 
-def main():
+async def reload_messages(context: ContextTypes.DEFAULT_TYPE):
+    # Горячая перезагрузка messages.json в каждом процессе
+    reload_if_changed()
+
+async def renew_leader_lease(context: ContextTypes.DEFAULT_TYPE):
     try:
-        application = Application.builder().token(TOKEN).build()
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("check", check_access))
-        application.add_handler(CommandHandler("rejoin", rejoin))
-        application.add_handler(CommandHandler("check_payment", check_payment))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("admin", admin_menu))
-        application.add_handler(CommandHandler("remove_inactive", remove_inactive))
-        application.add_handler(CallbackQueryHandler(button_callback))
-        application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
-        application.add_error_handler(error_handler)
-
-        application.job_queue.run_repeating(check_subscriptions, interval=86400, first=10)
-
-        logger.info("Bot started and ready to accept payments")
-        # Настройка Webhook
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=8443,
-            url_path="/webhook",
-            webhook_url="https://HappyFaceBot.pythonanywhere.com/webhook"
-        )
+        await storage.acquire_lease(LEADER_LEASE, INSTANCE_ID, LEADER_LEASE_TTL)
     except Exception as e:
-        logger.error(f"Error starting bot: {e}")
-        try:
-            bot = telegram.Bot(token=TOKEN)
-            bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"⚠️ Ошибка запуска бота: {str(e)}",
-                parse_mode=ParseMode.HTML
-            )
+        logger.error(f"Error renewing leader lease: {e}")
+
+def leader_only(callback, min_interval: float):
+    """Плановая задача выполняется только у держателя аренды и не чаще min_interval секунд.
+
+    Прерванная задача (есть сохраненный прогресс) запускается сразу, без ожидания
+    интервала, и не считается выполненной, пока не дойдет до конца."""
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        if not await storage.acquire_lease(LEADER_LEASE, INSTANCE_ID, LEADER_LEASE_TTL):
+            return
+        if shutting_down():
+            return
+        interrupted = await storage.get_job_checkpoint(callback.__name__) is not None
+        last_run = await storage.get_job_last_run(callback.__name__)
+        if not interrupted and last_run and time.time() - last_run < min_interval:
+            return
+        await callback(context)
+        if await storage.get_job_checkpoint(callback.__name__) is None:
+            await storage.set_job_last_run(callback.__name__, time.time())
+    job.__name__ = callback.__name__
+    return job
+
+_shutting_down = False
+
+def shutting_down() -> bool:
+    """True после сигнала остановки: длинные циклы сохраняют прогресс и выходят."""
+    return _shutting_down
+
+def cancel_in_flight(application: Application):
+    cancelled = application.update_processor.cancel_running()
+    if cancelled:
+        logger.warning(f"Shutdown timeout: cancelled {cancelled} unfinished update handlers")
+
+def begin_shutdown(application: Application):
+    """Начинает остановку: задачи перестают брать новую работу, а обработчикам обновлений
+    дается SHUTDOWN_TIMEOUT секунд. Вызывается в цикле событий приложения."""
+    global _shutting_down
+    if _shutting_down:
+        return
+    _shutting_down = True
+    logger.info(f"Shutdown requested, draining in-flight work for up to {SHUTDOWN_TIMEOUT:g}s")
+    asyncio.get_running_loop().call_later(SHUTDOWN_TIMEOUT, cancel_in_flight, application)
+
+_circuit_alerts = {}
+
+async def notify_circuit_change(bot: telegram.Bot, breaker: CircuitBreaker, state: str):
+    """Одно уведомление админам на сбой сервиса и одно на его восстановление.
+
+    При частых переключениях о сбое сообщаем не чаще раза в CIRCUIT_ALERT_INTERVAL, а о
+    восстановлении — только если о сбое сообщили. Пока недоступен Bot API, уведомление о
+    сбое не уйдет, но придет сообщение о восстановлении с длительностью простоя."""
+    title = CIRCUIT_TITLES.get(breaker.name, breaker.name)
+    alert = _circuit_alerts.setdefault(breaker.name, {'sent_at': 0.0, 'pending': False})
+    if state == 'open':
+        if time.time() - alert['sent_at'] < CIRCUIT_ALERT_INTERVAL:
+            return
+        alert['sent_at'] = time.time()
+        alert['pending'] = True
+        text = (f"⚠️ {title} недоступен: {(breaker.last_error or '')[:200]}\n"
+                f"Запросы приостановлены, проверка восстановления каждые {breaker.reset_timeout:g} с.")
+    else:
+        if not alert['pending']:
+            return
+        alert['pending'] = False
+        downtime = int((time.time() - breaker.opened_since) / 60) if breaker.opened_since else 0
+        text = f"✅ {title} снова доступен (простой около {downtime} мин)."
+    try:
+        await bot.send_message(chat_id=ADMIN_ID, text=text)
+        if FRIEND_ID:
+            await bot.send_message(chat_id=FRIEND_ID, text=text)
+    except Exception as e:
+        logger.error(f"Failed to send circuit notification: {e}")
+
+async def load_hot_state():
+    """Загружает снимок ссылок и отбрасывает устаревшие по базе: платежи, которые уже не
+    в статусе pending, и приглашения пользователей, чей статус в канале менялся после снимка."""
+    snapshot = hot_state.read_snapshot(SNAPSHOT_FILE)
+    if not snapshot:
+        return
+    pending = await storage.get_pending_payment_ids([row[2] for row in snapshot['payment_links']])
+    changed = set(await storage.get_member_changes(snapshot['saved_at']))
+    hot_state.restore(
+        [row for row in snapshot['payment_links'] if row[2] in pending],
+        [row for row in snapshot['invite_links'] if (row[0], row[1]) not in changed]
+    )
+    logger.info(f"Hot state restored from {SNAPSHOT_FILE}: {hot_state.size()}")
+
+async def save_hot_state(context: ContextTypes.DEFAULT_TYPE = None):
+    if not hot_state.is_dirty():
+        return
+    try:
+        await asyncio.to_thread(hot_state.save_snapshot, SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"Error saving hot state snapshot: {e}")
+
+def changes_since() -> str:
+    """Граница следующей выборки изменений для индексов в памяти: сейчас минус
+    USER_INDEX_OVERLAP, по часам базы (UTC)."""
+    return (datetime.utcnow() - timedelta(seconds=USER_INDEX_OVERLAP)).strftime('%Y-%m-%d %H:%M:%S')
+
+async def notify_trial_abuse(bot: telegram.Bot, user, matches: list, denied: bool):
+    """Сообщает админам о новом аккаунте, похожем на уже получавший пробный период."""
+    reasons = "\n".join(
+        f"  • {TRIAL_SIGNAL_TITLES.get(kind, kind)} {user_id}" for key, user_id, kind in matches
+    )
+    text = (f"🕵️ Повторный пробный период {'не выдан' if denied else 'выдан'}: "
+            f"пользователь {user.id} (@{user.username or 'без имени'})\n{reasons}")
+    logger.warning(f"Repeat trial {'denied' if denied else 'flagged'} for user {user.id}: {matches}")
+    try:
+        await bot.send_message(chat_id=ADMIN_ID, text=text)
+        if FRIEND_ID:
+            await bot.send_message(chat_id=FRIEND_ID, text=text)
+    except TelegramError as e:
+        logger.error(f"Error sending repeat trial alert: {e}")
+
+async def rebuild_trial_guard(context: ContextTypes.DEFAULT_TYPE = None):
+    """Строит фильтр признаков повтора пробного периода из базы."""
+    global _trial_guard_since
+    since = changes_since()
+    try:
+        keys = await storage.get_trial_signal_keys()
+        await asyncio.to_thread(trial_guard.load, keys)
+    except Exception as e:
+        trial_guard.clear()
+        logger.error(f"Error building trial guard filter: {e}")
+        return
+    _trial_guard_since = since
+    logger.info(f"Trial guard filter built: {trial_guard.size()['keys']} keys")
+
+async def refresh_trial_guard(context: ContextTypes.DEFAULT_TYPE = None):
+    """Добавляет в фильтр признаки, записанные другими процессами."""
+    global _trial_guard_since
+    if not trial_guard.is_ready():
+        return
+    if trial_guard.needs_rebuild():
+        await rebuild_trial_guard()
+        return
+    since = changes_since()
+    try:
+        keys = await storage.get_trial_signal_keys(_trial_guard_since)
+    except Exception as e:
+        logger.error(f"Error refreshing trial guard filter: {e}")
+        return
+    for key in keys:
+        trial_guard.add(key)
+    _trial_guard_since = since
+
+async def load_promo(context: ContextTypes.DEFAULT_TYPE = None, discounts: bool = True):
+    """Загружает промокоды и, если discounts, неиспользованные скидки пользователей."""
+    try:
+        promo.load_codes(await storage.get_promo_codes())
+        if discounts:
+            promo.load_discounts(await storage.get_pending_discounts())
+    except Exception as e:
+        logger.error(f"Error loading promo codes: {e}")
+
+async def refresh_promo_codes(context: ContextTypes.DEFAULT_TYPE = None):
+    """Подтягивает коды, созданные в других процессах; скидки пользователей остаются."""
+    await load_promo(context, discounts=False)
+
+async def rebuild_user_index(context: ContextTypes.DEFAULT_TYPE = None):
+    """Строит индекс доступов из базы. Изменения, записанные во время построения,
+    подтягиваются сразу после него."""
+    global _user_index_since
+    started = time.perf_counter()
+    since = changes_since()
+    try:
+        rows = []
+        async for batch in storage.export_rows('entitlements', USER_INDEX_BATCH_SIZE):
+            rows.extend((row['user_id'], row['channel_id'], row['plan_id'], row['subscription_end'],
+                         row['is_trial'], row['active']) for row in batch)
+        await asyncio.to_thread(user_index.load, rows)
+        _user_index_since = since
+        await refresh_user_index()
+    except Exception as e:
+        user_index.clear()
+        logger.error(f"Error building user index: {e}")
+        return
+    size = user_index.size()
+    logger.info(f"User index built: {size['entries']} entitlements, {size['bytes'] // 1024} KB "
+                f"in {time.perf_counter() - started:.2f}s")
+
+async def refresh_user_index(context: ContextTypes.DEFAULT_TYPE = None):
+    """Переносит в индекс доступы, измененные другими процессами."""
+    global _user_index_since
+    if not user_index.is_ready():
+        return
+    since = changes_since()
+    try:
+        changes = await storage.get_entitlement_changes(_user_index_since)
+    except Exception as e:
+        logger.error(f"Error refreshing user index: {e}")
+        return
+    for row in changes:
+        user_index.put(*row)
+    _user_index_since = since
+
+async def on_startup(application: Application):
+    global _shutting_down, _backup_lock
+    _shutting_down = False
+    _backup_lock = asyncio.Lock()
+    await storage.init()
+    # Индекс прошлого запуска мог отстать от базы: до перестройки читаем из нее
+    user_index.clear()
+    trial_guard.clear()
+    # Скидки нужны до первого платежа: без них create_payment выставил бы полную цену
+    await load_promo()
+    # Без снимка бот просто стартует с пустым состоянием
+    try:
+        await load_hot_state()
+    except Exception as e:
+        logger.error(f"Error loading hot state snapshot: {e}")
+
+async def on_shutdown(application: Application):
+    await save_hot_state()
+    try:
+        await storage.release_lease(LEADER_LEASE, INSTANCE_ID)
+    except Exception as e:
+        logger.error(f"Error releasing leader lease: {e}")
+    await storage.close()
+
+def build_application(updater: bool = True, base_url: str = None,
+                      concurrent_updates: int = None) -> Application:
+    """Создает приложение с обработчиками и плановыми задачами.
+
+    updater=False — для рабочих процессов, получающих обновления от фронтового процесса.
+    base_url — адрес локального Bot API сервера (или заглушки в бенчмарках).
+    Обновления разных пользователей обрабатываются параллельно, не больше concurrent_updates
+    (по умолчанию SERVER.concurrent_updates) одновременно, одного пользователя — по порядку.
+    """
+    configure()
+    builder = (
+        Application.builder().token(TOKEN)
+        .base_url(base_url or SERVER.base_url)
+        .base_file_url(SERVER.base_file_url)
+        .local_mode(SERVER.local_mode)
+        .concurrent_updates(PerUserUpdateProcessor(concurrent_updates or SERVER.concurrent_updates))
+        # Пул как у HTTPXRequest, который собрал бы builder; getUpdates идет мимо предохранителя
+        .request(BreakerRequest(bot_api_breaker, connection_pool_size=256))
+        .post_init(on_startup).post_shutdown(on_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("check", check_access))
+    application.add_handler(CommandHandler("rejoin", rejoin))
+    application.add_handler(CommandHandler("check_payment", check_payment))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("plans", plans_menu))
+    application.add_handler(CommandHandler("autorenew", autorenew_command))
+    application.add_handler(CommandHandler("promo", promo_command))
+    application.add_handler(CommandHandler("referral", referral_command))
+    application.add_handler(CommandHandler("promo_add", promo_add_command))
+    application.add_handler(CommandHandler("promos", promos_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("backup", backup_command))
+    application.add_handler(CommandHandler(list(bulk_access.ACTIONS), bulk_command))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r'^/(grant|extend|revoke)(@\w+)?(\s|$)'), bulk_command))
+    application.add_handler(CommandHandler("admin", admin_menu))
+    application.add_handler(CommandHandler("remove_inactive", remove_inactive))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("reconcile", reconcile_command))
+    application.add_handler(CommandHandler("health", health_command))
+    application.add_handler(ChatMemberHandler(handle_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+    application.add_error_handler(error_handler)
+    for breaker in (yookassa_breaker, bot_api_breaker):
+        breaker.listeners[:] = [lambda breaker, old, new: application.create_task(
+            notify_circuit_change(application.bot, breaker, new))]
+
+    application.job_queue.run_repeating(renew_leader_lease, interval=LEADER_LEASE_TTL / 3, first=1)
+    application.job_queue.run_repeating(reload_messages, interval=60, first=60)
+    application.job_queue.run_repeating(save_hot_state, interval=SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL)
+    if USER_INDEX:
+        # Индекс строится в фоне: до готовности обработчики читают доступы из базы
+        application.job_queue.run_once(rebuild_user_index, 0)
+        application.job_queue.run_repeating(refresh_user_index, interval=USER_INDEX_REFRESH,
+                                            first=USER_INDEX_REFRESH)
+    if TRIAL_GUARD != 'off':
+        application.job_queue.run_once(rebuild_trial_guard, 0)
+        application.job_queue.run_repeating(refresh_trial_guard, interval=TRIAL_GUARD_REFRESH,
+                                            first=TRIAL_GUARD_REFRESH)
+    application.job_queue.run_repeating(refresh_promo_codes, interval=PROMO_REFRESH, first=PROMO_REFRESH)
+    # Доставка outbox во всех процессах: сообщения разбираются с арендой, без дублей
+    application.job_queue.run_repeating(dispatch_outbox, interval=OUTBOX_INTERVAL, first=OUTBOX_INTERVAL)
+    # Проверяем раз в час, а leader_only пропускает запуск, если проход был меньше суток назад
+    application.job_queue.run_repeating(
+        leader_only(check_subscriptions, SWEEP_INTERVAL - 3600), interval=3600, first=SWEEP_START_DELAY
+    )
+    application.job_queue.run_repeating(
+        leader_only(reconcile_members, SWEEP_INTERVAL - 3600), interval=3600, first=600
+    )
+    if BACKUP_INTERVAL and storage.name == 'sqlite':
+        application.job_queue.run_repeating(
+            leader_only(backup_database, BACKUP_INTERVAL * 3600 - 60), interval=BACKUP_INTERVAL * 3600,
+            first=SWEEP_START_DELAY
+        )
+    # Удаление устаревших записей и сжатие базы — раз в сутки в тихий час
+    application.job_queue.run_daily(
+        leader_only(maintain_storage, SWEEP_INTERVAL - 3600), time=day_time(MAINTENANCE_HOUR, tzinfo=MOSCOW_TZ)
+    )
+    application.job_queue.run_repeating(
+        leader_only(snapshot_events, EVENT_SNAPSHOT_INTERVAL - 60), interval=EVENT_SNAPSHOT_INTERVAL,
+        first=EVENT_SNAPSHOT_INTERVAL
+    )
+    if AUTO_RENEW:
+        application.job_queue.run_repeating(
+            leader_only(renew_subscriptions, RENEW_INTERVAL - 60), interval=RENEW_INTERVAL, first=SWEEP_START_DELAY
+        )
+    return application
+
+async def check_storage():
+    # Пул соединений привязан к циклу событий проверки, приложение откроет свой в on_startup
+    await storage.init()
+    try:
+        await storage.count_active_users()
+    finally:
+        await storage.close()
+
+async def check_yookassa():
+    await asyncio.to_thread(yookassa_api().Settings.get_account_settings)
+
+async def check_bot_api():
+    async with telegram.Bot(token=TOKEN, base_url=BOT_API_BASE_URL) as bot:
+        await bot.get_me()
+
+async def preflight() -> list:
+    """Параллельно проверяет базу, ключи ЮKassa и доступность Bot API.
+    Возвращает список (проверка, ошибка) для неудачных проверок."""
+    checks = {'database': check_storage(), 'yookassa': check_yookassa(), 'bot_api': check_bot_api()}
+    results = await asyncio.gather(
+        *(asyncio.wait_for(check, PREFLIGHT_TIMEOUT) for check in checks.values()),
+        return_exceptions=True
+    )
+    return [(name, result) for name, result in zip(checks, results) if isinstance(result, BaseException)]
+
+async def send_startup_alert(text: str):
+    """Уведомляет админов об ошибке запуска. Вызывается вне приложения, поэтому со своим Bot."""
+    try:
+        async with telegram.Bot(token=TOKEN, base_url=BOT_API_BASE_URL) as bot:
+            await bot.send_message(chat_id=ADMIN_ID, text=text)
             if FRIEND_ID:
-                bot.send_message(
-                    chat_id=FRIEND_ID,
-                    text=f"⚠️ Ошибка запуска бота: {str(e)}",
-                    parse_mode=ParseMode.HTML
+                await bot.send_message(chat_id=FRIEND_ID, text=text)
+    except Exception as send_error:
+        logger.error(f"Failed to send error message: {send_error}")
+
+def main():
+    """Запускает бота и перезапускает его с экспоненциальной задержкой после ошибок запуска."""
+    configure()
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        loop = None
+        try:
+            failures = asyncio.run(preflight())
+            if failures:
+                raise RuntimeError("; ".join(f"{name}: {error!r}" for name, error in failures))
+
+            application = build_application(base_url=BOT_API_BASE_URL)
+            logger.info(f"Bot started and ready to accept payments ({SERVER.mode}, "
+                        f"up to {SERVER.concurrent_updates} concurrent updates)")
+            # asyncio.run закрыл свой цикл, run_webhook нужен новый текущий цикл
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            # Вместо стандартной остановки PTB: сначала begin_shutdown (задачи сохраняют
+            # прогресс, обработчикам дается срок), затем PTB закрывает прием вебхуков
+            # и дожидается обновлений в работе
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, lambda: (begin_shutdown(application), application.stop_running()))
+            # chat_member не приходит без явного запроса, а на нем держится контроль входа в канал
+            allowed_updates = SERVER.allowed_updates or Update.ALL_TYPES
+            if SERVER.mode == 'polling':
+                # Для локальной разработки: run_polling сам удаляет установленный вебхук
+                application.run_polling(
+                    allowed_updates=allowed_updates,
+                    drop_pending_updates=SERVER.drop_pending_updates,
+                    stop_signals=None
+                )
+            else:
+                application.run_webhook(
+                    listen=SERVER.listen,
+                    port=SERVER.port,
+                    url_path=SERVER.url_path,
+                    webhook_url=SERVER.webhook_url,
+                    secret_token=SERVER.secret_token,
+                    max_connections=SERVER.max_connections,
+                    cert=SERVER.cert,
+                    key=SERVER.key,
+                    allowed_updates=allowed_updates,
+                    drop_pending_updates=SERVER.drop_pending_updates,
+                    stop_signals=None
                 )
-        except Exception as send_error:
-            logger.error(f"Failed to send error message: {send_error}")
+            # run_webhook/run_polling возвращаются после сигнала остановки — это штатное завершение
+            break
+        except Exception as e:
+            logger.error(f"Error starting bot: {e}")
+            if time.monotonic() - started > STARTUP_STABLE_SECONDS:
+                attempt = 0
+            delay = min(STARTUP_RETRY_MAX, STARTUP_RETRY_BASE * 2 ** attempt)
+            attempt += 1
+            asyncio.run(send_startup_alert(
+                f"⚠️ Ошибка запуска бота: {e}\n"
+                f"🔁 Попытка {attempt}, перезапуск через {delay} сек"
+            ))
+            time.sleep(delay)
+        finally:
+            # run_webhook/run_polling закрывают цикл сами, но запуск мог упасть раньше
+            if loop is not None and not loop.is_closed():
+                loop.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
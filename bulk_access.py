@@ -0,0 +1,118 @@
+"""Массовые операции админа с доступом: выдача, продление и отзыв.
+
+Админ передает список user_id и имен пользователей в команде (/grant, /extend, /revoke)
+или CSV-файлом с командой в подписи. parse_identifiers разбирает список, Storage
+находит пользователей (resolve_users) и применяет изменения одной транзакцией
+(bulk_update_access): новые состояния считает plan_changes, а записи в entitlements,
+users, журнал событий и outbox делаются executemany. Сообщения пользователям (ссылка
+в канал или уведомление об отзыве) и исключение из канала доставляет dispatch_outbox
+с его ограничением скорости.
+
+    * grant — доступ на days дней тем, у кого его нет; действующий доступ не меняется;
+    * extend — +days дней: к окончанию действующего доступа или от текущего момента;
+    * revoke — отключает действующий доступ и исключает из канала.
+"""
+import csv
+import io
+import re
+from datetime import datetime, timedelta
+
+ACTIONS = ('grant', 'extend', 'revoke')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+MAX_DAYS = 3650
+USERNAME_PATTERN = re.compile(r'^@?([A-Za-z][A-Za-z0-9_]{3,31})$')
+
+
+def parse_identifiers(tokens) -> tuple:
+    """(user_id, имена в нижнем регистре, нераспознанные) из строк; порядок сохраняется, дубли убираются."""
+    user_ids, usernames, invalid = {}, {}, []
+    for token in tokens:
+        token = token.strip().strip('"\'')
+        if not token:
+            continue
+        if token.isdigit():
+            user_ids[int(token)] = None
+            continue
+        match = USERNAME_PATTERN.match(token)
+        if match:
+            usernames[match.group(1).lower()] = None
+        else:
+            invalid.append(token)
+    return list(user_ids), list(usernames), invalid
+
+
+def parse_text(text: str) -> tuple:
+    """Список через пробелы, запятые, точки с запятой или переводы строк."""
+    return parse_identifiers(re.split(r'[\s,;]+', text or ''))
+
+
+def parse_csv(data: bytes) -> tuple:
+    """CSV (например, выгрузка активных пользователей): из каждой строки берется первая
+    непустая ячейка; строка заголовка попадает в нераспознанные, если не похожа на имя."""
+    text = data.decode('utf-8-sig', errors='replace')
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    cells = [next((cell for cell in row if cell.strip()), '') for row in csv.reader(io.StringIO(text), dialect)]
+    user_ids, usernames, invalid = parse_identifiers(cells)
+    # Заголовок выгрузки (user_id, username) именем пользователя не считается
+    usernames = [name for name in usernames if name not in ('user_id', 'username')]
+    return user_ids, usernames, invalid
+
+
+def plan_changes(action: str, user_ids: list, current: dict, days: int, now: datetime) -> list:
+    """Изменения доступа: [(user_id, subscription_end, is_trial, active, прежнее состояние или None)].
+
+    current — {user_id: (plan_id, subscription_end, is_trial, active)} по каналу; пользователи,
+    которых операция не меняет (доступ уже есть при grant, нет доступа при revoke), пропускаются."""
+    changes = []
+    for user_id in user_ids:
+        previous = current.get(user_id)
+        end = datetime.strptime(previous[1], DATE_FORMAT) if previous and previous[1] else None
+        running = bool(previous and previous[3] and end and end > now)
+        if action == 'revoke':
+            if previous and previous[3]:
+                changes.append((user_id, previous[1], bool(previous[2]), False, previous))
+            continue
+        if action == 'grant' and running:
+            continue
+        start = end if running and action == 'extend' else now
+        # Продленный пробный период остается пробным, как при днях по промокоду
+        is_trial = bool(previous[2]) if running else False
+        changes.append((user_id, (start + timedelta(days=days)).strftime(DATE_FORMAT), is_trial, True, previous))
+    return changes
+
+
+def event_entries(action: str, changes: list, days: int) -> list:
+    """События журнала (kind, payload) для изменений plan_changes."""
+    if action == 'revoke':
+        return [('revoked', {'reason': 'admin'}) for change in changes]
+    return [('extended', {'days': days, 'reason': 'admin', 'subscription_end': end, 'is_trial': is_trial})
+            for user_id, end, is_trial, active, previous in changes]
+
+
+def outbox_entries(action: str, changes: list, channel_id: int, days: int, batch_id: str) -> list:
+    """Сообщения outbox (chat_id, kind, payload, dedup_key); ключи операции начинаются с
+    outbox_prefix(batch_id), по ним считается прогресс доставки."""
+    kind = 'access_revoked' if action == 'revoke' else 'access_granted'
+    return [(user_id, kind, {'channel_id': channel_id, 'days': days},
+             f"{outbox_prefix(batch_id)}{user_id}:{channel_id}")
+            for user_id, end, is_trial, active, previous in changes]
+
+
+def outbox_prefix(batch_id: str) -> str:
+    return f"admin:{batch_id}:"
+
+
+def counter_deltas(changes: list) -> dict:
+    """Изменения счетчиков active_trial/active_paid."""
+    deltas = {}
+    for user_id, end, is_trial, active, previous in changes:
+        if previous and previous[3]:
+            name = 'active_trial' if previous[2] else 'active_paid'
+            deltas[name] = deltas.get(name, 0) - 1
+        if active:
+            name = 'active_trial' if is_trial else 'active_paid'
+            deltas[name] = deltas.get(name, 0) + 1
+    return {name: delta for name, delta in deltas.items() if delta}
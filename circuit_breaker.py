@@ -0,0 +1,181 @@
+"""Предохранители (circuit breaker) для внешних сервисов: ЮKassa и Bot API.
+
+Пока сервис отвечает, предохранитель замкнут (closed) и считает подряд идущие ошибки.
+После failure_threshold ошибок он размыкается (open): вызовы сразу завершаются
+CircuitOpenError, без ожидания таймаута. Через reset_timeout секунд предохранитель
+пропускает один пробный вызов (half_open): успех замыкает его, ошибка снова размыкает.
+
+Смена состояния передается слушателям (bot.py шлет по ней одно уведомление админам
+вместо уведомления на каждую ошибку), текущее состояние всех предохранителей —
+в health() для команды /health. BreakerRequest подключает предохранитель к запросам Bot API.
+"""
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from telegram.error import NetworkError
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен: предохранитель разомкнут."""
+
+    def __init__(self, breaker: 'CircuitBreaker'):
+        super().__init__(f"{breaker.name} is unavailable (circuit open)")
+        self.breaker = breaker
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 call_timeout: Optional[float] = None, is_failure: Optional[Callable] = None):
+        """is_failure(exc) решает, говорит ли исключение о недоступности сервиса
+        (ошибки в данных запроса предохранитель не размыкают)."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.call_timeout = call_timeout
+        self.is_failure = is_failure or (lambda exc: True)
+        self.listeners = []
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.calls = 0
+        self.total_failures = 0
+        self.rejected = 0
+        self.last_error = None
+        self.last_failure_at = None
+        self.opened_since = None
+        _breakers[name] = self
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """Можно ли выполнить вызов сейчас. В half_open пропускается только один пробный вызов."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self._probe_in_flight = False
+        self._failures = 0
+        self._set_state(CLOSED)
+
+    def record_failure(self, error: BaseException):
+        self._probe_in_flight = False
+        self._failures += 1
+        self.total_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        self.last_failure_at = time.time()
+        # Ошибка пробного вызова размыкает сразу, в замкнутом состоянии — после порога
+        if self._state != CLOSED or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self._state == CLOSED:
+                self.opened_since = time.time()
+            self._set_state(OPEN, force=True)
+
+    def _set_state(self, state: str, force: bool = False):
+        old = self._state
+        if old == state and not force:
+            return
+        self._state = state
+        if old == state:
+            return
+        if state == OPEN:
+            logger.warning(f"Circuit {self.name} opened: {self.last_error}")
+        else:
+            logger.info(f"Circuit {self.name} closed")
+        for listener in self.listeners:
+            try:
+                listener(self, old, state)
+            except Exception as e:
+                logger.error(f"Circuit {self.name} listener failed: {e}")
+
+    async def call(self, func, *args, **kwargs):
+        """Выполняет func (корутинную функцию) через предохранитель и с call_timeout."""
+        if not self.allow():
+            raise CircuitOpenError(self)
+        self.calls += 1
+        try:
+            if self.call_timeout:
+                result = await asyncio.wait_for(func(*args, **kwargs), self.call_timeout)
+            else:
+                result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            self._probe_in_flight = False
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                self.record_failure(e)
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def health(self) -> dict:
+        return {
+            'name': self.name,
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'calls': self.calls,
+            'failures': self.total_failures,
+            'rejected': self.rejected,
+            'last_error': self.last_error,
+            'last_failure_at': self.last_failure_at,
+            'opened_since': self.opened_since if self._state == OPEN else None,
+        }
+
+
+class BreakerRequest(HTTPXRequest):
+    """HTTPXRequest для Bot API через предохранитель. Сбой — сетевая ошибка, таймаут
+    или ответ 5xx; 429 и ошибки 4xx говорят о запросе, а не о недоступности Bot API.
+    Пока предохранитель разомкнут, запрос сразу завершается NetworkError."""
+
+    __slots__ = ('breaker',)
+
+    def __init__(self, breaker: CircuitBreaker, **kwargs):
+        super().__init__(**kwargs)
+        self.breaker = breaker
+
+    async def do_request(self, *args, **kwargs):
+        if not self.breaker.allow():
+            raise NetworkError(f"{self.breaker.name} is unavailable (circuit open)")
+        self.breaker.calls += 1
+        try:
+            code, payload = await super().do_request(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker._probe_in_flight = False
+            raise
+        except NetworkError as e:
+            self.breaker.record_failure(e)
+            raise
+        if code >= 500:
+            self.breaker.record_failure(NetworkError(f"HTTP {code}"))
+        else:
+            self.breaker.record_success()
+        return code, payload
+
+
+_breakers = {}
+
+
+def health() -> list:
+    """Состояние всех созданных предохранителей."""
+    return [breaker.health() for breaker in _breakers.values()]
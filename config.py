@@ -0,0 +1,92 @@
+"""Настройки бота из окружения и .env — в одном месте.
+
+Модули не читают .env при импорте: точка входа (bot.configure, workers.main,
+migrate_storage.main) вызывает load_env(), а остальной код берет значения из
+get_settings() при первом обращении. Поэтому модули можно импортировать в тестах
+и бенчмарках без побочных эффектов, а переменные окружения важнее файла .env.
+
+Настройки каналов и тарифов — plans.py, приема обновлений — server_config.py,
+хранилища — storage.py; они тоже читают окружение только при вызове.
+"""
+import os
+from typing import NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+_env_loaded = False
+_settings = None
+
+
+class Settings(NamedTuple):
+    token: Optional[str]
+    admin_id: Optional[int]
+    friend_id: int
+    trial_days: int
+    yookassa_shop_id: Optional[str]
+    yookassa_secret_key: Optional[str]
+    yookassa_api_url: Optional[str]
+    yookassa_timeout: float
+    circuit_failures: int
+    circuit_reset_timeout: float
+    shutdown_timeout: float
+    sweep_start_delay: int
+    snapshot_file: str
+    reconcile_enforce: bool
+    user_index: bool
+    user_index_refresh: float
+    trial_guard: str
+    auto_renew: bool
+    referral_days: int
+    retention_days: int
+    maintenance_hour: int
+    log_file: str
+    log_max_bytes: int
+    log_backups: int
+    backup_dir: str
+    backup_interval: float
+    backup_keep: int
+
+
+def load_env():
+    """Однократно загружает .env в os.environ (уже заданные переменные не перезаписываются)."""
+    global _env_loaded
+    if not _env_loaded:
+        load_dotenv()
+        _env_loaded = True
+
+
+def get_settings() -> Settings:
+    """Настройки процесса; читаются из окружения при первом вызове."""
+    global _settings
+    if _settings is None:
+        load_env()
+        _settings = Settings(
+            token=os.getenv('TELEGRAM_BOT_TOKEN'),
+            admin_id=int(os.getenv('ADMIN_ID')) if os.getenv('ADMIN_ID') else None,
+            friend_id=int(os.getenv('FRIEND_ID', 0)),
+            trial_days=int(os.getenv('TRIAL_DAYS', 5)),
+            yookassa_shop_id=os.getenv('YOOKASSA_SHOP_ID'),
+            yookassa_secret_key=os.getenv('YOOKASSA_SECRET_KEY'),
+            yookassa_api_url=os.getenv('YOOKASSA_API_URL'),
+            yookassa_timeout=float(os.getenv('YOOKASSA_TIMEOUT', 15)),
+            circuit_failures=int(os.getenv('CIRCUIT_FAILURES', 5)),
+            circuit_reset_timeout=float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30)),
+            shutdown_timeout=float(os.getenv('SHUTDOWN_TIMEOUT', 25)),
+            sweep_start_delay=int(os.getenv('SWEEP_START_DELAY', 300)),
+            snapshot_file=os.getenv('SNAPSHOT_FILE', 'hot_state.json'),
+            reconcile_enforce=os.getenv('RECONCILE_ENFORCE', '0').lower() in ('1', 'true', 'yes'),
+            user_index=os.getenv('USER_INDEX', '1').lower() in ('1', 'true', 'yes'),
+            user_index_refresh=float(os.getenv('USER_INDEX_REFRESH', 10)),
+            trial_guard=os.getenv('TRIAL_GUARD', 'flag').lower(),
+            auto_renew=os.getenv('AUTO_RENEW', '0').lower() in ('1', 'true', 'yes'),
+            referral_days=int(os.getenv('REFERRAL_DAYS', 7)),
+            retention_days=int(os.getenv('RETENTION_DAYS', 30)),
+            maintenance_hour=int(os.getenv('MAINTENANCE_HOUR', 4)),
+            log_file=os.getenv('LOG_FILE', 'bot.log'),
+            log_max_bytes=int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+            log_backups=int(os.getenv('LOG_BACKUPS', 5)),
+            backup_dir=os.getenv('BACKUP_DIR', 'data/backups'),
+            backup_interval=float(os.getenv('BACKUP_INTERVAL', 6)),
+            backup_keep=int(os.getenv('BACKUP_KEEP', 8)),
+        )
+    return _settings
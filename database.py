@@ -1,14 +1,16 @@
-from math import ceil
 import sqlite3
+import json
 from datetime import datetime, timedelta
 import os
-from dotenv import load_dotenv
 import time
 import threading
+from config import get_settings
+from plans import get_default_channel, get_default_plan, get_plan
+import bulk_access
+import event_log
 
-load_dotenv()
 DB_PATH = 'data/subscriptions.db'
-TRIAL_DAYS = int(os.getenv('TRIAL_DAYS', 5))
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 # Синхронизация для предотвращения `database is locked`
 db_lock = threading.Lock()
@@ -30,7 +32,7 @@ def get_db_connection():
 
 def init_db():
     try:
-        os.makedirs('data', exist_ok=True)
+        os.makedirs(os.path.dirname(DB_PATH) or '.', exist_ok=True)
         with db_lock:
             conn = get_db_connection()
             cursor = conn.cursor()
@@ -54,13 +56,351 @@ def init_db():
                 status TEXT DEFAULT 'pending',
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             )''')
-            
+
+            # Доступ пользователя к конкретному каналу. Таблица users хранит копию
+            # состояния основного канала для обратной совместимости.
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS entitlements (
+                user_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                plan_id TEXT,
+                subscription_end TIMESTAMP,
+                is_trial BOOLEAN DEFAULT 0,
+                active BOOLEAN DEFAULT 1,
+                PRIMARY KEY (user_id, channel_id)
+            )''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_entitlements_expiry ON entitlements (active, subscription_end)
+            ''')
+
+            cursor.execute("PRAGMA table_info(payments)")
+            if 'plan_id' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE payments ADD COLUMN plan_id TEXT')
+            # Время последнего изменения доступа: по нему сверка выбирает, кого проверять заново
+            cursor.execute("PRAGMA table_info(entitlements)")
+            if 'updated_at' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE entitlements ADD COLUMN updated_at TIMESTAMP')
+            # По нему индекс доступов в памяти подтягивает изменения других процессов
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_entitlements_updated ON entitlements (updated_at)')
+
+            # Последний известный статус пользователя в канале: из событий chat_member
+            # или из проверки get_chat_member при сверке
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS channel_members (
+                user_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                source TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, channel_id)
+            )''')
+
+            # Состояние плановых задач и аренда лидера между процессами
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_state (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                lease_until REAL,
+                last_run REAL
+            )''')
+            # Прогресс прерванной задачи (JSON): по нему задача продолжается после перезапуска
+            cursor.execute("PRAGMA table_info(job_state)")
+            if 'checkpoint' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE job_state ADD COLUMN checkpoint TEXT')
+
+            # Для последнего платежа пользователя и проверки первой оплаты
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_payments_user_date ON payments (user_id, date)
+            ''')
+            # Для удаления устаревших неоплаченных платежей (purge_payments)
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_payments_status_date ON payments (status, date)
+            ''')
+
+            # Агрегаты для статистики админа, обновляются вместе с изменениями данных
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL DEFAULT 0
+            )''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_periods (
+                period TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (period, metric)
+            )''')
+
+            # Исходящие сообщения: пишутся в одной транзакции с изменением данных,
+            # доставляются диспетчером bot.dispatch_outbox с повторами
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                dedup_key TEXT UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                locked_until REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, next_attempt_at)
+            ''')
+
+            # Сохраненные способы оплаты для автопродления: один на пользователя
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS payment_methods (
+                user_id INTEGER PRIMARY KEY,
+                method_id TEXT NOT NULL,
+                title TEXT,
+                auto_renew BOOLEAN NOT NULL DEFAULT 1,
+                failures INTEGER NOT NULL DEFAULT 0,
+                last_attempt_at REAL,
+                pending_payment_id TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+
+            # Признаки повторного пробного периода (trial_guard.py): ключ -> прежний аккаунт
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trial_signals (
+                key TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_trial_signals_created ON trial_signals (created_at)
+            ''')
+
+            # Промокоды: скидка в процентах на следующую оплату и/или дни доступа сразу
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS promo_codes (
+                code TEXT PRIMARY KEY,
+                percent INTEGER NOT NULL DEFAULT 0,
+                bonus_days INTEGER NOT NULL DEFAULT 0,
+                max_redemptions INTEGER,
+                redemptions INTEGER NOT NULL DEFAULT 0,
+                expires_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            # Активации промокодов: payment_id — платеж, в котором скидка использована
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS promo_redemptions (
+                code TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                payment_id TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (code, user_id)
+            )''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_promo_redemptions_user ON promo_redemptions (user_id)
+            ''')
+            # Приглашенные пользователи: пригласивший получает дни после первой оплаты приглашенного
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referrals (
+                user_id INTEGER PRIMARY KEY,
+                referrer_id INTEGER NOT NULL,
+                credited BOOLEAN NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id)
+            ''')
+
+            # Журнал изменений доступа (event_log.py): только добавление
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, id)')
+            # Свернутое журналом состояние (user_id, channel_id) и номер последнего учтенного события
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_snapshots (
+                user_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                event_id INTEGER NOT NULL,
+                PRIMARY KEY (user_id, channel_id)
+            )''')
+
+            _migrate_users_to_entitlements(cursor)
+            _backfill_event_snapshots(cursor)
+            _backfill_trial_signals(cursor)
+            _rebuild_stats_if_empty(cursor)
+
             conn.commit()
             conn.close()
     except Exception as e:
         print(f"Error initializing database: {e}")
 
-def add_user(user_id: int, username: str = None):
+def _migrate_users_to_entitlements(cursor):
+    """Однократно переносит подписки из users в entitlements основного канала."""
+    cursor.execute('SELECT 1 FROM entitlements LIMIT 1')
+    if cursor.fetchone():
+        return
+    cursor.execute('''
+    INSERT OR IGNORE INTO entitlements (user_id, channel_id, plan_id, subscription_end, is_trial, active)
+    SELECT user_id, ?, NULL,
+           COALESCE(subscription_end, datetime(join_date, ?)),
+           CASE WHEN trial_used THEN 0 ELSE 1 END,
+           active
+    FROM users
+    ''', (get_default_channel().channel_id, f'+{get_settings().trial_days} days'))
+
+def _backfill_event_snapshots(cursor):
+    """Однократно записывает текущие доступы как исходные снимки: история до появления
+    журнала не восстанавливается, но проекция с нее начинается."""
+    cursor.execute('SELECT 1 FROM events LIMIT 1')
+    if cursor.fetchone():
+        return
+    cursor.execute('SELECT 1 FROM event_snapshots LIMIT 1')
+    if cursor.fetchone():
+        return
+    cursor.execute('SELECT user_id, channel_id, plan_id, subscription_end, is_trial, active FROM entitlements')
+    cursor.executemany('''
+    INSERT OR IGNORE INTO event_snapshots (user_id, channel_id, state, event_id) VALUES (?, ?, ?, 0)
+    ''', [(user_id, channel_id, json.dumps(dict(event_log.empty_state(), plan_id=plan_id,
+                                                 subscription_end=subscription_end, is_trial=bool(is_trial),
+                                                 active=bool(active), paid=not is_trial)), )
+          for user_id, channel_id, plan_id, subscription_end, is_trial, active in cursor.fetchall()])
+
+def _append_event(cursor, user_id: int, channel_id: int, kind: str, payload: dict = None):
+    """Добавляет событие в журнал; вызывается в транзакции изменения."""
+    cursor.execute('''
+    INSERT INTO events (user_id, channel_id, kind, payload) VALUES (?, ?, ?, ?)
+    ''', (user_id, channel_id, kind, json.dumps(payload or {})))
+
+def _backfill_trial_signals(cursor):
+    """Однократно записывает имена уже существующих пользователей как признаки."""
+    cursor.execute('SELECT 1 FROM trial_signals LIMIT 1')
+    if cursor.fetchone():
+        return
+    cursor.execute('''
+    INSERT OR IGNORE INTO trial_signals (key, user_id, kind, created_at)
+    SELECT 'username:' || lower(username), user_id, 'username', COALESCE(join_date, CURRENT_TIMESTAMP)
+    FROM users WHERE username IS NOT NULL AND username != ''
+    ORDER BY join_date
+    ''')
+
+def _bump(cursor, name: str, delta: float = 1):
+    """Изменяет счетчик статистики на delta."""
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value) VALUES (?, ?)
+    ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', (name, delta))
+
+def _bump_period(cursor, metric: str, delta: float = 1):
+    """Изменяет метрику за текущие день и месяц (UTC, как даты в payments и users)."""
+    cursor.execute('''
+    INSERT INTO stats_periods (period, metric, value)
+    VALUES (date('now'), ?, ?), (strftime('%Y-%m', 'now'), ?, ?)
+    ON CONFLICT(period, metric) DO UPDATE SET value = value + excluded.value
+    ''', (metric, delta, metric, delta))
+
+def _rebuild_stats_if_empty(cursor):
+    """Заполняет агрегаты по существующим данным (первый запуск после обновления).
+
+    История оттока до появления агрегатов не восстанавливается."""
+    cursor.execute('SELECT 1 FROM stats_counters LIMIT 1')
+    if cursor.fetchone():
+        return
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT CASE WHEN is_trial THEN 'active_trial' ELSE 'active_paid' END, COUNT(*)
+    FROM entitlements WHERE active = 1 GROUP BY is_trial
+    ''')
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'payments_' || status, COUNT(*) FROM payments GROUP BY status
+    ''')
+    cursor.execute("INSERT INTO stats_counters (name, value) SELECT 'users_total', COUNT(*) FROM users")
+    cursor.execute('''
+    INSERT INTO stats_counters (name, value)
+    SELECT 'users_paid', COUNT(DISTINCT user_id) FROM payments WHERE status = 'succeeded'
+    ''')
+    for period_format in ('%Y-%m-%d', '%Y-%m'):
+        cursor.execute('''
+        INSERT INTO stats_periods (period, metric, value)
+        SELECT strftime(?, date), 'revenue', SUM(amount) FROM payments
+        WHERE status = 'succeeded' AND date IS NOT NULL GROUP BY 1
+        ''', (period_format,))
+        cursor.execute('''
+        INSERT INTO stats_periods (period, metric, value)
+        SELECT strftime(?, join_date), 'new_users', COUNT(*) FROM users
+        WHERE join_date IS NOT NULL GROUP BY 1
+        ''', (period_format,))
+        cursor.execute('''
+        INSERT INTO stats_periods (period, metric, value)
+        SELECT strftime(?, first_date), 'conversions', COUNT(*) FROM (
+            SELECT MIN(date) AS first_date FROM payments WHERE status = 'succeeded' GROUP BY user_id
+        ) WHERE first_date IS NOT NULL GROUP BY 1
+        ''', (period_format,))
+
+def _sync_user_row(cursor, user_id: int, channel_id: int, subscription_end, active: bool, paid: bool = False):
+    """Дублирует состояние основного канала в таблицу users."""
+    if channel_id != get_default_channel().channel_id:
+        return
+    if paid:
+        cursor.execute('''
+        UPDATE users SET active = ?, subscription_end = ?, trial_used = 1 WHERE user_id = ?
+        ''', (int(active), subscription_end, user_id))
+    else:
+        cursor.execute('''
+        UPDATE users SET active = ?, subscription_end = COALESCE(?, subscription_end) WHERE user_id = ?
+        ''', (int(active), subscription_end, user_id))
+
+def _extend_entitlement(cursor, user_id: int, channel_id: int, days: int, reason: str) -> str:
+    """Добавляет days дней доступа к каналу (от окончания или, если доступ истек, от текущего
+    момента) и возвращает новую дату окончания. Вызывается внутри транзакции."""
+    cursor.execute('''
+    SELECT subscription_end, is_trial, active FROM entitlements WHERE user_id = ? AND channel_id = ?
+    ''', (user_id, channel_id))
+    result = cursor.fetchone()
+    now = datetime.now()
+    is_trial = False
+    if result and result[2] and result[0] and datetime.strptime(result[0], DATE_FORMAT) > now:
+        subscription_end = (datetime.strptime(result[0], DATE_FORMAT) + timedelta(days=days)).strftime(DATE_FORMAT)
+        is_trial = bool(result[1])
+        cursor.execute('''
+        UPDATE entitlements SET subscription_end = ?, updated_at = datetime('now') WHERE user_id = ? AND channel_id = ?
+        ''', (subscription_end, user_id, channel_id))
+    else:
+        # Истекший или отсутствующий доступ становится платным без тарифа
+        subscription_end = (now + timedelta(days=days)).strftime(DATE_FORMAT)
+        cursor.execute('''
+        INSERT INTO entitlements (user_id, channel_id, plan_id, subscription_end, is_trial, active, updated_at)
+        VALUES (?, ?, NULL, ?, 0, 1, datetime('now'))
+        ON CONFLICT(user_id, channel_id) DO UPDATE SET
+            subscription_end = excluded.subscription_end,
+            is_trial = 0,
+            active = 1,
+            updated_at = excluded.updated_at
+        ''', (user_id, channel_id, subscription_end))
+        if not (result and result[2] and not result[1]):
+            _bump(cursor, 'active_paid')
+            if result and result[2]:
+                _bump(cursor, 'active_trial', -1)
+    _sync_user_row(cursor, user_id, channel_id, subscription_end, True)
+    _append_event(cursor, user_id, channel_id, 'extended',
+                  {'days': days, 'reason': reason, 'subscription_end': subscription_end, 'is_trial': is_trial})
+    return subscription_end
+
+def add_user(user_id: int, username: str = None, suspect_keys: list = (), deny_trial: bool = False):
+    """Создает пользователя с пробным периодом в основном канале.
+
+    suspect_keys — ключи trial_signals, которые надо проверить (trial_guard.suspect_keys).
+    Возвращает None, если пользователь уже был, иначе список совпавших признаков
+    (key, user_id прежнего аккаунта, kind). При совпадениях и deny_trial пробный период
+    не выдается."""
     try:
         with db_lock:
             conn = get_db_connection()
@@ -69,86 +409,1131 @@ def add_user(user_id: int, username: str = None):
             INSERT OR IGNORE INTO users (user_id, username, join_date, active, trial_used)
             VALUES (?, ?, datetime('now'), 1, 0)
             ''', (user_id, username))
+            matches = None
+            if cursor.rowcount:
+                matches = []
+                if suspect_keys:
+                    cursor.execute(f'''
+                    SELECT key, user_id, kind FROM trial_signals
+                    WHERE key IN ({', '.join('?' for _ in suspect_keys)}) AND user_id != ?
+                    ''', (*suspect_keys, user_id))
+                    matches = cursor.fetchall()
+                if username:
+                    cursor.execute('''
+                    INSERT OR IGNORE INTO trial_signals (key, user_id, kind) VALUES (?, ?, 'username')
+                    ''', (f"username:{username.lower()}", user_id))
+                _bump(cursor, 'users_total')
+                _bump_period(cursor, 'new_users')
+                if matches:
+                    _bump(cursor, 'trials_denied' if deny_trial else 'trials_flagged')
+                if matches and deny_trial:
+                    cursor.execute('UPDATE users SET active = 0, trial_used = 1 WHERE user_id = ?', (user_id,))
+                else:
+                    # Новый пользователь получает пробный период в основном канале
+                    channel_id = get_default_channel().channel_id
+                    trial_end = (datetime.now() + timedelta(days=get_settings().trial_days)).strftime(DATE_FORMAT)
+                    cursor.execute('''
+                    INSERT OR IGNORE INTO entitlements (user_id, channel_id, subscription_end, is_trial, active, updated_at)
+                    VALUES (?, ?, ?, 1, 1, datetime('now'))
+                    ''', (user_id, channel_id, trial_end))
+                    _sync_user_row(cursor, user_id, channel_id, trial_end, True)
+                    _bump(cursor, 'active_trial')
+                    _append_event(cursor, user_id, channel_id, 'trial_started', {'subscription_end': trial_end})
             conn.commit()
             conn.close()
+            return matches
     except Exception as e:
         print(f"Error adding user {user_id}: {e}")
 
-def check_user_access(user_id: int) -> bool:
+def add_trial_signal(key: str, user_id: int, kind: str):
+    """Записывает признак, если ключ еще не занят (остается первый аккаунт)."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('INSERT OR IGNORE INTO trial_signals (key, user_id, kind) VALUES (?, ?, ?)',
+                         (key, user_id, kind))
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_trial_signal_keys(since: str = None):
+    """Ключи trial_signals, записанные не раньше since (все — без since)."""
+    conn = get_db_connection()
     try:
-        with db_lock:
-            conn = get_db_connection()
+        cursor = conn.cursor()
+        if since is None:
+            cursor.execute('SELECT key FROM trial_signals')
+        else:
+            cursor.execute('SELECT key FROM trial_signals WHERE created_at >= ?', (since,))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_entitlement(user_id: int, channel_id: int = None):
+    """Возвращает (plan_id, subscription_end, is_trial, active) или None."""
+    if channel_id is None:
+        channel_id = get_default_channel().channel_id
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT plan_id, subscription_end, is_trial, active FROM entitlements
+        WHERE user_id = ? AND channel_id = ?
+        ''', (user_id, channel_id))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+def get_user_entitlements(user_id: int):
+    """Возвращает список (channel_id, plan_id, subscription_end, is_trial, active)."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT channel_id, plan_id, subscription_end, is_trial, active FROM entitlements
+        WHERE user_id = ?
+        ''', (user_id,))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_due_entitlements(cutoff: str, after: list = None, deactivated_since: str = None, now: str = None):
+    """Активные доступы, заканчивающиеся раньше cutoff (использует индекс по окончанию),
+    по возрастанию (subscription_end, user_id, channel_id).
+
+    Для продолжения прерванного прохода: after — позиция последнего обработанного доступа,
+    возвращаются только доступы после нее; с deactivated_since (UTC) и now к активным добавляются
+    доступы, истекшие раньше now и отключенные не раньше deactivated_since, — проход мог
+    отключить их, не успев исключить пользователя из канала."""
+    conditions, params = ['e.subscription_end < ?'], [cutoff]
+    if deactivated_since:
+        conditions.append('(e.active = 1 OR (e.updated_at >= ? AND e.subscription_end < ?))')
+        params += [deactivated_since, now]
+    else:
+        conditions.append('e.active = 1')
+    if after:
+        conditions.append('(e.subscription_end, e.user_id, e.channel_id) > (?, ?, ?)')
+        params += after
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT e.user_id, u.username, e.channel_id, e.plan_id, e.subscription_end, e.is_trial
+        FROM entitlements e LEFT JOIN users u ON u.user_id = e.user_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY e.subscription_end, e.user_id, e.channel_id
+        ''', params)
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def deactivate_entitlement(user_id: int, channel_id: int, outbox: list = (), now: str = None) -> bool:
+    """Отключает доступ. Сообщения outbox ставятся в очередь в той же транзакции,
+    только если доступ был активен (повторное отключение их не дублирует).
+
+    С now отключается только доступ, истекший раньше now: продленный после того, как проход
+    прочитал список, остается активным. Возвращает False, если такого доступа нет."""
+    end_condition = ' AND subscription_end < ?' if now else ''
+    end_params = (now,) if now else ()
+    with db_lock:
+        conn = get_db_connection()
+        try:
             cursor = conn.cursor()
-            cursor.execute('''
-            SELECT subscription_end, trial_used, join_date, active FROM users 
-            WHERE user_id = ?
-            ''', (user_id,))
-            result = cursor.fetchone()
-            
-            if result:
-                subscription_end, trial_used, join_date, active = result
-                if active:
-                    if subscription_end and datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S') > datetime.now():
-                        conn.close()
-                        return True
-                    elif not trial_used:
-                        trial_end = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S') + timedelta(days=TRIAL_DAYS)
-                        if trial_end > datetime.now():
-                            conn.close()
-                            return True
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'''
+            SELECT is_trial FROM entitlements WHERE user_id = ? AND channel_id = ? AND active = 1{end_condition}
+            ''', (user_id, channel_id) + end_params)
+            current = cursor.fetchone()
+            cursor.execute(f'''
+            UPDATE entitlements SET active = 0, updated_at = datetime('now')
+            WHERE user_id = ? AND channel_id = ?{end_condition}
+            ''', (user_id, channel_id) + end_params)
+            if not cursor.rowcount:
+                conn.commit()
+                return False
+            if current:
+                kind = 'trial' if current[0] else 'paid'
+                _bump(cursor, f'active_{kind}', -1)
+                _bump(cursor, f'churned_{kind}')
+                _bump_period(cursor, f'churned_{kind}')
+                _enqueue(cursor, outbox)
+                _append_event(cursor, user_id, channel_id, 'expired')
+            _sync_user_row(cursor, user_id, channel_id, None, False)
+            conn.commit()
+            return True
+        finally:
             conn.close()
-            return False
+
+def check_user_access(user_id: int, channel_id: int = None) -> bool:
+    try:
+        entitlement = get_entitlement(user_id, channel_id)
+        if entitlement:
+            plan_id, subscription_end, is_trial, active = entitlement
+            if active and subscription_end and datetime.strptime(subscription_end, DATE_FORMAT) > datetime.now():
+                return True
+        return False
     except Exception as e:
         print(f"Error checking access for user {user_id}: {e}")
         return False
 
-def update_subscription(user_id: int, payment_id: str, amount: float):
+def update_subscription(user_id: int, payment_id: str, amount: float, plan_id: str = None,
+                        outbox: list = (), promo_code: str = None, referral_days: int = 0):
+    """Продлевает доступ к каналу тарифа и возвращает новую дату окончания.
+
+    Возвращает None, если платеж уже был зачтен ранее (в том числе другим процессом).
+    Сообщения outbox ставятся в очередь в той же транзакции, что и продление.
+    promo_code — промокод, скидка по которому использована в этом платеже. При первой
+    оплате пригласивший пользователя получает referral_days дней доступа.
+    """
     try:
+        plan = get_plan(plan_id) or get_default_plan()
         with db_lock:
             conn = get_db_connection()
             cursor = conn.cursor()
+            # Берем блокировку записи сразу, чтобы проверка и продление были атомарны между процессами
+            cursor.execute('BEGIN IMMEDIATE')
+
+            cursor.execute('''
+            SELECT status FROM payments WHERE payment_id = ?
+            ''', (payment_id,))
+            payment = cursor.fetchone()
+            if payment and payment[0] == 'succeeded':
+                conn.rollback()
+                conn.close()
+                print(f"Payment {payment_id} for user {user_id} already applied")
+                return None
             
             cursor.execute('''
-            SELECT subscription_end, trial_used, join_date FROM users WHERE user_id = ?
-            ''', (user_id,))
+            SELECT subscription_end, is_trial, active FROM entitlements WHERE user_id = ? AND channel_id = ?
+            ''', (user_id, plan.channel_id))
             result = cursor.fetchone()
             
             # Определяем новую дату окончания подписки
-            if result:
-                subscription_end, trial_used, join_date = result
-                if subscription_end and datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S') > datetime.now():
-                    # Если есть активная подписка, добавляем 30 дней к текущей дате окончания
-                    end_date = datetime.strptime(subscription_end, '%Y-%m-%d %H:%M:%S') + timedelta(days=30)
-                elif not trial_used:
-                    # Если есть пробный период, добавляем его оставшиеся дни + 30 дней
-                    trial_end = datetime.strptime(join_date, '%Y-%m-%d %H:%M:%S') + timedelta(days=TRIAL_DAYS)
-                    remaining_days = max(0, ceil((trial_end - datetime.now()).total_seconds() / (24 * 3600)))
-                    end_date = datetime.now() + timedelta(days=30 + remaining_days)
-                else:
-                    # Если нет активной подписки, устанавливаем 30 дней с текущей даты
-                    end_date = datetime.now() + timedelta(days=30)
+            now = datetime.now()
+            if result and result[0] and datetime.strptime(result[0], DATE_FORMAT) > now:
+                # Если есть активная подписка или пробный период, продлеваем от их окончания
+                end_date = datetime.strptime(result[0], DATE_FORMAT) + timedelta(days=plan.days)
             else:
-                # Новый пользователь без подписки
-                end_date = datetime.now() + timedelta(days=30)
+                # Если нет активной подписки, отсчитываем срок тарифа от текущей даты
+                end_date = now + timedelta(days=plan.days)
+            subscription_end = end_date.strftime(DATE_FORMAT)
             
             cursor.execute('''
-            UPDATE users
-            SET active = 1, subscription_end = ?, trial_used = 1
-            WHERE user_id = ?
-            ''', (end_date.strftime('%Y-%m-%d %H:%M:%S'), user_id))
-            
+            INSERT INTO entitlements (user_id, channel_id, plan_id, subscription_end, is_trial, active, updated_at)
+            VALUES (?, ?, ?, ?, 0, 1, datetime('now'))
+            ON CONFLICT(user_id, channel_id) DO UPDATE SET
+                plan_id = excluded.plan_id,
+                subscription_end = excluded.subscription_end,
+                is_trial = 0,
+                active = 1,
+                updated_at = excluded.updated_at
+            ''', (user_id, plan.channel_id, plan.plan_id, subscription_end))
+            _sync_user_row(cursor, user_id, plan.channel_id, subscription_end, True, paid=True)
+
+            # Статистика: переход в платные, первая оплата пользователя, выручка
+            if not (result and result[2] and not result[1]):
+                _bump(cursor, 'active_paid')
+                if result and result[2]:
+                    _bump(cursor, 'active_trial', -1)
             cursor.execute('''
-            INSERT INTO payments (payment_id, user_id, amount, status)
-            VALUES (?, ?, ?, 'succeeded')
-            ON CONFLICT(payment_id) DO UPDATE SET status = 'succeeded'
-            ''', (payment_id, user_id, amount))
+            SELECT 1 FROM payments WHERE user_id = ? AND status = 'succeeded' LIMIT 1
+            ''', (user_id,))
+            if not cursor.fetchone():
+                _bump(cursor, 'users_paid')
+                _bump_period(cursor, 'conversions')
+                if referral_days:
+                    _credit_referrer(cursor, user_id, referral_days)
+            if promo_code:
+                cursor.execute('''
+                UPDATE promo_redemptions SET payment_id = ? WHERE code = ? AND user_id = ? AND payment_id IS NULL
+                ''', (payment_id, promo_code, user_id))
+            if payment:
+                _bump(cursor, f'payments_{payment[0]}', -1)
+            _bump(cursor, 'payments_succeeded')
+            _bump_period(cursor, 'revenue', amount)
+
+            cursor.execute('''
+            INSERT INTO payments (payment_id, user_id, amount, status, plan_id)
+            VALUES (?, ?, ?, 'succeeded', ?)
+            ON CONFLICT(payment_id) DO UPDATE SET status = 'succeeded', date = datetime('now')
+            ''', (payment_id, user_id, amount, plan.plan_id))
+            _enqueue(cursor, outbox)
+            _append_event(cursor, user_id, plan.channel_id, 'payment_succeeded',
+                          {'payment_id': payment_id, 'amount': amount, 'plan_id': plan.plan_id,
+                           'subscription_end': subscription_end})
             
             conn.commit()
             conn.close()
-            print(f"Updated subscription for user {user_id} to {end_date}")
+            print(f"Updated subscription for user {user_id} in channel {plan.channel_id} to {end_date}")
+            return end_date
     except Exception as e:
         print(f"Error updating subscription for user {user_id}: {e}")
         raise e
 
+def _credit_referrer(cursor, user_id: int, days: int):
+    """Начисляет пригласившему days дней в основном канале (один раз на приглашенного)."""
+    cursor.execute('SELECT referrer_id FROM referrals WHERE user_id = ? AND credited = 0', (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return
+    cursor.execute('UPDATE referrals SET credited = 1 WHERE user_id = ?', (user_id,))
+    _extend_entitlement(cursor, row[0], get_default_channel().channel_id, days, 'referral')
+    _bump(cursor, 'referrals_credited')
+    _enqueue(cursor, [(row[0], 'referral_credited', {'days': days}, f"referral_credited:{user_id}")])
+
+def add_payment(payment_id: str, user_id: int, amount: float, plan_id: str = None, status: str = 'pending'):
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT INTO payments (payment_id, user_id, amount, status, plan_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(payment_id) DO NOTHING
+            ''', (payment_id, user_id, amount, status, plan_id))
+            if cursor.rowcount:
+                _bump(cursor, f'payments_{status}')
+            conn.commit()
+        finally:
+            conn.close()
+
+def set_payment_status(payment_id: str, status: str):
+    """Обновляет статус платежа. Статус succeeded выставляет только update_subscription."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status FROM payments WHERE payment_id = ?', (payment_id,))
+            current = cursor.fetchone()
+            cursor.execute('''
+            UPDATE payments SET status = ?, date = datetime('now')
+            WHERE payment_id = ? AND status != 'succeeded' AND ? != 'succeeded'
+            ''', (status, payment_id, status))
+            if cursor.rowcount and current[0] != status:
+                _bump(cursor, f'payments_{current[0]}', -1)
+                _bump(cursor, f'payments_{status}')
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_payment(payment_id: str):
+    """Возвращает (payment_id, user_id, amount, status, plan_id) или None."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT payment_id, user_id, amount, status, plan_id FROM payments WHERE payment_id = ?
+        ''', (payment_id,))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+def get_pending_payment_ids(payment_ids: list) -> set:
+    """Те из payment_ids, что еще в статусе pending."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        pending = set()
+        # Пачками: у SQLite ограничено число параметров запроса
+        for start in range(0, len(payment_ids), 500):
+            batch = payment_ids[start:start + 500]
+            cursor.execute(f'''
+            SELECT payment_id FROM payments
+            WHERE status = 'pending' AND payment_id IN ({', '.join('?' * len(batch))})
+            ''', batch)
+            pending.update(row[0] for row in cursor.fetchall())
+        return pending
+    finally:
+        conn.close()
+
+def get_last_payment(user_id: int):
+    """Возвращает (payment_id, status) последнего платежа пользователя или None."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT payment_id, status FROM payments
+        WHERE user_id = ?
+        ORDER BY date DESC LIMIT 1
+        ''', (user_id,))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+def save_payment_method(user_id: int, method_id: str, title: str = None):
+    """Сохраняет способ оплаты пользователя и включает автопродление."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+            INSERT INTO payment_methods (user_id, method_id, title, auto_renew, failures, updated_at)
+            VALUES (?, ?, ?, 1, 0, datetime('now'))
+            ON CONFLICT(user_id) DO UPDATE SET
+                method_id = excluded.method_id,
+                title = excluded.title,
+                auto_renew = 1,
+                failures = 0,
+                pending_payment_id = NULL,
+                updated_at = excluded.updated_at
+            ''', (user_id, method_id, title))
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_payment_method(user_id: int):
+    """(method_id, title, auto_renew, failures, pending_payment_id) или None."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT method_id, title, auto_renew, failures, pending_payment_id FROM payment_methods WHERE user_id = ?
+        ''', (user_id,))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+def set_auto_renew(user_id: int, enabled: bool) -> bool:
+    """Включает или отключает автопродление. False — сохраненного способа оплаты нет."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            UPDATE payment_methods SET auto_renew = ?, failures = 0, updated_at = datetime('now') WHERE user_id = ?
+            ''', (int(enabled), user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+def get_auto_renew_user_ids(user_ids: list) -> set:
+    """Те из user_ids, у кого включено автопродление."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        enabled = set()
+        for start in range(0, len(user_ids), 500):
+            batch = user_ids[start:start + 500]
+            cursor.execute(f'''
+            SELECT user_id FROM payment_methods
+            WHERE auto_renew = 1 AND user_id IN ({', '.join('?' * len(batch))})
+            ''', batch)
+            enabled.update(row[0] for row in cursor.fetchall())
+        return enabled
+    finally:
+        conn.close()
+
+def get_due_renewals(cutoff: str, retry_before: float, limit: int):
+    """Платные доступы с автопродлением, истекающие раньше cutoff, без попытки списания
+    после retry_before: (user_id, channel_id, plan_id, subscription_end, method_id,
+    failures, pending_payment_id), ближайшие к окончанию первыми."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT e.user_id, e.channel_id, e.plan_id, e.subscription_end, m.method_id, m.failures, m.pending_payment_id
+        FROM entitlements e JOIN payment_methods m ON m.user_id = e.user_id
+        WHERE e.active = 1 AND e.is_trial = 0 AND e.subscription_end < ? AND m.auto_renew = 1
+          AND (m.last_attempt_at IS NULL OR m.last_attempt_at < ?)
+        ORDER BY e.subscription_end
+        LIMIT ?
+        ''', (cutoff, retry_before, limit))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def record_renewal_attempt(user_id: int, status: str, payment_id: str = None, max_failures: int = 3) -> bool:
+    """Записывает попытку автопродления: pending — платеж еще обрабатывается, succeeded —
+    успех, error — ЮKassa не ответила (отказом не считается), иначе отказ. Возвращает True,
+    если этот отказ отключил автопродление."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            if status == 'pending':
+                cursor.execute('''
+                UPDATE payment_methods SET last_attempt_at = ?, pending_payment_id = ? WHERE user_id = ?
+                ''', (time.time(), payment_id, user_id))
+            elif status == 'succeeded':
+                cursor.execute('''
+                UPDATE payment_methods SET last_attempt_at = ?, pending_payment_id = NULL, failures = 0
+                WHERE user_id = ?
+                ''', (time.time(), user_id))
+            elif status == 'error':
+                # Число отказов не меняется, чтобы повтор пришел с тем же ключом идемпотентности
+                cursor.execute('UPDATE payment_methods SET last_attempt_at = ? WHERE user_id = ?',
+                               (time.time(), user_id))
+            else:
+                cursor.execute('''
+                UPDATE payment_methods SET last_attempt_at = ?, pending_payment_id = NULL,
+                    failures = failures + 1, auto_renew = CASE WHEN failures + 1 >= ? THEN 0 ELSE auto_renew END
+                WHERE user_id = ? AND auto_renew = 1
+                ''', (time.time(), max_failures, user_id))
+                updated = cursor.rowcount
+                cursor.execute('SELECT auto_renew FROM payment_methods WHERE user_id = ?', (user_id,))
+                row = cursor.fetchone()
+                conn.commit()
+                return bool(updated) and not row[0]
+            conn.commit()
+            return False
+        finally:
+            conn.close()
+
+def add_promo_code(code: str, percent: int = 0, bonus_days: int = 0, max_redemptions: int = None,
+                   expires_at: str = None) -> bool:
+    """Создает промокод; False — такой код уже есть."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT OR IGNORE INTO promo_codes (code, percent, bonus_days, max_redemptions, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (code, percent, bonus_days, max_redemptions, expires_at))
+            conn.commit()
+            return bool(cursor.rowcount)
+        finally:
+            conn.close()
+
+def get_promo_codes():
+    """Список (code, percent, bonus_days, max_redemptions, redemptions, expires_at)."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT code, percent, bonus_days, max_redemptions, redemptions, expires_at FROM promo_codes ORDER BY created_at
+        ''')
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_pending_discounts():
+    """(user_id, code) активированных, но еще не использованных скидок, от старых к новым."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT r.user_id, r.code FROM promo_redemptions r JOIN promo_codes c ON c.code = r.code
+        WHERE r.payment_id IS NULL AND c.percent > 0
+        ORDER BY r.created_at
+        ''')
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def redeem_promo_code(user_id: int, code: str, channel_id: int = None):
+    """Активирует промокод: (status, percent, bonus_days, subscription_end).
+
+    status — ok, not_found, expired, already (пользователь уже активировал код) или
+    exhausted (лимит активаций исчерпан). Счетчик увеличивается условным UPDATE в одной
+    транзакции с записью активации и начислением дней, поэтому лимит не превышается при
+    одновременных активациях из разных процессов."""
+    channel_id = channel_id or get_default_channel().channel_id
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT percent, bonus_days, expires_at FROM promo_codes WHERE code = ?', (code,))
+            promo = cursor.fetchone()
+            if not promo:
+                conn.rollback()
+                return 'not_found', 0, 0, None
+            percent, bonus_days, expires_at = promo
+            if expires_at and expires_at <= datetime.now().strftime(DATE_FORMAT):
+                conn.rollback()
+                return 'expired', percent, bonus_days, None
+            cursor.execute('INSERT OR IGNORE INTO promo_redemptions (code, user_id) VALUES (?, ?)', (code, user_id))
+            if not cursor.rowcount:
+                conn.rollback()
+                return 'already', percent, bonus_days, None
+            cursor.execute('''
+            UPDATE promo_codes SET redemptions = redemptions + 1
+            WHERE code = ? AND (max_redemptions IS NULL OR redemptions < max_redemptions)
+            ''', (code,))
+            if not cursor.rowcount:
+                conn.rollback()
+                return 'exhausted', percent, bonus_days, None
+            subscription_end = (_extend_entitlement(cursor, user_id, channel_id, bonus_days, 'promo')
+                                if bonus_days else None)
+            _bump(cursor, 'promo_redemptions')
+            conn.commit()
+            return 'ok', percent, bonus_days, subscription_end
+        finally:
+            conn.close()
+
+def add_referral(user_id: int, referrer_id: int) -> bool:
+    """Запоминает, кто пригласил нового пользователя; пригласивший должен быть в базе."""
+    if user_id == referrer_id:
+        return False
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT OR IGNORE INTO referrals (user_id, referrer_id)
+            SELECT ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)
+            ''', (user_id, referrer_id, referrer_id))
+            conn.commit()
+            return bool(cursor.rowcount)
+        finally:
+            conn.close()
+
+def count_referrals(referrer_id: int):
+    """(приглашено, из них оплатили) для пригласившего."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT COUNT(*), COALESCE(SUM(credited), 0) FROM referrals WHERE referrer_id = ?
+        ''', (referrer_id,))
+        return tuple(cursor.fetchone())
+    finally:
+        conn.close()
+
+def get_active_users():
+    """Возвращает (user_id, username) пользователей с активным доступом хотя бы к одному каналу."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT DISTINCT e.user_id, u.username FROM entitlements e
+        LEFT JOIN users u ON u.user_id = e.user_id
+        WHERE e.active = 1
+        ''')
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_active_users_page(after_user_id: int = None, before_user_id: int = None, limit: int = 50):
+    """Страница активных пользователей по возрастанию user_id (keyset-пагинация по первичному ключу
+    entitlements): после after_user_id или, если задан before_user_id, перед ним.
+
+    Унарный плюс в +e.active не дает планировщику выбрать индекс по active: иначе он читает
+    всех активных пользователей и сортирует их ради одной страницы."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if before_user_id is not None:
+            cursor.execute('''
+            SELECT e.user_id, u.username FROM entitlements e
+            LEFT JOIN users u ON u.user_id = e.user_id
+            WHERE +e.active = 1 AND e.user_id < ?
+            GROUP BY e.user_id ORDER BY e.user_id DESC LIMIT ?
+            ''', (before_user_id, limit))
+            return cursor.fetchall()[::-1]
+        cursor.execute('''
+        SELECT e.user_id, u.username FROM entitlements e
+        LEFT JOIN users u ON u.user_id = e.user_id
+        WHERE +e.active = 1 AND e.user_id > ?
+        GROUP BY e.user_id ORDER BY e.user_id LIMIT ?
+        ''', (after_user_id if after_user_id is not None else -1, limit))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def count_active_users() -> int:
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(DISTINCT user_id) FROM entitlements WHERE active = 1')
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+def record_member_status(user_id: int, channel_id: int, status: str, source: str):
+    """Запоминает статус пользователя в канале (source: 'event' или 'probe'); вход, выход
+    и бан записываются в журнал событий."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status FROM channel_members WHERE user_id = ? AND channel_id = ?',
+                           (user_id, channel_id))
+            previous = cursor.fetchone()
+            kind = event_log.member_event(previous and previous[0], status)
+            if kind:
+                _append_event(cursor, user_id, channel_id, kind, {'source': source})
+            cursor.execute('''
+            INSERT INTO channel_members (user_id, channel_id, status, source, updated_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT(user_id, channel_id) DO UPDATE SET
+                status = excluded.status,
+                source = excluded.source,
+                updated_at = excluded.updated_at
+            ''', (user_id, channel_id, status, source))
+            conn.commit()
+        finally:
+            conn.close()
+
+def resolve_users(user_ids: list, usernames: list) -> tuple:
+    """({user_id: username} найденных пользователей, [не найденные user_id и имена])."""
+    found, matched_names = {}, set()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            cursor.execute(f'''
+            SELECT user_id, username FROM users WHERE user_id IN ({', '.join('?' for _ in chunk)})
+            ''', chunk)
+            found.update(cursor.fetchall())
+        for start in range(0, len(usernames), 500):
+            chunk = usernames[start:start + 500]
+            # При повторе имени берется аккаунт, пришедший последним
+            cursor.execute(f'''
+            SELECT user_id, username FROM users WHERE lower(username) IN ({', '.join('?' for _ in chunk)})
+            ORDER BY join_date
+            ''', chunk)
+            by_name = {username.lower(): (user_id, username) for user_id, username in cursor.fetchall()}
+            for name, (user_id, username) in by_name.items():
+                found[user_id] = username
+                matched_names.add(name)
+        missing = [user_id for user_id in user_ids if user_id not in found]
+        missing += [f"@{name}" for name in usernames if name not in matched_names]
+        return found, missing
+    finally:
+        conn.close()
+
+def bulk_update_access(action: str, user_ids: list, channel_id: int, days: int, batch_id: str) -> list:
+    """Массовая операция админа (bulk_access.py) одной транзакцией; возвращает изменения
+    [(user_id, subscription_end, is_trial, active, прежнее состояние)]. Сообщения пользователям
+    ставятся в outbox в той же транзакции."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            current = {}
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                cursor.execute(f'''
+                SELECT user_id, plan_id, subscription_end, is_trial, active FROM entitlements
+                WHERE channel_id = ? AND user_id IN ({', '.join('?' for _ in chunk)})
+                ''', [channel_id, *chunk])
+                current.update((row[0], row[1:]) for row in cursor.fetchall())
+            changes = bulk_access.plan_changes(action, user_ids, current, days, datetime.now())
+            if action == 'revoke':
+                cursor.executemany('''
+                UPDATE entitlements SET active = 0, updated_at = datetime('now') WHERE user_id = ? AND channel_id = ?
+                ''', [(change[0], channel_id) for change in changes])
+            else:
+                cursor.executemany('''
+                INSERT INTO entitlements (user_id, channel_id, plan_id, subscription_end, is_trial, active, updated_at)
+                VALUES (?, ?, NULL, ?, ?, 1, datetime('now'))
+                ON CONFLICT(user_id, channel_id) DO UPDATE SET
+                    subscription_end = excluded.subscription_end,
+                    is_trial = excluded.is_trial,
+                    active = 1,
+                    updated_at = excluded.updated_at
+                ''', [(user_id, channel_id, end, int(is_trial)) for user_id, end, is_trial, active, previous in changes])
+            if channel_id == get_default_channel().channel_id:
+                cursor.executemany('UPDATE users SET active = ?, subscription_end = ? WHERE user_id = ?',
+                                   [(int(active), end, user_id) for user_id, end, is_trial, active, previous in changes])
+            for name, delta in bulk_access.counter_deltas(changes).items():
+                _bump(cursor, name, delta)
+            cursor.executemany('INSERT INTO events (user_id, channel_id, kind, payload) VALUES (?, ?, ?, ?)', [
+                (change[0], channel_id, kind, json.dumps(payload))
+                for change, (kind, payload) in zip(changes, bulk_access.event_entries(action, changes, days))])
+            _enqueue(cursor, bulk_access.outbox_entries(action, changes, channel_id, days, batch_id))
+            conn.commit()
+            return changes
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+def get_outbox_progress(prefix: str) -> dict:
+    """{статус: сообщений} outbox с ключом дедупликации, начинающимся с prefix."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT status, COUNT(*) FROM outbox WHERE dedup_key >= ? AND dedup_key < ? GROUP BY status
+        ''', (prefix, prefix + '\uffff'))
+        return dict(cursor.fetchall())
+    finally:
+        conn.close()
+
+def get_events(after_id: int = 0, limit: int = 1000):
+    """События журнала с номером больше after_id по возрастанию:
+    [(id, user_id, channel_id, kind, payload, created_at)]."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id, user_id, channel_id, kind, payload, created_at FROM events WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, limit))
+        return [(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5]) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_user_events(user_id: int, after_id: int = 0):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id, user_id, channel_id, kind, payload, created_at FROM events
+        WHERE user_id = ? AND id > ? ORDER BY id
+        ''', (user_id, after_id))
+        return [(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5]) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_event_snapshots(keys: list) -> dict:
+    """{(user_id, channel_id): (state, event_id)} для пар keys."""
+    result = {}
+    keys = list(keys)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        for start in range(0, len(keys), 400):
+            chunk = keys[start:start + 400]
+            cursor.execute(f'''
+            SELECT user_id, channel_id, state, event_id FROM event_snapshots
+            WHERE (user_id, channel_id) IN ({', '.join('(?, ?)' for _ in chunk)})
+            ''', [value for key in chunk for value in key])
+            for user_id, channel_id, state, event_id in cursor.fetchall():
+                result[(user_id, channel_id)] = (json.loads(state), event_id)
+        return result
+    finally:
+        conn.close()
+
+def get_user_snapshots(user_id: int) -> dict:
+    """{channel_id: (state, event_id)} снимков пользователя."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT channel_id, state, event_id FROM event_snapshots WHERE user_id = ?', (user_id,))
+        return {channel_id: (json.loads(state), event_id) for channel_id, state, event_id in cursor.fetchall()}
+    finally:
+        conn.close()
+
+def get_snapshot_position() -> int:
+    """Номер последнего события, учтенного снимками."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(event_id), 0) FROM event_snapshots')
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+def save_event_snapshots(rows: list):
+    """Записывает снимки (user_id, channel_id, state, event_id)."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.executemany('''
+            INSERT INTO event_snapshots (user_id, channel_id, state, event_id) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, channel_id) DO UPDATE SET state = excluded.state, event_id = excluded.event_id
+            ''', [(user_id, channel_id, json.dumps(state), event_id) for user_id, channel_id, state, event_id in rows])
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_reconcile_candidates(channel_id: int, expired_after: str, full: bool = False):
+    """Пользователи канала с активным или недавно истекшим доступом, чей статус в канале
+    неизвестен или записан раньше последнего изменения доступа. full=True — все такие пользователи."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT e.user_id FROM entitlements e
+        LEFT JOIN channel_members m ON m.user_id = e.user_id AND m.channel_id = e.channel_id
+        WHERE e.channel_id = ? AND (e.active = 1 OR e.subscription_end > ?)
+          AND (? OR m.user_id IS NULL OR m.updated_at <= e.updated_at)
+        ORDER BY e.user_id
+        ''', (channel_id, expired_after, int(full)))
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def get_member_changes(since: str):
+    """(user_id, channel_id) участников, чей статус в канале записан не раньше since."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, channel_id FROM channel_members WHERE updated_at >= ?', (since,))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_entitlement_changes(since: str):
+    """Доступы (user_id, channel_id, plan_id, subscription_end, is_trial, active), измененные не раньше since."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT user_id, channel_id, plan_id, subscription_end, is_trial, active FROM entitlements
+        WHERE updated_at >= ?
+        ''', (since,))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_membership_diff(channel_id: int, now: str):
+    """Расхождения базы и канала: (в канале без доступа, с доступом вне канала).
+
+    Каждый список — (user_id, username, status). Администраторы канала не учитываются.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT m.user_id, u.username, m.status FROM channel_members m
+        LEFT JOIN entitlements e ON e.user_id = m.user_id AND e.channel_id = m.channel_id
+        LEFT JOIN users u ON u.user_id = m.user_id
+        WHERE m.channel_id = ? AND m.status IN ('member', 'restricted')
+          AND (e.user_id IS NULL OR e.active = 0 OR e.subscription_end <= ?)
+        ORDER BY m.user_id
+        ''', (channel_id, now))
+        without_access = cursor.fetchall()
+        cursor.execute('''
+        SELECT e.user_id, u.username, m.status FROM entitlements e
+        JOIN channel_members m ON m.user_id = e.user_id AND m.channel_id = e.channel_id
+        LEFT JOIN users u ON u.user_id = e.user_id
+        WHERE e.channel_id = ? AND e.active = 1 AND e.subscription_end > ?
+          AND m.status IN ('left', 'kicked')
+        ORDER BY e.user_id
+        ''', (channel_id, now))
+        return without_access, cursor.fetchall()
+    finally:
+        conn.close()
+
+def get_stats(days: int = 7, months: int = 6):
+    """Статистика из агрегатов: (счетчики, [(день, метрика, значение)], [(месяц, метрика, значение)])."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, value FROM stats_counters')
+        counters = dict(cursor.fetchall())
+        cursor.execute('''
+        SELECT period, metric, value FROM stats_periods
+        WHERE period >= date('now', ?) AND length(period) = 10
+        ORDER BY period
+        ''', (f'-{days - 1} days',))
+        daily = cursor.fetchall()
+        cursor.execute('''
+        SELECT period, metric, value FROM stats_periods
+        WHERE period >= strftime('%Y-%m', 'now', 'start of month', ?) AND length(period) = 7
+        ORDER BY period
+        ''', (f'-{months - 1} months',))
+        return counters, daily, cursor.fetchall()
+    finally:
+        conn.close()
+
+def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    """Берет или продлевает аренду name для owner. Возвращает True, если аренда у owner."""
+    now = time.time()
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+            INSERT OR IGNORE INTO job_state (name, owner, lease_until) VALUES (?, NULL, 0)
+            ''', (name,))
+            cursor.execute('''
+            UPDATE job_state SET owner = ?, lease_until = ?
+            WHERE name = ? AND (owner = ? OR owner IS NULL OR lease_until < ?)
+            ''', (owner, now + ttl, name, owner, now))
+            acquired = cursor.rowcount > 0
+            conn.commit()
+            return acquired
+        finally:
+            conn.close()
+
+def release_lease(name: str, owner: str):
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+            UPDATE job_state SET owner = NULL, lease_until = 0 WHERE name = ? AND owner = ?
+            ''', (name, owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_job_last_run(name: str):
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT last_run FROM job_state WHERE name = ?', (name,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    finally:
+        conn.close()
+
+def set_job_last_run(name: str, timestamp: float):
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+            INSERT INTO job_state (name, last_run) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET last_run = excluded.last_run
+            ''', (name, timestamp))
+            conn.commit()
+        finally:
+            conn.close()
+
+def _enqueue(cursor, entries):
+    """Добавляет сообщения (chat_id, kind, payload, dedup_key) в outbox; дубли по dedup_key пропускаются."""
+    cursor.executemany('''
+    INSERT OR IGNORE INTO outbox (chat_id, kind, payload, dedup_key) VALUES (?, ?, ?, ?)
+    ''', [(chat_id, kind, json.dumps(payload), dedup_key) for chat_id, kind, payload, dedup_key in entries])
+
+def enqueue_outbox(entries: list):
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            _enqueue(conn.cursor(), entries)
+            conn.commit()
+        finally:
+            conn.close()
+
+def claim_outbox(limit: int, lease: float):
+    """Забирает до limit готовых к отправке сообщений на lease секунд:
+    [(id, chat_id, kind, payload, attempts)]. Незавершенные после lease вернутся в очередь."""
+    now = time.time()
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+            SELECT id, chat_id, kind, payload, attempts FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ? AND locked_until <= ?
+            ORDER BY id LIMIT ?
+            ''', (now, now, limit))
+            rows = cursor.fetchall()
+            cursor.executemany('UPDATE outbox SET locked_until = ? WHERE id = ?',
+                               [(now + lease, row[0]) for row in rows])
+            conn.commit()
+            return [(id, chat_id, kind, json.loads(payload), attempts)
+                    for id, chat_id, kind, payload, attempts in rows]
+        finally:
+            conn.close()
+
+def complete_outbox(outbox_id: int):
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute("UPDATE outbox SET status = 'sent', locked_until = 0 WHERE id = ?", (outbox_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+def fail_outbox(outbox_id: int, error: str, retry_at: float = None):
+    """Неудачная попытка: повтор не раньше retry_at или, если retry_at=None, в dead-letter."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+            UPDATE outbox SET attempts = attempts + 1, last_error = ?, locked_until = 0,
+                status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END,
+                next_attempt_at = COALESCE(?, next_attempt_at)
+            WHERE id = ?
+            ''', (error, retry_at, retry_at, outbox_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+# --- Хранение и сжатие ---
+
+def purge_payments(before: str, limit: int) -> dict:
+    """Удаляет до limit неоплаченных платежей (pending, canceled) с датой раньше before (UTC);
+    возвращает {статус: удалено}. Платеж, ожидающий автопродления, не удаляется."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT payment_id, status FROM payments
+            WHERE status IN ('pending', 'canceled') AND date < ?
+              AND payment_id NOT IN (SELECT pending_payment_id FROM payment_methods
+                                     WHERE pending_payment_id IS NOT NULL)
+            LIMIT ?
+            ''', (before, limit))
+            rows = cursor.fetchall()
+            cursor.executemany('DELETE FROM payments WHERE payment_id = ?', [(row[0],) for row in rows])
+            counts = {}
+            for payment_id, status in rows:
+                counts[status] = counts.get(status, 0) + 1
+            for status, count in counts.items():
+                _bump(cursor, f'payments_{status}', -count)
+            if rows:
+                _bump(cursor, 'purged_payments', len(rows))
+            conn.commit()
+            return counts
+        finally:
+            conn.close()
+
+def purge_outbox(before: str, limit: int) -> int:
+    """Удаляет до limit доставленных и dead-letter сообщений, созданных раньше before (UTC)."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+            DELETE FROM outbox WHERE id IN (
+                SELECT id FROM outbox WHERE status IN ('sent', 'dead') AND created_at < ? LIMIT ?
+            )
+            ''', (before, limit))
+            deleted = cursor.rowcount
+            if deleted:
+                _bump(cursor, 'purged_outbox', deleted)
+            conn.commit()
+            return deleted
+        finally:
+            conn.close()
+
+def compact(vacuum_ratio: float) -> dict:
+    """Сжимает базу: VACUUM, если свободных страниц не меньше доли vacuum_ratio, и перенос
+    WAL в файл базы с обрезкой WAL до нуля. VACUUM блокирует запись на все время работы,
+    поэтому вызывается в тихие часы."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            pages = conn.execute('PRAGMA page_count').fetchone()[0]
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            vacuumed = bool(pages) and free_pages / pages >= vacuum_ratio
+            if vacuumed:
+                conn.execute('VACUUM')
+            conn.execute('PRAGMA optimize')
+            busy = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[0]
+            return {'size_before': pages * page_size,
+                    'size_after': conn.execute('PRAGMA page_count').fetchone()[0] * page_size,
+                    'vacuumed': vacuumed, 'wal_truncated': not busy}
+        finally:
+            conn.close()
+
+def get_job_checkpoint(name: str):
+    """Сохраненный прогресс задачи name (словарь) или None, если задача не прерывалась."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT checkpoint FROM job_state WHERE name = ?', (name,))
+        result = cursor.fetchone()
+        return json.loads(result[0]) if result and result[0] else None
+    finally:
+        conn.close()
+
+def set_job_checkpoint(name: str, checkpoint: dict = None):
+    """Сохраняет прогресс задачи; None — задача завершена, прогресс сбрасывается."""
+    with db_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('''
+            INSERT INTO job_state (name, checkpoint) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET checkpoint = excluded.checkpoint
+            ''', (name, json.dumps(checkpoint) if checkpoint is not None else None))
+            conn.commit()
+        finally:
+            conn.close()
+
 if __name__ == "__main__":
     init_db()
\ No newline at end of file
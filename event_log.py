@@ -0,0 +1,96 @@
+"""Журнал событий подписки и проекция состояния из него.
+
+Каждое изменение доступа записывается в таблицу events в той же транзакции, что и само
+изменение (database.py, storage_postgres.py):
+    * trial_started — выдан пробный период;
+    * payment_succeeded — оплата продлила доступ;
+    * extended — дни доступа без оплаты (reason: promo, referral, admin);
+    * expired — доступ отключен после окончания;
+    * revoked — доступ отозван админом (bulk_access.py);
+    * joined, rejoined, left, banned — вход, повторный вход, выход и бан в канале.
+События доступа несут его состояние после изменения, поэтому повторное применение
+события ничего не меняет.
+
+apply сворачивает события в состояние пары (user_id, channel_id): те же поля, что в
+entitlements, и статус в канале. Чтобы не читать журнал с начала, bot.snapshot_events
+сохраняет свернутые состояния в event_snapshots с номером последнего учтенного события,
+и replay начинает со снимка. Потребители журнала (аналитика, кэши) читают его по
+возрастанию номера (Storage.get_events) и сами помнят номер последнего прочитанного.
+"""
+from typing import Optional
+
+ACCESS_EVENTS = ('trial_started', 'payment_succeeded', 'extended', 'expired', 'revoked')
+MEMBER_EVENTS = ('joined', 'rejoined', 'left', 'banned')
+# Статусы chat_member, при которых пользователь в канале
+IN_CHANNEL = ('member', 'administrator', 'creator', 'restricted')
+
+
+def empty_state() -> dict:
+    return {'plan_id': None, 'subscription_end': None, 'is_trial': False, 'active': False, 'paid': False,
+            'member': None}
+
+
+def apply(state: Optional[dict], kind: str, payload: dict) -> dict:
+    """Новое состояние после события; state не изменяется."""
+    state = dict(state or empty_state())
+    if kind == 'trial_started':
+        state.update(subscription_end=payload['subscription_end'], is_trial=True, active=True)
+    elif kind == 'payment_succeeded':
+        state.update(plan_id=payload.get('plan_id'), subscription_end=payload['subscription_end'],
+                     is_trial=False, active=True, paid=True)
+    elif kind == 'extended':
+        state.update(subscription_end=payload['subscription_end'], is_trial=bool(payload.get('is_trial')),
+                     active=True)
+    elif kind in ('expired', 'revoked'):
+        state['active'] = False
+    elif kind in ('joined', 'rejoined'):
+        state['member'] = 'member'
+    elif kind == 'left':
+        state['member'] = 'left'
+    elif kind == 'banned':
+        state['member'] = 'kicked'
+    return state
+
+
+def fold(snapshots: dict, events: list) -> dict:
+    """Состояния {(user_id, channel_id): state} пар, затронутых снимками и событиями.
+
+    snapshots — {(user_id, channel_id): (state, event_id)}, events — события
+    (id, user_id, channel_id, kind, payload, created_at) по возрастанию id; события,
+    уже учтенные снимком пары, пропускаются."""
+    states = {key: state for key, (state, event_id) in snapshots.items()}
+    for event_id, user_id, channel_id, kind, payload, created_at in events:
+        key = (user_id, channel_id)
+        snapshot = snapshots.get(key)
+        if snapshot and event_id <= snapshot[1]:
+            continue
+        states[key] = apply(states.get(key), kind, payload)
+    return states
+
+
+def replay(user_id: int, snapshots: dict, events: list) -> dict:
+    """Состояния {channel_id: state} одного пользователя по его снимкам {channel_id: (state, event_id)}
+    и событиям."""
+    states = fold({(user_id, channel_id): snapshot for channel_id, snapshot in snapshots.items()}, events)
+    return {channel_id: state for (_, channel_id), state in states.items()}
+
+
+def member_event(previous: Optional[str], status: str) -> Optional[str]:
+    """Событие при смене статуса в канале previous -> status или None, если это не вход/выход/бан."""
+    was_in = previous in IN_CHANNEL
+    if status in IN_CHANNEL and not was_in:
+        return 'rejoined' if previous in ('left', 'kicked') else 'joined'
+    if status == 'kicked' and previous != 'kicked':
+        return 'banned'
+    if status == 'left' and was_in:
+        return 'left'
+    return None
+
+
+def differences(state: dict, entitlement: Optional[tuple]) -> list:
+    """Поля, в которых проекция расходится с entitlements (plan_id, subscription_end, is_trial, active)."""
+    if entitlement is None:
+        return [] if state['subscription_end'] is None else ['entitlement']
+    plan_id, subscription_end, is_trial, active = entitlement
+    stored = {'subscription_end': subscription_end, 'is_trial': bool(is_trial), 'active': bool(active)}
+    return [field for field, value in stored.items() if state[field] != value]
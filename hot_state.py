@@ -0,0 +1,146 @@
+"""Горячее состояние в памяти и его снимок на диске для быстрого старта.
+
+Самое дорогое в обработчиках — внешние вызовы: каждый /start и каждое напоминание
+создавали новый платеж в ЮKassa и новую ссылку-приглашение в Bot API. Здесь
+хранятся недавние ссылки на оплату (пока платеж в статусе pending) и действующие
+приглашения, чтобы выдавать их повторно. При остановке состояние сохраняется в
+SNAPSHOT_FILE, при запуске загружается и сверяется с базой (bot.load_hot_state),
+поэтому после деплоя первые запросы не ждут ЮKassa и Bot API.
+
+Участники каналов здесь не кэшируются, а доступы к каналам — в отдельном индексе
+(user_index.py), который сверяется с базой по entitlements.updated_at.
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Ссылка на оплату выдается повторно, пока платеж моложе PAYMENT_LINK_TTL секунд,
+# приглашение — пока до его истечения больше INVITE_LINK_MIN_LIFETIME секунд
+PAYMENT_LINK_TTL = 900
+INVITE_LINK_MIN_LIFETIME = 12 * 3600
+
+# (user_id, plan_id) -> (payment_id, url, created_at)
+_payment_links = {}
+# (user_id, channel_id) -> (invite_link, expire_date)
+_invite_links = {}
+_dirty = False
+
+
+def get_payment_link(user_id: int, plan_id: str) -> Optional[tuple]:
+    """(url, payment_id) недавнего неоплаченного платежа или None."""
+    entry = _payment_links.get((user_id, plan_id))
+    if not entry or time.time() - entry[2] >= PAYMENT_LINK_TTL:
+        return None
+    return entry[1], entry[0]
+
+
+def put_payment_link(user_id: int, plan_id: str, payment_id: str, url: str):
+    global _dirty
+    _payment_links[(user_id, plan_id)] = (payment_id, url, time.time())
+    _dirty = True
+
+
+def drop_payment_links(user_id: int):
+    """Платеж пользователя оплачен или отменен: следующая ссылка создается заново."""
+    global _dirty
+    for key in [key for key in _payment_links if key[0] == user_id]:
+        del _payment_links[key]
+        _dirty = True
+
+
+def get_invite_link(user_id: int, channel_id: int) -> Optional[str]:
+    entry = _invite_links.get((user_id, channel_id))
+    if not entry or entry[1] - time.time() <= INVITE_LINK_MIN_LIFETIME:
+        return None
+    return entry[0]
+
+
+def put_invite_link(user_id: int, channel_id: int, invite_link: str, expire_date: float):
+    global _dirty
+    _invite_links[(user_id, channel_id)] = (invite_link, expire_date)
+    _dirty = True
+
+
+def drop_invite_link(user_id: int, channel_id: int):
+    """Статус пользователя в канале изменился: одноразовое приглашение могло быть использовано."""
+    global _dirty
+    if _invite_links.pop((user_id, channel_id), None):
+        _dirty = True
+
+
+def clear():
+    global _dirty
+    _payment_links.clear()
+    _invite_links.clear()
+    _dirty = False
+
+
+def is_dirty() -> bool:
+    return _dirty
+
+
+def size() -> dict:
+    return {'payment_links': len(_payment_links), 'invite_links': len(_invite_links)}
+
+
+def save_snapshot(path: str):
+    """Атомарно записывает непросроченное состояние в path."""
+    global _dirty
+    now = time.time()
+    data = {
+        'version': SNAPSHOT_VERSION,
+        # Метка по часам базы (UTC, как CURRENT_TIMESTAMP): изменения в базе позже нее
+        # делают недействительными сохраненные приглашения
+        'saved_at': datetime.utcnow().strftime(DATE_FORMAT),
+        'payment_links': [[user_id, plan_id, *entry] for (user_id, plan_id), entry in _payment_links.items()
+                          if now - entry[2] < PAYMENT_LINK_TTL],
+        'invite_links': [[user_id, channel_id, *entry] for (user_id, channel_id), entry in _invite_links.items()
+                         if entry[1] - now > INVITE_LINK_MIN_LIFETIME],
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.hot_state-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    _dirty = False
+
+
+def read_snapshot(path: str) -> Optional[dict]:
+    """Читает снимок без просроченных записей. None — снимка нет или он неполный."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+    if data.get('version') != SNAPSHOT_VERSION:
+        logger.info(f"Ignoring snapshot {path} of version {data.get('version')}")
+        return None
+    now = time.time()
+    data['payment_links'] = [row for row in data['payment_links'] if now - row[4] < PAYMENT_LINK_TTL]
+    data['invite_links'] = [row for row in data['invite_links'] if row[3] - now > INVITE_LINK_MIN_LIFETIME]
+    return data
+
+
+def restore(payment_links: list, invite_links: list):
+    """Заполняет состояние проверенными строками снимка."""
+    global _dirty
+    for user_id, plan_id, payment_id, url, created_at in payment_links:
+        _payment_links[(user_id, plan_id)] = (payment_id, url, created_at)
+    for user_id, channel_id, invite_link, expire_date in invite_links:
+        _invite_links[(user_id, channel_id)] = (invite_link, expire_date)
+    _dirty = False
@@ -0,0 +1,284 @@
+"""Тексты сообщений пользователям и статические кнопки.
+
+Шаблоны разбираются и проверяются один раз при загрузке, обработчики только
+подставляют значения полей. Встроенные тексты — русские (язык по умолчанию);
+их можно переопределить или добавить переводы в JSON-файле MESSAGES_FILE
+(по умолчанию messages.json):
+
+    {"ru": {"btn_help": "❓ Помощь"}, "en": {"btn_help": "❓ Help", ...}}
+
+Файл перечитывается при изменении (reload_if_changed), ошибка в новом файле
+не ломает уже загруженные тексты. Ключи, которых нет в переводе, берутся из
+языка по умолчанию.
+"""
+import json
+import logging
+import os
+from string import Formatter
+from typing import NamedTuple, Optional
+
+from telegram import InlineKeyboardButton
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANG = os.getenv('MESSAGES_LANG', 'ru')
+
+DEFAULTS = {
+    # /start
+    'start_welcome': (
+        "✨ <b>Добро пожаловать в Happy Face Club</b> ✨\n\n"
+        "🌿 Это место, где ты можешь быть собой.\n"
+        "Здесь вы найдёте простые, но мощные инструменты для улучшения самочувствия и красоты\n\n"
+        "💆‍♀️ Массаж и телесные практики\n"
+        "🥗 Вкусные и полезные рецепты\n"
+        "🫶 Поддержку комьюнити\n\n"
+    ),
+    'start_paid': (
+        "⭐️ <b>Ваша подписка активна</b>\n"
+        "Тип: Платная\n"
+        "Осталось дней: {days_left}\n"
+        "Завершается: {end_date}\n\n"
+        "Вы можете продлить подписку, оплатив еще один месяц.\n\n"
+    ),
+    'start_trial': "✨ <b>У тебя есть {days_left} дней бесплатного доступа</b> - почувствуй, как тебе здесь.\n\n",
+    'start_links_paid': (
+        "🔗 Ссылка в группу: {invite_link}\n"
+        "💬 Чат сообщества: {chat_link}\n\n"
+        "💳 Продлить подписку: {price} руб/месяц"
+    ),
+    'start_links_trial': (
+        "🔗 Ссылка в группу: {invite_link}\n"
+        "💬 Чат сообщества: {chat_link}\n\n"
+        "💳 Оплатить подписку: {price} руб/месяц"
+    ),
+    'start_other_channel': "\n🔗 {title}: {invite_link}",
+    'start_no_subscription': (
+        "🔒 Для доступа к материалам требуется подписка\n\n"
+        "💳 Стоимость: {price} руб/месяц"
+    ),
+    'trial_denied': "\n\nℹ️ Пробный период уже был использован с другого аккаунта.",
+    # /check и /rejoin
+    'subscription_active': (
+        "✅ <b>Ваша подписка активна</b>\n\n"
+        "{channel_line}"
+        "Тип: {sub_type}\n"
+        "Осталось дней: {days_left}\n"
+        "Завершается: {end_date}\n\n"
+        "🔗 Новая ссылка в группу: {invite_link}"
+    ),
+    'channel_line': "Группа: {title}\n",
+    'sub_type_paid': "Платная",
+    'sub_type_trial': "Пробный период",
+    'expired_check': (
+        "❌ <b>Ваша подписка истекла</b>\n\n"
+        "Для продолжения доступа, пожалуйста, продлите подписку.\n"
+        "💳 Стоимость: {price} руб/месяц"
+    ),
+    'expired_rejoin': (
+        "❌ <b>Ваша подписка истекла</b>\n\n"
+        "Для возвращения в группу, пожалуйста, продлите подписку.\n"
+        "💳 Стоимость: {price} руб/месяц"
+    ),
+    'already_member': "✅ Вы уже состоите в группе. Новая ссылка не требуется.",
+    'already_member_channel': "✅ Вы уже состоите в группе {title}. Новая ссылка не требуется.",
+    # Плановая проверка подписок
+    'reminder': (
+        "⚠️ <b>Ваша подписка заканчивается через {days_left} день(дня)!</b>\n\n"
+        "Пожалуйста, продлите подписку, чтобы продолжить доступ в группе {title}.\n"
+        "💳 Стоимость: {price}"
+    ),
+    'expired_removed': (
+        "❌ <b>Ваша подписка истекла</b>\n\n"
+        "Вы были исключены из группы {title}.\n"
+        "Для продолжения доступа, пожалуйста, продлите подписку.\n"
+        "💳 Стоимость: {price}"
+    ),
+    # Автопродление
+    'auto_renewed': (
+        "🔁 <b>Подписка продлена автоматически</b>\n\n"
+        "Группа: {title}\n"
+        "Списано: {price}\n"
+        "Доступ до: {end_date}\n\n"
+        "Отключить автопродление: /autorenew"
+    ),
+    'auto_renew_failed': (
+        "⚠️ <b>Не удалось продлить подписку автоматически</b>\n\n"
+        "Списание с сохраненной карты не прошло, автопродление отключено.\n"
+        "Продлите подписку на группу {title} вручную.\n"
+        "💳 Стоимость: {price}"
+    ),
+    'auto_renew_on': "🔁 Автопродление включено ({method}). Оплата списывается за сутки до окончания подписки.",
+    'auto_renew_off': "⏸ Автопродление отключено. Способ оплаты {method} сохранен, включить можно в любой момент.",
+    'auto_renew_none': "ℹ️ Автопродление включается при оплате подписки: способ оплаты сохраняется после первого платежа.",
+    'auto_renew_note': "\n\n🔁 Включено автопродление, отключить — /autorenew",
+    # Промокоды и приглашения
+    'promo_usage': "🎟 Отправьте промокод командой /promo КОД",
+    'promo_discount': "🎟 Промокод {code} активирован: скидка {percent}% на следующую оплату.\n💳 Стоимость: {price} руб",
+    'promo_days': "🎁 Промокод {code} активирован: +{days} дн. доступа, подписка до {end_date}.",
+    'promo_not_found': "⚠️ Промокод не найден. Проверьте, правильно ли он введен.",
+    'promo_expired': "⚠️ Срок действия промокода истек.",
+    'promo_exhausted': "⚠️ Промокод больше не действует: все активации использованы.",
+    'promo_already': "ℹ️ Вы уже активировали этот промокод.",
+    'referral_info': (
+        "🤝 <b>Приглашайте друзей</b>\n\n"
+        "Когда приглашенный оплатит подписку, вы получите +{days} дн. доступа.\n"
+        "Ваша ссылка: {link}\n\n"
+        "Приглашено: {invited}, оплатили: {credited}"
+    ),
+    'referral_off': "ℹ️ Реферальная программа сейчас не действует.",
+    'referral_credited': "🎁 Приглашенный вами друг оплатил подписку: +{days} дн. доступа, подписка до {end_date}.",
+    # Массовые операции админа
+    'access_granted': "🎁 Вам открыт доступ к группе {title} до {end_date}.\n🔗 Ссылка: {invite_link}",
+    'access_revoked': "❌ Доступ к группе {title} отозван администратором.",
+    # Вход в канал
+    'join_no_subscription': "❌ У вас нет активной подписки. Пожалуйста, оформите подписку с помощью /start.",
+    'join_welcome': (
+        "Добро пожаловать в Happy Face Club! 🌿\n\n"
+        "Рада знать, что ты хочешь позаботиться о своём теле и душе✨\n"
+        "Ты присоединилась только что, и поэтому пока не видишь контента — это нормально!\n"
+        "Контент в клубе виден только с момента твоего вступления, всё, что было раньше — остаётся закрытым.\n\n"
+        "Но не переживай: каждый день мы добавляем новые практики, и ты скоро всё увидишь и почувствуешь!\n\n"
+        "Тип подписки: {sub_type}\n"
+        "Осталось дней: {days_left}\n"
+        "Завершается: {end_date}\n\n"
+        "Если возникнут вопросы, ты можешь задать их в нашем чате: {chat_link}\n\n"
+        "С любовью ДАША HAPPY FACE ❤️"
+    ),
+    'join_sub_type_paid': "Платная",
+    'join_sub_type_trial': "Пробный период",
+    # Ошибки
+    'error_invite_link': "⚠️ Ошибка создания ссылки",
+    'error_payment': "⚠️ Ошибка при создании платежа. Пожалуйста, попробуйте позже.",
+    'error_generic': "⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
+    'payment_unavailable': "⏳ Оплата временно недоступна. Нажмите «Повторить оплату» через пару минут.",
+    # Кнопки
+    'btn_go_to_group': "🔐 Перейти в группу",
+    'btn_community_chat': "💬 Чат сообщества",
+    'btn_pay': "💳 Оплатить/продлить подписку",
+    'btn_extend': "💳 Продлить подписку",
+    'btn_check': "🔍 Проверить подписку",
+    'btn_rejoin': "🔄 Вернуться в группу",
+    'btn_payment_status': "💸 Статус платежа",
+    'btn_help': "❓ Помощь",
+    'btn_plans': "🗂 Все тарифы и группы",
+    'btn_payment_retry': "🔄 Повторить оплату",
+    'btn_auto_renew_off': "⏸ Отключить автопродление",
+    'btn_auto_renew_on': "🔁 Включить автопродление",
+}
+
+# Ряды кнопок с callback_data, которые не зависят от пользователя: (ключ текста, callback_data)
+STATIC_ROWS = {
+    'check_rejoin': (('btn_check', 'check'), ('btn_rejoin', 'rejoin')),
+    'payment_help': (('btn_payment_status', 'check_payment'), ('btn_help', 'help')),
+    'plans': (('btn_plans', 'plans'),),
+    'help': (('btn_help', 'help'),),
+}
+
+
+class Template(NamedTuple):
+    text: str
+    fields: frozenset
+
+
+def compile_template(text: str) -> Template:
+    """Разбирает шаблон str.format и запоминает имена полей (ошибка синтаксиса — ValueError)."""
+    fields = set()
+    for literal, field, format_spec, conversion in Formatter().parse(text):
+        if field is not None:
+            if not field or not field.isidentifier():
+                raise ValueError(f"Only named fields are allowed, got {{{field}}}")
+            fields.add(field)
+    return Template(text, frozenset(fields))
+
+
+_DEFAULT_TEMPLATES = {key: compile_template(text) for key, text in DEFAULTS.items()}
+_templates = {DEFAULT_LANG: dict(_DEFAULT_TEMPLATES)}
+_rows = {}
+_loaded_mtime = None
+
+
+def _validate(lang: str, items: dict) -> dict:
+    compiled = {}
+    for key, text in items.items():
+        if key not in _DEFAULT_TEMPLATES:
+            logger.warning(f"Unknown message key {key} in language {lang}, ignored")
+            continue
+        template = compile_template(text)
+        extra = template.fields - _DEFAULT_TEMPLATES[key].fields
+        if extra:
+            raise ValueError(f"Message {lang}.{key} uses unknown fields: {', '.join(sorted(extra))}")
+        compiled[key] = template
+    return compiled
+
+
+def load_messages(path: Optional[str] = None):
+    """Загружает тексты (встроенные + MESSAGES_FILE) и проверяет шаблоны.
+    При ошибке выбрасывает исключение и оставляет прежние тексты."""
+    global _templates, _rows, _loaded_mtime
+    path = path or os.getenv('MESSAGES_FILE', 'messages.json')
+    templates = {DEFAULT_LANG: dict(_DEFAULT_TEMPLATES)}
+    mtime = None
+    if os.path.exists(path):
+        mtime = os.path.getmtime(path)
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        templates[DEFAULT_LANG].update(_validate(DEFAULT_LANG, config.get(DEFAULT_LANG, {})))
+        for lang, items in config.items():
+            if lang != DEFAULT_LANG:
+                templates[lang] = {**templates[DEFAULT_LANG], **_validate(lang, items)}
+    _templates = templates
+    _rows = {}
+    _loaded_mtime = mtime
+
+
+def reload_if_changed(path: Optional[str] = None) -> bool:
+    """Перечитывает MESSAGES_FILE, если он изменился. True — тексты обновлены."""
+    path = path or os.getenv('MESSAGES_FILE', 'messages.json')
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    if mtime == _loaded_mtime:
+        return False
+    try:
+        load_messages(path)
+    except Exception as e:
+        logger.error(f"Failed to reload messages from {path}, keeping previous texts: {e}")
+        return False
+    logger.info(f"Messages reloaded from {path}")
+    return True
+
+
+def _lang(lang: Optional[str]) -> str:
+    if lang:
+        lang = lang.split('-')[0].lower()
+        if lang in _templates:
+            return lang
+    return DEFAULT_LANG
+
+
+def render(key: str, lang: Optional[str] = None, **fields) -> str:
+    """Текст сообщения key на языке lang (код языка Telegram) с подставленными полями."""
+    return _templates[_lang(lang)][key].text.format_map(fields)
+
+
+def button(key: str, lang: Optional[str] = None, **kwargs) -> InlineKeyboardButton:
+    """Кнопка с текстом key и url/callback_data из kwargs (для кнопок с переменной ссылкой)."""
+    return InlineKeyboardButton(render(key, lang), **kwargs)
+
+
+def static_row(name: str, lang: Optional[str] = None) -> tuple:
+    """Готовый ряд кнопок из STATIC_ROWS. Кнопки неизменяемы, поэтому ряды общие для всех вызовов."""
+    lang = _lang(lang)
+    row = _rows.get((name, lang))
+    if row is None:
+        row = tuple(button(key, lang, callback_data=data) for key, data in STATIC_ROWS[name])
+        _rows[(name, lang)] = row
+    return row
+
+
+def url_row(key: str, url: str, lang: Optional[str] = None) -> tuple:
+    """Ряд из одной кнопки-ссылки на постоянный адрес (канал, чат), кэшируется как static_row."""
+    lang = _lang(lang)
+    row = _rows.get((key, url, lang))
+    if row is None:
+        row = (button(key, lang, url=url),)
+        _rows[(key, url, lang)] = row
+    return row
@@ -0,0 +1,108 @@
+"""Перенос данных между бэкендами хранилища.
+
+    python migrate_storage.py export dump.jsonl                 # из STORAGE_BACKEND в файл
+    python migrate_storage.py import dump.jsonl                 # из файла в STORAGE_BACKEND
+    python migrate_storage.py copy --from sqlite --to postgres  # напрямую
+
+Строки читаются и пишутся пачками по --batch-size, поэтому объем памяти не зависит
+от размера базы. Повторный импорт пропускает уже существующие ключи.
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from config import load_env
+from storage import TABLES, create_storage
+
+
+async def export_to_file(source, path, batch_size):
+    counts = {}
+    with open(path, 'w', encoding='utf-8') as f:
+        for table in TABLES:
+            counts[table] = 0
+            async for batch in source.export_rows(table, batch_size):
+                for row in batch:
+                    f.write(json.dumps({'table': table, 'row': row}, ensure_ascii=False) + '\n')
+                counts[table] += len(batch)
+    return counts
+
+
+async def import_from_file(target, path, batch_size):
+    counts = {table: 0 for table in TABLES}
+    batch, batch_table = [], None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if batch and (record['table'] != batch_table or len(batch) >= batch_size):
+                await target.import_rows(batch_table, batch)
+                counts[batch_table] += len(batch)
+                batch = []
+            batch_table = record['table']
+            batch.append(record['row'])
+    if batch:
+        await target.import_rows(batch_table, batch)
+        counts[batch_table] += len(batch)
+    return counts
+
+
+async def copy_between(source, target, batch_size):
+    counts = {}
+    for table in TABLES:
+        counts[table] = 0
+        async for batch in source.export_rows(table, batch_size):
+            await target.import_rows(table, batch)
+            counts[table] += len(batch)
+    return counts
+
+
+async def run(args):
+    if args.command == 'copy':
+        source = create_storage(args.source, args.source_dsn)
+        target = create_storage(args.target, args.target_dsn)
+        await source.init()
+        await target.init()
+        try:
+            counts = await copy_between(source, target, args.batch_size)
+        finally:
+            await source.close()
+            await target.close()
+    else:
+        storage = create_storage(args.backend, args.dsn)
+        await storage.init()
+        try:
+            if args.command == 'export':
+                counts = await export_to_file(storage, args.path, args.batch_size)
+            else:
+                counts = await import_from_file(storage, args.path, args.batch_size)
+        finally:
+            await storage.close()
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+
+
+def main():
+    load_env()
+    parser = argparse.ArgumentParser(description="Перенос данных между SQLite и PostgreSQL")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name in ('export', 'import'):
+        command = commands.add_parser(name)
+        command.add_argument('path', help='JSONL-файл')
+        command.add_argument('--backend', default=os.getenv('STORAGE_BACKEND', 'sqlite'))
+        command.add_argument('--dsn', default=None, help='Путь к SQLite или DATABASE_URL для postgres')
+
+    copy = commands.add_parser('copy')
+    copy.add_argument('--from', dest='source', default='sqlite')
+    copy.add_argument('--from-dsn', dest='source_dsn', default=None)
+    copy.add_argument('--to', dest='target', default='postgres')
+    copy.add_argument('--to-dsn', dest='target_dsn', default=None)
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
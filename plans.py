@@ -0,0 +1,105 @@
+"""Каналы и тарифы подписки.
+
+Конфигурация читается из JSON-файла PLANS_FILE (по умолчанию plans.json), см.
+plans.example.json. Если файла нет, используется один канал и один тариф из
+переменных окружения CHANNEL_ID, LINK_CLOSED_CHANNEL, CHAT_LINK и SUBSCRIPTION_PRICE —
+так бот работает как раньше, с единственной группой.
+
+Первый канал в списке считается основным: на него выдается пробный период и
+его состояние дублируется в таблицу users.
+"""
+import json
+import os
+from typing import NamedTuple, Optional
+
+
+class Channel(NamedTuple):
+    channel_id: int
+    title: str
+    link: str
+    chat_link: str
+
+
+class Plan(NamedTuple):
+    plan_id: str
+    channel_id: int
+    title: str
+    price: float
+    days: int
+
+
+_channels = {}
+_plans = {}
+
+
+def load_plans(path: Optional[str] = None):
+    """Загружает каналы и тарифы. Повторный вызов перечитывает конфигурацию."""
+    path = path or os.getenv('PLANS_FILE', 'plans.json')
+    channels = {}
+    plans = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        for item in config['channels']:
+            channel = Channel(int(item['id']), item.get('title', 'HappyFaceClub'),
+                              item.get('link', ''), item.get('chat_link', ''))
+            channels[channel.channel_id] = channel
+        for item in config['plans']:
+            plan = Plan(str(item['id']), int(item['channel_id']), item.get('title', ''),
+                        float(item['price']), int(item.get('days', 30)))
+            if plan.channel_id not in channels:
+                raise ValueError(f"Plan {plan.plan_id} refers to unknown channel {plan.channel_id}")
+            plans[plan.plan_id] = plan
+    else:
+        channel = Channel(int(os.getenv('CHANNEL_ID')), os.getenv('CHANNEL_TITLE', 'HappyFaceClub'),
+                          os.getenv('LINK_CLOSED_CHANNEL', ''), os.getenv('CHAT_LINK', ''))
+        channels[channel.channel_id] = channel
+        plan = Plan('default', channel.channel_id, '1 месяц',
+                    float(os.getenv('SUBSCRIPTION_PRICE', 1000)), int(os.getenv('SUBSCRIPTION_DAYS', 30)))
+        plans[plan.plan_id] = plan
+
+    if not channels or not plans:
+        raise ValueError("At least one channel and one plan must be configured")
+    _channels.clear()
+    _channels.update(channels)
+    _plans.clear()
+    _plans.update(plans)
+
+
+def _ensure_loaded():
+    if not _channels:
+        load_plans()
+
+
+def get_channels() -> list:
+    _ensure_loaded()
+    return list(_channels.values())
+
+
+def get_channel(channel_id: int) -> Optional[Channel]:
+    _ensure_loaded()
+    return _channels.get(int(channel_id))
+
+
+def get_default_channel() -> Channel:
+    _ensure_loaded()
+    return next(iter(_channels.values()))
+
+
+def get_plans(channel_id: Optional[int] = None) -> list:
+    _ensure_loaded()
+    return [plan for plan in _plans.values() if channel_id is None or plan.channel_id == int(channel_id)]
+
+
+def get_plan(plan_id: Optional[str]) -> Optional[Plan]:
+    _ensure_loaded()
+    return _plans.get(plan_id) if plan_id else None
+
+
+def get_default_plan(channel_id: Optional[int] = None) -> Plan:
+    """Первый тариф канала (по умолчанию — основного)."""
+    channel_id = get_default_channel().channel_id if channel_id is None else int(channel_id)
+    plans = get_plans(channel_id)
+    if not plans:
+        raise ValueError(f"No plans configured for channel {channel_id}")
+    return plans[0]
@@ -0,0 +1,88 @@
+"""Промокоды и цена платежа для пользователя.
+
+Промокод дает скидку в процентах на следующую оплату и/или дни доступа сразу при
+активации; лимит активаций и срок действия проверяет Storage.redeem_promo_code.
+
+Цена платежа — цена тарифа, а у пользователя с активированной, но еще не использованной
+скидкой — цена со скидкой. create_payment вызывается на каждый /start, /check и
+напоминание, поэтому цена определяется поиском в словарях в памяти:
+    * _prices — (code, plan_id) -> цена со скидкой, посчитанная заранее для всех кодов и тарифов;
+    * _user_codes — user_id -> код неиспользованной скидки.
+Коды и скидки загружаются при запуске (bot.load_promo), коды других процессов — раз в
+PROMO_REFRESH секунд. Обновления одного пользователя обрабатывает один процесс
+(workers.routing_key), поэтому активацию и оплату со скидкой видит тот же процесс.
+"""
+import re
+from typing import Optional
+
+from plans import get_plans
+
+CODE_PATTERN = re.compile(r'^[A-Z0-9_-]{3,32}$')
+
+# code -> процент скидки (только коды со скидкой)
+_percents = {}
+# (code, plan_id) -> цена со скидкой
+_prices = {}
+# user_id -> код неиспользованной скидки
+_user_codes = {}
+
+
+def normalize(code: str) -> Optional[str]:
+    """Код в верхнем регистре или None, если он не подходит по формату."""
+    code = (code or '').strip().upper()
+    return code if CODE_PATTERN.match(code) else None
+
+
+def discounted(price: float, percent: int) -> float:
+    """Цена со скидкой, округленная до рубля; не меньше 1 рубля (минимум ЮKassa)."""
+    return float(max(1, round(price * (100 - percent) / 100)))
+
+
+def add_code(code: str, percent: int):
+    """Запоминает код и считает цены по всем тарифам."""
+    if not percent:
+        return
+    _percents[code] = percent
+    for plan in get_plans():
+        _prices[(code, plan.plan_id)] = discounted(plan.price, percent)
+
+
+def load_codes(rows: list):
+    """Заменяет коды строками (code, percent, bonus_days, max_redemptions, redemptions, expires_at)."""
+    _percents.clear()
+    _prices.clear()
+    for row in rows:
+        add_code(row[0], row[1])
+
+
+def load_discounts(rows: list):
+    """Заменяет скидки пользователей строками (user_id, code) от старых к новым: действует последняя."""
+    _user_codes.clear()
+    for user_id, code in rows:
+        _user_codes[user_id] = code
+
+
+def set_user_code(user_id: int, code: str, percent: int):
+    add_code(code, percent)
+    _user_codes[user_id] = code
+
+
+def drop_user_code(user_id: int, code: str = None):
+    """Скидка использована в оплате; code — только если это все еще текущий код."""
+    if code is None or _user_codes.get(user_id) == code:
+        _user_codes.pop(user_id, None)
+
+
+def price(user_id: int, plan) -> tuple:
+    """(цена, код скидки или None) платежа пользователя по тарифу."""
+    code = _user_codes.get(user_id)
+    if code is None:
+        return plan.price, None
+    discounted_price = _prices.get((code, plan.plan_id))
+    if discounted_price is None:
+        return plan.price, None
+    return discounted_price, code
+
+
+def size() -> dict:
+    return {'codes': len(_percents), 'discounts': len(_user_codes)}
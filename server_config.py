@@ -0,0 +1,146 @@
+"""Настройки приема обновлений: вебхук или polling, параллельная обработка.
+
+Значения по умолчанию повторяют прежний запуск на PythonAnywhere. Их можно задать
+в JSON-файле SERVER_CONFIG_FILE (по умолчанию server.json), см. server.example.json,
+а переменные окружения переопределяют файл:
+
+    BOT_MODE                 webhook | polling (polling — для локальной разработки)
+    WEBHOOK_LISTEN           адрес, на котором слушает сервер вебхуков
+    WEBHOOK_PORT             порт сервера вебхуков
+    WEBHOOK_PATH             путь вебхука
+    WEBHOOK_URL              публичный адрес, который получает Telegram в setWebhook
+    WEBHOOK_SECRET           секрет заголовка X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_MAX_CONNECTIONS  сколько соединений одновременно открывает Telegram (1-100)
+    WEBHOOK_CERT, WEBHOOK_KEY  самоподписанный сертификат, если TLS не терминирует прокси
+    ALLOWED_UPDATES          типы обновлений через запятую, пусто — все типы
+    DROP_PENDING_UPDATES     отбросить накопившиеся обновления при запуске
+    CONCURRENT_UPDATES       сколько обновлений обрабатывается одновременно
+    BOT_WORKERS              число рабочих процессов для workers.py
+    BOT_API_BASE_URL, BOT_API_FILE_URL, BOT_API_LOCAL_MODE  локальный Bot API сервер
+
+Модуль не импортирует telegram, чтобы фронтовой процесс workers.py оставался легким.
+"""
+import json
+import os
+from typing import NamedTuple, Optional
+
+# Верхняя граница параллельной обработки: каждое обновление держит соединение с
+# Bot API и базой, поэтому больше этого числа только растит очереди ожидания
+MAX_CONCURRENT_UPDATES = 256
+MAX_WEBHOOK_CONNECTIONS = 100
+
+
+class ServerConfig(NamedTuple):
+    mode: str
+    listen: str
+    port: int
+    url_path: str
+    webhook_url: str
+    secret_token: Optional[str]
+    max_connections: int
+    cert: Optional[str]
+    key: Optional[str]
+    allowed_updates: Optional[list]
+    drop_pending_updates: bool
+    concurrent_updates: int
+    workers: int
+    base_url: str
+    base_file_url: str
+    local_mode: bool
+
+
+DEFAULTS = {
+    'mode': 'webhook',
+    'listen': '0.0.0.0',
+    'port': 8443,
+    'url_path': '/webhook',
+    'webhook_url': 'https://HappyFaceBot.pythonanywhere.com/webhook',
+    'secret_token': '',
+    'max_connections': 40,
+    'cert': '',
+    'key': '',
+    'allowed_updates': '',
+    'drop_pending_updates': False,
+    'concurrent_updates': 32,
+    'workers': 2,
+    'base_url': 'https://api.telegram.org/bot',
+    'base_file_url': 'https://api.telegram.org/file/bot',
+    'local_mode': False,
+}
+
+# Поле конфигурации -> переменная окружения
+ENV_NAMES = {
+    'mode': 'BOT_MODE',
+    'listen': 'WEBHOOK_LISTEN',
+    'port': 'WEBHOOK_PORT',
+    'url_path': 'WEBHOOK_PATH',
+    'webhook_url': 'WEBHOOK_URL',
+    'secret_token': 'WEBHOOK_SECRET',
+    'max_connections': 'WEBHOOK_MAX_CONNECTIONS',
+    'cert': 'WEBHOOK_CERT',
+    'key': 'WEBHOOK_KEY',
+    'allowed_updates': 'ALLOWED_UPDATES',
+    'drop_pending_updates': 'DROP_PENDING_UPDATES',
+    'concurrent_updates': 'CONCURRENT_UPDATES',
+    'workers': 'BOT_WORKERS',
+    'base_url': 'BOT_API_BASE_URL',
+    'base_file_url': 'BOT_API_FILE_URL',
+    'local_mode': 'BOT_API_LOCAL_MODE',
+}
+
+
+def _flag(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def _list(value) -> Optional[list]:
+    if isinstance(value, str):
+        value = [item.strip() for item in value.split(',') if item.strip()]
+    # None — все типы обновлений (telegram.Update.ALL_TYPES подставляет bot.py)
+    return list(value) or None
+
+
+def load_server_config(path: Optional[str] = None) -> ServerConfig:
+    """Собирает настройки из значений по умолчанию, файла и окружения и проверяет их."""
+    path = path or os.getenv('SERVER_CONFIG_FILE', 'server.json')
+    values = dict(DEFAULTS)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            config = json.load(f)
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown server settings in {path}: {', '.join(sorted(unknown))}")
+        values.update(config)
+    for field, env_name in ENV_NAMES.items():
+        if os.getenv(env_name) is not None:
+            values[field] = os.getenv(env_name)
+
+    config = ServerConfig(
+        mode=str(values['mode']).lower(),
+        listen=str(values['listen']),
+        port=int(values['port']),
+        url_path='/' + str(values['url_path']).lstrip('/'),
+        webhook_url=str(values['webhook_url']),
+        secret_token=values['secret_token'] or None,
+        max_connections=int(values['max_connections']),
+        cert=values['cert'] or None,
+        key=values['key'] or None,
+        allowed_updates=_list(values['allowed_updates']),
+        drop_pending_updates=_flag(values['drop_pending_updates']),
+        concurrent_updates=min(MAX_CONCURRENT_UPDATES, max(1, int(values['concurrent_updates']))),
+        workers=max(1, int(values['workers'])),
+        base_url=str(values['base_url']),
+        base_file_url=str(values['base_file_url']),
+        local_mode=_flag(values['local_mode']),
+    )
+    if config.mode not in ('webhook', 'polling'):
+        raise ValueError(f"BOT_MODE must be webhook or polling, got {config.mode}")
+    if not 1 <= config.max_connections <= MAX_WEBHOOK_CONNECTIONS:
+        raise ValueError(f"WEBHOOK_MAX_CONNECTIONS must be between 1 and {MAX_WEBHOOK_CONNECTIONS}")
+    if config.secret_token and (len(config.secret_token) > 256
+                                or not all(c.isalnum() or c in "_-" for c in config.secret_token)):
+        # Ограничение Bot API: 1-256 символов A-Z, a-z, 0-9, _ и -
+        raise ValueError("WEBHOOK_SECRET may contain only letters, digits, _ and -")
+    return config
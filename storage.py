@@ -0,0 +1,592 @@
+"""Интерфейс хранилища пользователей, платежей и состояния задач.
+
+bot.py работает только через объект Storage, полученный из get_storage(). Бэкенд
+выбирается переменной STORAGE_BACKEND:
+    * sqlite (по умолчанию) — функции database.py, вызываемые в пуле потоков;
+    * postgres — асинхронный asyncpg с пулом соединений (storage_postgres.py),
+      адрес базы берется из DATABASE_URL.
+
+Все даты в интерфейсе — строки вида '%Y-%m-%d %H:%M:%S', как и в SQLite.
+Перенос данных между бэкендами — migrate_storage.py.
+"""
+import asyncio
+import os
+
+import backup
+import database
+
+# Таблицы и колонки в порядке переноса (users раньше зависимых таблиц)
+TABLES = {
+    'users': ['user_id', 'username', 'join_date', 'active', 'subscription_end', 'trial_used'],
+    'entitlements': ['user_id', 'channel_id', 'plan_id', 'subscription_end', 'is_trial', 'active', 'updated_at'],
+    'payments': ['payment_id', 'user_id', 'amount', 'date', 'status', 'plan_id'],
+    'job_state': ['name', 'owner', 'lease_until', 'last_run', 'checkpoint'],
+    'channel_members': ['user_id', 'channel_id', 'status', 'source', 'updated_at'],
+    'stats_counters': ['name', 'value'],
+    'stats_periods': ['period', 'metric', 'value'],
+    'outbox': ['id', 'chat_id', 'kind', 'payload', 'dedup_key', 'status', 'attempts',
+               'next_attempt_at', 'locked_until', 'last_error', 'created_at'],
+    'trial_signals': ['key', 'user_id', 'kind', 'created_at'],
+    'payment_methods': ['user_id', 'method_id', 'title', 'auto_renew', 'failures', 'last_attempt_at',
+                        'pending_payment_id', 'updated_at'],
+    'promo_codes': ['code', 'percent', 'bonus_days', 'max_redemptions', 'redemptions', 'expires_at', 'created_at'],
+    'promo_redemptions': ['code', 'user_id', 'payment_id', 'created_at'],
+    'referrals': ['user_id', 'referrer_id', 'credited', 'created_at'],
+    'events': ['id', 'user_id', 'channel_id', 'kind', 'payload', 'created_at'],
+    'event_snapshots': ['user_id', 'channel_id', 'state', 'event_id'],
+}
+# Агрегаты статистики при импорте заменяют значения, посчитанные целевой базой при создании
+OVERWRITE_TABLES = {'stats_counters': ['name'], 'stats_periods': ['period', 'metric']}
+TIMESTAMP_COLUMNS = {'join_date', 'subscription_end', 'date', 'updated_at', 'created_at', 'expires_at'}
+BOOLEAN_COLUMNS = {'active', 'trial_used', 'is_trial', 'auto_renew', 'credited'}
+
+
+class Storage:
+    """Базовый класс бэкенда. Методы повторяют функции database.py, но асинхронные."""
+
+    name = 'base'
+
+    async def init(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    # --- Пользователи и доступы ---
+
+    async def add_user(self, user_id: int, username: str = None, suspect_keys: list = (),
+                       deny_trial: bool = False):
+        """Создает пользователя с пробным периодом. None — пользователь уже был, иначе список
+        совпавших признаков повтора (key, user_id, kind); при совпадениях и deny_trial
+        пробный период не выдается."""
+        raise NotImplementedError
+
+    async def add_trial_signal(self, key: str, user_id: int, kind: str):
+        raise NotImplementedError
+
+    async def get_trial_signal_keys(self, since: str = None) -> list:
+        """Ключи признаков повтора пробного периода, записанные не раньше since (UTC)."""
+        raise NotImplementedError
+
+    async def get_entitlement(self, user_id: int, channel_id: int = None):
+        """(plan_id, subscription_end, is_trial, active) или None."""
+        raise NotImplementedError
+
+    async def get_user_entitlements(self, user_id: int):
+        """Список (channel_id, plan_id, subscription_end, is_trial, active)."""
+        raise NotImplementedError
+
+    async def get_entitlement_changes(self, since: str):
+        """(user_id, channel_id, plan_id, subscription_end, is_trial, active) доступов,
+        измененных не раньше since (UTC, по updated_at)."""
+        raise NotImplementedError
+
+    async def get_due_entitlements(self, cutoff: str, after: list = None, deactivated_since: str = None,
+                                   now: str = None):
+        """Активные доступы с окончанием раньше cutoff по возрастанию (subscription_end, user_id, channel_id):
+        (user_id, username, channel_id, plan_id, subscription_end, is_trial). after — позиция, с которой
+        продолжается прерванный проход; с ней возвращаются и доступы, истекшие раньше now и
+        отключенные не раньше deactivated_since (UTC)."""
+        raise NotImplementedError
+
+    async def deactivate_entitlement(self, user_id: int, channel_id: int, outbox: list = (),
+                                     now: str = None) -> bool:
+        """Отключает доступ; outbox — сообщения (chat_id, kind, payload, dedup_key),
+        которые ставятся в очередь в той же транзакции, если доступ был активен. С now
+        отключается только доступ, истекший раньше now; False — такого доступа нет."""
+        raise NotImplementedError
+
+    async def get_active_users(self):
+        """Список (user_id, username) с активным доступом хотя бы к одному каналу."""
+        raise NotImplementedError
+
+    async def get_active_users_page(self, after_user_id: int = None, before_user_id: int = None,
+                                    limit: int = 50):
+        """Страница (user_id, username) активных пользователей по возрастанию user_id."""
+        raise NotImplementedError
+
+    async def count_active_users(self) -> int:
+        raise NotImplementedError
+
+    async def iter_active_users(self, batch_size: int = 1000):
+        """Асинхронный генератор пачек активных пользователей без загрузки всего списка."""
+        after_user_id = None
+        while True:
+            batch = await self.get_active_users_page(after_user_id, limit=batch_size)
+            if not batch:
+                return
+            yield batch
+            after_user_id = batch[-1][0]
+
+    async def update_subscription(self, user_id: int, payment_id: str, amount: float, plan_id: str = None,
+                                  outbox: list = (), promo_code: str = None, referral_days: int = 0):
+        """Продлевает доступ; возвращает новую дату окончания или None, если платеж уже зачтен.
+        Сообщения outbox ставятся в очередь в той же транзакции, что и продление; там же
+        отмечается использованная скидка promo_code и начисляются дни пригласившему."""
+        raise NotImplementedError
+
+    # --- Участники каналов ---
+
+    async def record_member_status(self, user_id: int, channel_id: int, status: str, source: str):
+        raise NotImplementedError
+
+    async def get_reconcile_candidates(self, channel_id: int, expired_after: str, full: bool = False):
+        """user_id с активным или недавно истекшим доступом, которых нужно проверить в канале."""
+        raise NotImplementedError
+
+    async def get_membership_diff(self, channel_id: int, now: str):
+        """(в канале без доступа, с доступом вне канала) — списки (user_id, username, status)."""
+        raise NotImplementedError
+
+    async def get_member_changes(self, since: str):
+        """(user_id, channel_id), чей статус в канале записан не раньше since."""
+        raise NotImplementedError
+
+    # --- Платежи ---
+
+    async def add_payment(self, payment_id: str, user_id: int, amount: float, plan_id: str = None,
+                          status: str = 'pending'):
+        raise NotImplementedError
+
+    async def set_payment_status(self, payment_id: str, status: str):
+        raise NotImplementedError
+
+    async def get_payment(self, payment_id: str):
+        """(payment_id, user_id, amount, status, plan_id) или None."""
+        raise NotImplementedError
+
+    async def get_last_payment(self, user_id: int):
+        """(payment_id, status) последнего платежа или None."""
+        raise NotImplementedError
+
+    async def get_pending_payment_ids(self, payment_ids: list) -> set:
+        """Те из payment_ids, что еще в статусе pending."""
+        raise NotImplementedError
+
+    # --- Автопродление ---
+
+    async def save_payment_method(self, user_id: int, method_id: str, title: str = None):
+        """Сохраняет способ оплаты и включает автопродление."""
+        raise NotImplementedError
+
+    async def get_payment_method(self, user_id: int):
+        """(method_id, title, auto_renew, failures, pending_payment_id) или None."""
+        raise NotImplementedError
+
+    async def set_auto_renew(self, user_id: int, enabled: bool) -> bool:
+        """False — у пользователя нет сохраненного способа оплаты."""
+        raise NotImplementedError
+
+    async def get_auto_renew_user_ids(self, user_ids: list) -> set:
+        raise NotImplementedError
+
+    async def get_due_renewals(self, cutoff: str, retry_before: float, limit: int):
+        """Доступы к автопродлению: (user_id, channel_id, plan_id, subscription_end, method_id,
+        failures, pending_payment_id)."""
+        raise NotImplementedError
+
+    async def record_renewal_attempt(self, user_id: int, status: str, payment_id: str = None,
+                                     max_failures: int = 3) -> bool:
+        """status error — ЮKassa не ответила: меняется только время попытки. True — этот
+        отказ отключил автопродление."""
+        raise NotImplementedError
+
+    # --- Промокоды и приглашения ---
+
+    async def add_promo_code(self, code: str, percent: int = 0, bonus_days: int = 0,
+                             max_redemptions: int = None, expires_at: str = None) -> bool:
+        """False — такой код уже есть."""
+        raise NotImplementedError
+
+    async def get_promo_codes(self):
+        """Список (code, percent, bonus_days, max_redemptions, redemptions, expires_at)."""
+        raise NotImplementedError
+
+    async def get_pending_discounts(self):
+        """(user_id, code) активированных, но не использованных скидок, от старых к новым."""
+        raise NotImplementedError
+
+    async def redeem_promo_code(self, user_id: int, code: str, channel_id: int = None):
+        """(status, percent, bonus_days, subscription_end); status — ok, not_found, expired,
+        already или exhausted. Лимит активаций соблюдается атомарно."""
+        raise NotImplementedError
+
+    async def add_referral(self, user_id: int, referrer_id: int) -> bool:
+        raise NotImplementedError
+
+    async def count_referrals(self, referrer_id: int):
+        """(приглашено, из них оплатили)."""
+        raise NotImplementedError
+
+    # --- Массовые операции админа (bulk_access.py) ---
+
+    async def resolve_users(self, user_ids: list, usernames: list) -> tuple:
+        """({user_id: username} найденных, [не найденные user_id и @имена])."""
+        raise NotImplementedError
+
+    async def bulk_update_access(self, action: str, user_ids: list, channel_id: int, days: int,
+                                 batch_id: str) -> list:
+        """Применяет grant, extend или revoke к user_ids одной транзакцией; возвращает изменения
+        [(user_id, subscription_end, is_trial, active, прежнее состояние)]."""
+        raise NotImplementedError
+
+    async def get_outbox_progress(self, prefix: str) -> dict:
+        """{статус: сообщений} outbox с ключом дедупликации, начинающимся с prefix."""
+        raise NotImplementedError
+
+    # --- Журнал событий (event_log.py) ---
+
+    async def get_events(self, after_id: int = 0, limit: int = 1000):
+        """События с номером больше after_id по возрастанию:
+        [(id, user_id, channel_id, kind, payload, created_at)]."""
+        raise NotImplementedError
+
+    async def get_user_events(self, user_id: int, after_id: int = 0):
+        raise NotImplementedError
+
+    async def get_event_snapshots(self, keys: list) -> dict:
+        """{(user_id, channel_id): (state, event_id)} для пар keys."""
+        raise NotImplementedError
+
+    async def get_user_snapshots(self, user_id: int) -> dict:
+        """{channel_id: (state, event_id)}."""
+        raise NotImplementedError
+
+    async def get_snapshot_position(self) -> int:
+        """Номер последнего события, учтенного снимками."""
+        raise NotImplementedError
+
+    async def save_event_snapshots(self, rows: list):
+        """Записывает снимки (user_id, channel_id, state, event_id)."""
+        raise NotImplementedError
+
+    # --- Исходящие сообщения ---
+
+    async def enqueue_outbox(self, entries: list):
+        """Ставит сообщения (chat_id, kind, payload, dedup_key) в очередь, дубли по dedup_key пропускаются."""
+        raise NotImplementedError
+
+    async def claim_outbox(self, limit: int, lease: float):
+        """Забирает готовые к отправке сообщения: [(id, chat_id, kind, payload, attempts)]."""
+        raise NotImplementedError
+
+    async def complete_outbox(self, outbox_id: int):
+        raise NotImplementedError
+
+    async def fail_outbox(self, outbox_id: int, error: str, retry_at: float = None):
+        """Повтор не раньше retry_at (время epoch) или dead-letter, если retry_at=None."""
+        raise NotImplementedError
+
+    # --- Статистика ---
+
+    async def get_stats(self, days: int = 7, months: int = 6):
+        """(счетчики, [(день, метрика, значение)], [(месяц, метрика, значение)]) из агрегатов."""
+        raise NotImplementedError
+
+    # --- Хранение и сжатие ---
+
+    async def purge_payments(self, before: str, limit: int) -> dict:
+        """Удаляет до limit неоплаченных платежей (pending, canceled) с датой раньше before;
+        возвращает {статус: удалено}. Оплаченные платежи не удаляются никогда."""
+        raise NotImplementedError
+
+    async def purge_outbox(self, before: str, limit: int) -> int:
+        """Удаляет до limit доставленных и dead-letter сообщений, созданных раньше before."""
+        raise NotImplementedError
+
+    async def compact(self, vacuum_ratio: float) -> dict:
+        """Освобождает место удаленных строк; возвращает размеры базы до и после для лога."""
+        raise NotImplementedError
+
+    async def backup(self, backup_dir: str, keep: int) -> tuple:
+        """Снимает проверенную сжатую копию базы в backup_dir, оставляя последние keep копий;
+        возвращает (путь, {таблица: строк}). Есть только у SQLite."""
+        raise NotImplementedError
+
+    # --- Состояние задач ---
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        raise NotImplementedError
+
+    async def release_lease(self, name: str, owner: str):
+        raise NotImplementedError
+
+    async def get_job_last_run(self, name: str):
+        raise NotImplementedError
+
+    async def set_job_last_run(self, name: str, timestamp: float):
+        raise NotImplementedError
+
+    async def get_job_checkpoint(self, name: str):
+        """Прогресс прерванной задачи (словарь) или None."""
+        raise NotImplementedError
+
+    async def set_job_checkpoint(self, name: str, checkpoint: dict = None):
+        """Сохраняет прогресс задачи; None — сбрасывает его."""
+        raise NotImplementedError
+
+    # --- Перенос данных ---
+
+    async def export_rows(self, table: str, batch_size: int = 1000):
+        """Асинхронный генератор пачек строк таблицы в виде словарей."""
+        raise NotImplementedError
+        yield
+
+    async def import_rows(self, table: str, rows: list):
+        """Вставляет строки (словари), пропуская уже существующие ключи."""
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """Бэкенд поверх database.py. Синхронные вызовы уходят в пул потоков, чтобы не
+    блокировать цикл событий на время ожидания блокировки SQLite."""
+
+    name = 'sqlite'
+
+    def __init__(self, path: str = None):
+        if path:
+            database.DB_PATH = path
+
+    async def init(self):
+        await asyncio.to_thread(database.init_db)
+
+    async def add_user(self, user_id, username=None, suspect_keys=(), deny_trial=False):
+        return await asyncio.to_thread(database.add_user, user_id, username, list(suspect_keys), deny_trial)
+
+    async def add_trial_signal(self, key, user_id, kind):
+        await asyncio.to_thread(database.add_trial_signal, key, user_id, kind)
+
+    async def get_trial_signal_keys(self, since=None):
+        return await asyncio.to_thread(database.get_trial_signal_keys, since)
+
+    async def get_entitlement(self, user_id, channel_id=None):
+        return await asyncio.to_thread(database.get_entitlement, user_id, channel_id)
+
+    async def get_user_entitlements(self, user_id):
+        return await asyncio.to_thread(database.get_user_entitlements, user_id)
+
+    async def get_entitlement_changes(self, since):
+        return await asyncio.to_thread(database.get_entitlement_changes, since)
+
+    async def get_due_entitlements(self, cutoff, after=None, deactivated_since=None, now=None):
+        return await asyncio.to_thread(database.get_due_entitlements, cutoff, after, deactivated_since, now)
+
+    async def deactivate_entitlement(self, user_id, channel_id, outbox=(), now=None):
+        return await asyncio.to_thread(database.deactivate_entitlement, user_id, channel_id, outbox, now)
+
+    async def get_active_users(self):
+        return await asyncio.to_thread(database.get_active_users)
+
+    async def get_active_users_page(self, after_user_id=None, before_user_id=None, limit=50):
+        return await asyncio.to_thread(database.get_active_users_page, after_user_id, before_user_id, limit)
+
+    async def count_active_users(self):
+        return await asyncio.to_thread(database.count_active_users)
+
+    async def update_subscription(self, user_id, payment_id, amount, plan_id=None, outbox=(), promo_code=None,
+                                  referral_days=0):
+        return await asyncio.to_thread(database.update_subscription, user_id, payment_id, amount, plan_id, outbox,
+                                       promo_code, referral_days)
+
+    async def record_member_status(self, user_id, channel_id, status, source):
+        await asyncio.to_thread(database.record_member_status, user_id, channel_id, status, source)
+
+    async def get_reconcile_candidates(self, channel_id, expired_after, full=False):
+        return await asyncio.to_thread(database.get_reconcile_candidates, channel_id, expired_after, full)
+
+    async def get_membership_diff(self, channel_id, now):
+        return await asyncio.to_thread(database.get_membership_diff, channel_id, now)
+
+    async def get_member_changes(self, since):
+        return await asyncio.to_thread(database.get_member_changes, since)
+
+    async def add_payment(self, payment_id, user_id, amount, plan_id=None, status='pending'):
+        await asyncio.to_thread(database.add_payment, payment_id, user_id, amount, plan_id, status)
+
+    async def set_payment_status(self, payment_id, status):
+        await asyncio.to_thread(database.set_payment_status, payment_id, status)
+
+    async def get_payment(self, payment_id):
+        return await asyncio.to_thread(database.get_payment, payment_id)
+
+    async def get_last_payment(self, user_id):
+        return await asyncio.to_thread(database.get_last_payment, user_id)
+
+    async def get_pending_payment_ids(self, payment_ids):
+        return await asyncio.to_thread(database.get_pending_payment_ids, list(payment_ids))
+
+    async def save_payment_method(self, user_id, method_id, title=None):
+        await asyncio.to_thread(database.save_payment_method, user_id, method_id, title)
+
+    async def get_payment_method(self, user_id):
+        return await asyncio.to_thread(database.get_payment_method, user_id)
+
+    async def set_auto_renew(self, user_id, enabled):
+        return await asyncio.to_thread(database.set_auto_renew, user_id, enabled)
+
+    async def get_auto_renew_user_ids(self, user_ids):
+        return await asyncio.to_thread(database.get_auto_renew_user_ids, list(user_ids))
+
+    async def get_due_renewals(self, cutoff, retry_before, limit):
+        return await asyncio.to_thread(database.get_due_renewals, cutoff, retry_before, limit)
+
+    async def record_renewal_attempt(self, user_id, status, payment_id=None, max_failures=3):
+        return await asyncio.to_thread(database.record_renewal_attempt, user_id, status, payment_id, max_failures)
+
+    async def add_promo_code(self, code, percent=0, bonus_days=0, max_redemptions=None, expires_at=None):
+        return await asyncio.to_thread(database.add_promo_code, code, percent, bonus_days, max_redemptions,
+                                       expires_at)
+
+    async def get_promo_codes(self):
+        return await asyncio.to_thread(database.get_promo_codes)
+
+    async def get_pending_discounts(self):
+        return await asyncio.to_thread(database.get_pending_discounts)
+
+    async def redeem_promo_code(self, user_id, code, channel_id=None):
+        return await asyncio.to_thread(database.redeem_promo_code, user_id, code, channel_id)
+
+    async def add_referral(self, user_id, referrer_id):
+        return await asyncio.to_thread(database.add_referral, user_id, referrer_id)
+
+    async def count_referrals(self, referrer_id):
+        return await asyncio.to_thread(database.count_referrals, referrer_id)
+
+    async def resolve_users(self, user_ids, usernames):
+        return await asyncio.to_thread(database.resolve_users, user_ids, usernames)
+
+    async def bulk_update_access(self, action, user_ids, channel_id, days, batch_id):
+        return await asyncio.to_thread(database.bulk_update_access, action, user_ids, channel_id, days, batch_id)
+
+    async def get_outbox_progress(self, prefix):
+        return await asyncio.to_thread(database.get_outbox_progress, prefix)
+
+    async def get_events(self, after_id=0, limit=1000):
+        return await asyncio.to_thread(database.get_events, after_id, limit)
+
+    async def get_user_events(self, user_id, after_id=0):
+        return await asyncio.to_thread(database.get_user_events, user_id, after_id)
+
+    async def get_event_snapshots(self, keys):
+        return await asyncio.to_thread(database.get_event_snapshots, keys)
+
+    async def get_user_snapshots(self, user_id):
+        return await asyncio.to_thread(database.get_user_snapshots, user_id)
+
+    async def get_snapshot_position(self):
+        return await asyncio.to_thread(database.get_snapshot_position)
+
+    async def save_event_snapshots(self, rows):
+        await asyncio.to_thread(database.save_event_snapshots, rows)
+
+    async def enqueue_outbox(self, entries):
+        await asyncio.to_thread(database.enqueue_outbox, entries)
+
+    async def claim_outbox(self, limit, lease):
+        return await asyncio.to_thread(database.claim_outbox, limit, lease)
+
+    async def complete_outbox(self, outbox_id):
+        await asyncio.to_thread(database.complete_outbox, outbox_id)
+
+    async def fail_outbox(self, outbox_id, error, retry_at=None):
+        await asyncio.to_thread(database.fail_outbox, outbox_id, error, retry_at)
+
+    async def get_stats(self, days=7, months=6):
+        return await asyncio.to_thread(database.get_stats, days, months)
+
+    async def purge_payments(self, before, limit):
+        return await asyncio.to_thread(database.purge_payments, before, limit)
+
+    async def purge_outbox(self, before, limit):
+        return await asyncio.to_thread(database.purge_outbox, before, limit)
+
+    async def compact(self, vacuum_ratio):
+        return await asyncio.to_thread(database.compact, vacuum_ratio)
+
+    async def backup(self, backup_dir, keep):
+        # Копирование, сжатие и проверка — в пуле потоков, цикл событий их не ждет
+        return await asyncio.to_thread(backup.run, database.DB_PATH, backup_dir, keep)
+
+    async def acquire_lease(self, name, owner, ttl):
+        return await asyncio.to_thread(database.acquire_lease, name, owner, ttl)
+
+    async def release_lease(self, name, owner):
+        await asyncio.to_thread(database.release_lease, name, owner)
+
+    async def get_job_last_run(self, name):
+        return await asyncio.to_thread(database.get_job_last_run, name)
+
+    async def set_job_last_run(self, name, timestamp):
+        await asyncio.to_thread(database.set_job_last_run, name, timestamp)
+
+    async def get_job_checkpoint(self, name):
+        return await asyncio.to_thread(database.get_job_checkpoint, name)
+
+    async def set_job_checkpoint(self, name, checkpoint=None):
+        await asyncio.to_thread(database.set_job_checkpoint, name, checkpoint)
+
+    def _fetch_batch(self, table, columns, last_rowid, batch_size):
+        conn = database.get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size)
+            )
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    async def export_rows(self, table, batch_size=1000):
+        columns = TABLES[table]
+        last_rowid = 0
+        while True:
+            batch = await asyncio.to_thread(self._fetch_batch, table, columns, last_rowid, batch_size)
+            if not batch:
+                return
+            last_rowid = batch[-1][0]
+            yield [dict(zip(columns, row[1:])) for row in batch]
+
+    def _insert_rows(self, table, rows):
+        columns = TABLES[table]
+        with database.db_lock:
+            conn = database.get_db_connection()
+            try:
+                conn.executemany(
+                    f"INSERT OR {'REPLACE' if table in OVERWRITE_TABLES else 'IGNORE'} INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' for _ in columns)})",
+                    [tuple(_to_sqlite(column, row.get(column)) for column in columns) for row in rows]
+                )
+                conn.commit()
+            finally:
+                conn.close()
+
+    async def import_rows(self, table, rows):
+        await asyncio.to_thread(self._insert_rows, table, rows)
+
+
+def _to_sqlite(column, value):
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def create_storage(backend: str = None, dsn: str = None) -> Storage:
+    backend = (backend or os.getenv('STORAGE_BACKEND', 'sqlite')).lower()
+    if backend == 'sqlite':
+        return SQLiteStorage(dsn)
+    if backend in ('postgres', 'postgresql'):
+        from storage_postgres import PostgresStorage
+        return PostgresStorage(dsn or os.getenv('DATABASE_URL'))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+_storage = None
+
+
+def get_storage() -> Storage:
+    """Хранилище процесса, выбранное по STORAGE_BACKEND."""
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
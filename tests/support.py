@@ -0,0 +1,64 @@
+"""Общая подготовка тестов: bot.py во временном каталоге против локальных заглушек
+Bot API и ЮKassa (benchmarks/fake_services.py), как в бенчмарках.
+
+Запуск из корня репозитория:
+    python -m unittest discover tests
+"""
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fake_services import FakeServices  # noqa: E402
+
+TEST_ENV = {
+    'TELEGRAM_BOT_TOKEN': '123456:TEST',
+    'CHANNEL_ID': '-1001000000000',
+    'CHAT_LINK': 'https://t.me/+chat',
+    'LINK_CLOSED_CHANNEL': 'https://t.me/+channel',
+    'SUBSCRIPTION_PRICE': '1000',
+    'TRIAL_DAYS': '5',
+    'ADMIN_ID': '1000',
+    'FRIEND_ID': '0',
+    'YOOKASSA_SHOP_ID': '1',
+    'YOOKASSA_SECRET_KEY': 'test',
+    'STORAGE_BACKEND': 'sqlite',
+}
+
+_services = None
+_workdir = None
+
+
+def start_services() -> FakeServices:
+    """Запускает заглушки и выставляет окружение один раз на процесс: config.py и
+    bot.configure() читают окружение только при первом обращении."""
+    global _services, _workdir
+    if _services is None:
+        _services = FakeServices().start()
+        os.environ.update(TEST_ENV)
+        os.environ['BOT_API_BASE_URL'] = _services.bot_base_url
+        os.environ['YOOKASSA_API_URL'] = _services.yookassa_api_url
+        # База, лог и снимки bot.py пишутся в рабочий каталог
+        _workdir = tempfile.mkdtemp(prefix='happyface_tests_')
+        os.chdir(_workdir)
+    return _services
+
+
+def configure_bot():
+    """(bot, services): bot.py, настроенный на заглушки."""
+    services = start_services()
+    import bot
+    bot.configure()
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return bot, services
+
+
+def fresh_database(name: str) -> str:
+    """Путь к новой базе SQLite в рабочем каталоге тестов."""
+    start_services()
+    return os.path.join(_workdir, f"{name}.db")
@@ -0,0 +1,154 @@
+"""Автопродление (bot.renew_subscriptions) против заглушки ЮKassa: успешное списание,
+отказ с повтором через RENEW_RETRY_INTERVAL, отключение после RENEW_MAX_FAILURES отказов и
+сбой связи после списания, который не должен приводить ко второму списанию."""
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from support import configure_bot, fresh_database
+
+bot, services = configure_bot()
+import database  # noqa: E402
+from telegram.ext import Application, CallbackContext  # noqa: E402
+
+USER_ID = 71
+
+
+class AutoRenewTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patches = [
+            mock.patch.object(database, 'DB_PATH', fresh_database(self._testMethodName)),
+            mock.patch.object(bot, 'AUTO_RENEW', True),
+            mock.patch.object(bot, 'RENEW_BATCH_INTERVAL', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        await bot.storage.init()
+        bot.hot_state.clear()
+        self.application = Application.builder().token(bot.TOKEN).base_url(services.bot_base_url).build()
+        await self.application.initialize()
+        self.context = CallbackContext(self.application)
+
+        # Первая оплата сохраняет способ оплаты (заглушка ЮKassa всегда сохраняет его)
+        await bot.storage.add_user(USER_ID, 'renewer')
+        payment_link, payment_id = await bot.create_payment(USER_ID, 'test_bot')
+        services.set_payment_status(payment_id, 'succeeded')
+        self.assertTrue(await bot.check_payment_status(payment_id, USER_ID, self.context))
+        self.method_id = (await bot.storage.get_payment_method(USER_ID))[0]
+        # Доступ заканчивается в пределах RENEW_AHEAD
+        self.subscription_end = (datetime.now(bot.MOSCOW_TZ) + timedelta(hours=5)).strftime('%Y-%m-%d %H:%M:%S')
+        self.execute('UPDATE entitlements SET subscription_end = ? WHERE user_id = ?',
+                     (self.subscription_end, USER_ID))
+        services.reset()
+
+    async def asyncTearDown(self):
+        await self.application.shutdown()
+        services.declined_methods.clear()
+        services.idempotence_keys.clear()
+        services.drop_payments = 0
+
+    def execute(self, sql, params=()):
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def age_last_attempt(self, seconds: float):
+        """Сдвигает последнюю попытку списания в прошлое на seconds."""
+        self.execute('UPDATE payment_methods SET last_attempt_at = last_attempt_at - ? WHERE user_id = ?',
+                     (seconds, USER_ID))
+
+    def subscription(self):
+        return self.execute('SELECT subscription_end, active FROM entitlements WHERE user_id = ?', (USER_ID,))[0]
+
+    def outbox_kinds(self):
+        return [row[0] for row in self.execute('SELECT kind FROM outbox WHERE chat_id = ? ORDER BY id', (USER_ID,))]
+
+    async def test_successful_charge(self):
+        await bot.renew_subscriptions(self.context)
+
+        self.assertEqual(services.calls['yookassa.create_payment'], 1)
+        end = datetime.strptime(self.subscription_end, '%Y-%m-%d %H:%M:%S') + timedelta(days=30)
+        self.assertEqual(self.subscription(), (end.strftime('%Y-%m-%d %H:%M:%S'), 1))
+        self.assertEqual(self.execute(
+            "SELECT amount, status FROM payments WHERE user_id = ? ORDER BY rowid DESC LIMIT 1", (USER_ID,)),
+            [(1000.0, 'succeeded')])
+        method_id, title, auto_renew, failures, pending_payment_id = await bot.storage.get_payment_method(USER_ID)
+        self.assertEqual((auto_renew, failures, pending_payment_id), (1, 0, None))
+        self.assertIn('subscription_renewed', self.outbox_kinds())
+
+        # Продленный доступ больше не попадает в окно автопродления
+        await bot.renew_subscriptions(self.context)
+        self.assertEqual(services.calls['yookassa.create_payment'], 1)
+
+    async def test_decline_is_retried_after_retry_interval(self):
+        services.declined_methods.add(self.method_id)
+        await bot.renew_subscriptions(self.context)
+
+        self.assertEqual(services.calls['yookassa.create_payment'], 1)
+        self.assertEqual(self.subscription(), (self.subscription_end, 1))
+        self.assertEqual((await bot.storage.get_payment_method(USER_ID))[2:4], (1, 1))
+
+        # До истечения RENEW_RETRY_INTERVAL (6 часов) повторного списания нет
+        await bot.renew_subscriptions(self.context)
+        self.age_last_attempt(bot.RENEW_RETRY_INTERVAL - 60)
+        await bot.renew_subscriptions(self.context)
+        self.assertEqual(services.calls['yookassa.create_payment'], 1)
+
+        # После него — новая попытка, и при успехе доступ продлевается
+        services.declined_methods.clear()
+        self.age_last_attempt(120)
+        await bot.renew_subscriptions(self.context)
+        self.assertEqual(services.calls['yookassa.create_payment'], 2)
+        self.assertNotEqual(self.subscription()[0], self.subscription_end)
+        self.assertEqual((await bot.storage.get_payment_method(USER_ID))[2:4], (1, 0))
+
+    async def test_auto_renew_disabled_after_three_declines(self):
+        services.declined_methods.add(self.method_id)
+        for attempt in range(bot.RENEW_MAX_FAILURES):
+            await bot.renew_subscriptions(self.context)
+            self.age_last_attempt(bot.RENEW_RETRY_INTERVAL + 60)
+
+        self.assertEqual(services.calls['yookassa.create_payment'], 3)
+        method_id, title, auto_renew, failures, pending_payment_id = await bot.storage.get_payment_method(USER_ID)
+        self.assertEqual((auto_renew, failures), (0, 3))
+        self.assertEqual(self.outbox_kinds().count('auto_renew_failed'), 1)
+        self.assertEqual(self.subscription(), (self.subscription_end, 1))
+
+        # Отключенное автопродление больше не списывается
+        await bot.renew_subscriptions(self.context)
+        self.assertEqual(services.calls['yookassa.create_payment'], 3)
+
+    async def test_lost_response_is_not_charged_twice(self):
+        payments_before = set(services.payments)
+        # ЮKassa списывает оплату, но соединение обрывается до ответа — три раза подряд
+        services.drop_payments = bot.RENEW_MAX_FAILURES
+        for attempt in range(bot.RENEW_MAX_FAILURES):
+            await bot.renew_subscriptions(self.context)
+            self.age_last_attempt(bot.RENEW_RETRY_INTERVAL + 60)
+
+        self.assertEqual(services.calls['yookassa.create_payment'], 3)
+        # Сбой связи — не отказ: автопродление включено, пользователь не уведомлен
+        self.assertEqual((await bot.storage.get_payment_method(USER_ID))[2:4], (1, 0))
+        self.assertNotIn('auto_renew_failed', self.outbox_kinds())
+        self.assertEqual(self.subscription(), (self.subscription_end, 1))
+
+        # Повтор с тем же ключом получает первый платеж, а не создает новый
+        await bot.renew_subscriptions(self.context)
+        self.assertEqual(services.calls['yookassa.create_payment'], 4)
+        charged = [payment_id for payment_id in services.payments if payment_id not in payments_before]
+        self.assertEqual(len(charged), 1)
+        self.assertEqual(self.execute(
+            "SELECT payment_id, status FROM payments WHERE user_id = ? ORDER BY rowid DESC LIMIT 1", (USER_ID,)),
+            [(charged[0], 'succeeded')])
+        end = datetime.strptime(self.subscription_end, '%Y-%m-%d %H:%M:%S') + timedelta(days=30)
+        self.assertEqual(self.subscription(), (end.strftime('%Y-%m-%d %H:%M:%S'), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Исключение по истекшему доступу (bot.process_due_entitlement): доступ, продленный после
+того, как проход check_subscriptions прочитал список, не отключается, а повторная обработка
+при продолжении прерванного прохода не повторяет уведомления."""
+import sqlite3
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from support import configure_bot, fresh_database
+
+bot, services = configure_bot()
+import database  # noqa: E402
+from telegram.ext import Application, CallbackContext  # noqa: E402
+
+USER_ID = 81
+
+
+class ProcessDueEntitlementTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patch = mock.patch.object(database, 'DB_PATH', fresh_database(self._testMethodName))
+        patch.start()
+        self.addCleanup(patch.stop)
+        await bot.storage.init()
+        bot.hot_state.clear()
+        self.application = Application.builder().token(bot.TOKEN).base_url(services.bot_base_url).build()
+        await self.application.initialize()
+        self.context = CallbackContext(self.application)
+
+        # Пробный период истек час назад; проход прочитал его в списке истекающих
+        await bot.storage.add_user(USER_ID, 'expired')
+        self.now = datetime.now(bot.MOSCOW_TZ)
+        self.execute('UPDATE entitlements SET subscription_end = ? WHERE user_id = ?',
+                     ((self.now - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S'), USER_ID))
+        cutoff = (self.now + timedelta(days=4)).strftime('%Y-%m-%d %H:%M:%S')
+        [self.entitlement] = await bot.storage.get_due_entitlements(cutoff)
+        services.reset()
+
+    async def asyncTearDown(self):
+        await self.application.shutdown()
+
+    def execute(self, sql, params=()):
+        conn = sqlite3.connect(database.DB_PATH)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def active(self):
+        return self.execute('SELECT active FROM entitlements WHERE user_id = ?', (USER_ID,))[0][0]
+
+    def outbox_kinds(self):
+        return [row[0] for row in self.execute('SELECT kind FROM outbox ORDER BY id')]
+
+    async def test_expired_access_is_removed(self):
+        await bot.process_due_entitlement(self.context, self.entitlement, self.now)
+
+        self.assertEqual(self.active(), 0)
+        self.assertEqual(services.calls['bot.banChatMember'], 1)
+        self.assertIn('subscription_expired', self.outbox_kinds())
+
+    async def test_resumed_pass_does_not_repeat_notices(self):
+        # Прерванный проход отключил доступ; продолжение обрабатывает его снова
+        await bot.process_due_entitlement(self.context, self.entitlement, self.now)
+        await bot.process_due_entitlement(self.context, self.entitlement, self.now)
+        await bot.dispatch_outbox(self.context)
+
+        self.assertEqual(services.calls['bot.banChatMember'], 2)
+        self.assertEqual(self.outbox_kinds(), ['subscription_expired', 'member_removed'])
+        self.assertEqual(self.execute("SELECT chat_id, status FROM outbox WHERE kind = 'member_removed'"),
+                         [(bot.ADMIN_ID, 'sent')])
+
+    async def test_access_extended_during_pass_is_kept(self):
+        # Оплата прошла после того, как проход прочитал список
+        plan = bot.get_default_plan()
+        await bot.storage.add_payment('pay-81', USER_ID, plan.price, plan.plan_id)
+        await bot.storage.update_subscription(USER_ID, 'pay-81', plan.price, plan.plan_id)
+
+        await bot.process_due_entitlement(self.context, self.entitlement, self.now)
+
+        self.assertEqual(self.active(), 1)
+        self.assertEqual(services.calls['bot.banChatMember'], 0)
+        self.assertNotIn('subscription_expired', self.outbox_kinds())
+
+
+if __name__ == '__main__':
+    unittest.main()
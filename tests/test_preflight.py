@@ -0,0 +1,86 @@
+"""Проверки перед запуском (bot.preflight) и перезапуск main после ошибки запуска."""
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+from support import configure_bot
+
+bot, services = configure_bot()
+import database  # noqa: E402
+
+
+class PreflightTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        services.reset()
+
+    async def test_all_checks_pass(self):
+        self.assertEqual(await bot.preflight(), [])
+        self.assertGreaterEqual(services.calls['bot.getMe'], 1)
+        self.assertEqual(services.calls['yookassa.me'], 1)
+
+    async def test_bot_api_unavailable(self):
+        with mock.patch.object(bot, 'BOT_API_BASE_URL', 'http://127.0.0.1:9/bot'):
+            failures = await bot.preflight()
+        self.assertEqual([name for name, error in failures], ['bot_api'])
+
+    async def test_yookassa_rejects_request(self):
+        with mock.patch.object(bot.yookassa_api().Configuration, 'api_url', f"{services.url}/missing"):
+            failures = await bot.preflight()
+        self.assertEqual([name for name, error in failures], ['yookassa'])
+
+    async def test_database_unavailable(self):
+        # Каталог базы нельзя создать: на его месте файл
+        with mock.patch.object(database, 'DB_PATH', os.path.join(os.path.abspath(__file__), 'subscriptions.db')):
+            failures = await bot.preflight()
+        self.assertEqual([name for name, error in failures], ['database'])
+
+    async def test_timeout(self):
+        async def hanging():
+            await asyncio.sleep(10)
+
+        with mock.patch.object(bot, 'PREFLIGHT_TIMEOUT', 0.1), mock.patch.object(bot, 'check_bot_api', hanging):
+            failures = await bot.preflight()
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0], 'bot_api')
+        self.assertIsInstance(failures[0][1], asyncio.TimeoutError)
+
+
+class StopRetries(Exception):
+    pass
+
+
+class MainRetryTest(unittest.TestCase):
+    def test_failed_start_closes_event_loop(self):
+        loops = []
+        new_event_loop = asyncio.new_event_loop
+
+        def tracked_loop():
+            loop = new_event_loop()
+            loops.append(loop)
+            return loop
+
+        application = mock.Mock()
+        application.run_webhook.side_effect = RuntimeError('port in use')
+        application.run_polling.side_effect = RuntimeError('port in use')
+        alerts = []
+
+        async def send_startup_alert(text):
+            alerts.append(text)
+
+        with mock.patch('asyncio.new_event_loop', tracked_loop), \
+                mock.patch.object(bot, 'build_application', return_value=application), \
+                mock.patch.object(bot, 'send_startup_alert', send_startup_alert), \
+                mock.patch.object(bot.time, 'sleep', side_effect=StopRetries):
+            with self.assertRaises(StopRetries):
+                bot.main()
+        asyncio.set_event_loop(None)
+
+        self.assertEqual(len(loops), 1)
+        self.assertTrue(loops[0].is_closed())
+        self.assertEqual(len(alerts), 1)
+        self.assertIn('port in use', alerts[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
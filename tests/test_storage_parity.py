@@ -0,0 +1,284 @@
+"""Совпадение бэкендов хранения: один и тот же сценарий выполняется на SQLiteStorage и
+PostgresStorage, результаты каждого шага сравниваются.
+
+Нужен живой PostgreSQL; без DATABASE_URL (или без asyncpg) тест пропускается:
+    DATABASE_URL=postgresql://postgres@localhost:5432/postgres python -m unittest discover tests
+
+Таблицы создаются во временной схеме, которая удаляется после теста.
+"""
+import asyncio
+import os
+import re
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from support import fresh_database, start_services
+
+start_services()
+import plans  # noqa: E402
+from storage import SQLiteStorage  # noqa: E402
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+# Даты, вычисленные от текущего времени, расходятся на время между шагами сценария
+DATE_TOLERANCE = timedelta(seconds=5)
+
+
+def normalize(value):
+    """Приводит результаты бэкендов к общему виду: bool, Decimal и datetime, кортежи и множества."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FORMAT)
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((normalize(item) for item in value), key=repr)
+    if isinstance(value, dict):
+        return {(tuple(key) if isinstance(key, tuple) else key): normalize(item) for key, item in value.items()}
+    return value
+
+
+async def collect(aiter):
+    rows = []
+    async for batch in aiter:
+        rows.extend(batch)
+    return rows
+
+
+async def scenario(storage):
+    """Список (шаг, результат) одного и того же набора операций."""
+    steps = []
+    channel_id = plans.get_default_channel().channel_id
+    now = datetime.now()
+    started_at = (datetime.utcnow() - timedelta(minutes=1)).strftime(DATE_FORMAT)
+    far = (now + timedelta(days=3650)).strftime(DATE_FORMAT)
+    past = (now - timedelta(days=1)).strftime(DATE_FORMAT)
+
+    def record(name, value):
+        steps.append((name, normalize(value)))
+
+    # Пользователи и пробный период
+    record('add_user', await storage.add_user(1, 'alice'))
+    record('add_user repeat', await storage.add_user(1, 'alice'))
+    await storage.add_trial_signal('invite:abc', 1, 'invite')
+    record('add_user suspect', await storage.add_user(2, 'bob', ['username:nobody', 'invite:abc']))
+    record('add_user denied', await storage.add_user(3, 'carol', ['invite:abc'], deny_trial=True))
+    record('add_user plain', await storage.add_user(4, 'dave'))
+    record('trial signal keys', sorted(await storage.get_trial_signal_keys()))
+    record('entitlement', await storage.get_entitlement(1))
+    record('entitlement denied', await storage.get_entitlement(3))
+    record('user entitlements', await storage.get_user_entitlements(2))
+    record('entitlement changes', sorted(await storage.get_entitlement_changes(started_at)))
+
+    # Платежи
+    await storage.add_payment('pay-1', 1, 1000.0, 'default')
+    record('payment', await storage.get_payment('pay-1'))
+    record('pending ids', await storage.get_pending_payment_ids(['pay-1', 'missing']))
+    record('update_subscription', await storage.update_subscription(
+        1, 'pay-1', 1000.0, 'default', [(1, 'payment_confirmed', {'channel_id': channel_id}, 'confirmed:pay-1')]))
+    record('update_subscription repeat', await storage.update_subscription(1, 'pay-1', 1000.0, 'default'))
+    record('payment succeeded', await storage.get_payment('pay-1'))
+    record('last payment', await storage.get_last_payment(1))
+    await storage.add_payment('pay-2', 2, 500.0, 'default')
+    await storage.set_payment_status('pay-2', 'canceled')
+    record('payment canceled', await storage.get_payment('pay-2'))
+    record('pending ids canceled', await storage.get_pending_payment_ids(['pay-2']))
+
+    # Активные пользователи
+    record('active users', sorted(await storage.get_active_users()))
+    record('active page', await storage.get_active_users_page(limit=2))
+    record('active page after', await storage.get_active_users_page(after_user_id=1, limit=10))
+    record('active page before', await storage.get_active_users_page(before_user_id=4, limit=10))
+    record('count active', await storage.count_active_users())
+    record('iter active', await collect(storage.iter_active_users(batch_size=2)))
+
+    # Истекающие доступы
+    due = await storage.get_due_entitlements(far)
+    record('due', due)
+    record('deactivate', await storage.deactivate_entitlement(
+        2, channel_id, [(2, 'subscription_expired', {}, 'expired:2')]))
+    record('deactivate repeat', await storage.deactivate_entitlement(
+        2, channel_id, [(2, 'subscription_expired', {}, 'expired:2:again')], far))
+    # Доступ, который еще не истек к моменту прохода, не отключается
+    record('deactivate extended', await storage.deactivate_entitlement(
+        4, channel_id, [(4, 'subscription_expired', {}, 'expired:4')], past))
+    record('due after deactivate', await storage.get_due_entitlements(far))
+    # Продолжение прохода видит и доступ, отключенный им самим до прерывания
+    position = [due[0][4], 0, channel_id]
+    record('due resumed', await storage.get_due_entitlements(far, position, started_at, far))
+    record('entitlement inactive', await storage.get_entitlement(2))
+
+    # Участники каналов. SQLite хранит время с точностью до секунды, и статус, записанный в ту же
+    # секунду, что и изменение доступа, считается устаревшим; PostgreSQL различает их
+    await asyncio.sleep(1.1)
+    await storage.record_member_status(1, channel_id, 'member', 'event')
+    await storage.record_member_status(2, channel_id, 'member', 'event')
+    await storage.record_member_status(2, channel_id, 'kicked', 'probe')
+    await storage.record_member_status(4, channel_id, 'left', 'event')
+    record('reconcile candidates', sorted(await storage.get_reconcile_candidates(channel_id, past)))
+    record('reconcile candidates full', sorted(await storage.get_reconcile_candidates(channel_id, past, True)))
+    record('membership diff', await storage.get_membership_diff(channel_id, now.strftime(DATE_FORMAT)))
+    record('member changes', sorted(await storage.get_member_changes(started_at)))
+
+    # Автопродление
+    await storage.save_payment_method(1, 'method-1', 'Bank card *4444')
+    record('payment method', await storage.get_payment_method(1))
+    record('set auto renew missing', await storage.set_auto_renew(2, True))
+    record('set auto renew', await storage.set_auto_renew(1, True))
+    record('auto renew ids', await storage.get_auto_renew_user_ids([1, 2]))
+    record('due renewals', await storage.get_due_renewals(far, datetime.now().timestamp() + 1, 10))
+    record('renewal pending', await storage.record_renewal_attempt(1, 'pending', 'renew-1'))
+    record('method pending', await storage.get_payment_method(1))
+    record('renewal error', await storage.record_renewal_attempt(1, 'error'))
+    record('method after error', await storage.get_payment_method(1))
+    for attempt in range(3):
+        record(f'renewal declined {attempt}', await storage.record_renewal_attempt(1, 'canceled', None, 3))
+    record('method disabled', await storage.get_payment_method(1))
+    record('auto renew ids disabled', await storage.get_auto_renew_user_ids([1]))
+
+    # Промокоды и приглашения
+    record('promo add', await storage.add_promo_code('SALE', 20, 0, 1))
+    record('promo add repeat', await storage.add_promo_code('SALE', 20))
+    await storage.add_promo_code('OLD', 10, 0, None, past)
+    await storage.add_promo_code('DAYS', 0, 3)
+    record('redeem', await storage.redeem_promo_code(1, 'SALE'))
+    record('redeem exhausted', await storage.redeem_promo_code(4, 'SALE'))
+    record('redeem already', await storage.redeem_promo_code(1, 'SALE'))
+    record('redeem expired', await storage.redeem_promo_code(1, 'OLD'))
+    record('redeem not found', await storage.redeem_promo_code(1, 'NOPE'))
+    record('redeem days', await storage.redeem_promo_code(4, 'DAYS'))
+    record('promo codes', sorted(await storage.get_promo_codes()))
+    record('pending discounts', await storage.get_pending_discounts())
+    record('referral', await storage.add_referral(4, 1))
+    record('referral repeat', await storage.add_referral(4, 3))
+    record('referral self', await storage.add_referral(1, 1))
+    await storage.add_payment('pay-4', 4, 800.0, 'default')
+    record('referral payment', await storage.update_subscription(4, 'pay-4', 800.0, 'default', (), None, 7))
+    record('count referrals', await storage.count_referrals(1))
+    record('referrer entitlement', await storage.get_entitlement(1))
+
+    # Массовые операции
+    record('resolve', await storage.resolve_users([1, 99], ['bob', 'nobody']))
+    record('bulk extend', await storage.bulk_update_access('extend', [1, 2, 3], channel_id, 5, 'b1'))
+    record('bulk revoke', await storage.bulk_update_access('revoke', [2, 3], channel_id, 0, 'b2'))
+    record('bulk grant', await storage.bulk_update_access('grant', [2, 3], channel_id, 10, 'b3'))
+
+    # Исходящие сообщения
+    await storage.enqueue_outbox([(5, 'test', {'n': 1}, 'test:1'), (5, 'test', {'n': 1}, 'test:1'),
+                                  (5, 'test', {'n': 2}, 'test:2'), (5, 'test', {'n': 3}, 'test:3')])
+    claimed = await storage.claim_outbox(100, 60)
+    record('claimed', [row[1:] for row in claimed])
+    record('claimed again', await storage.claim_outbox(100, 60))
+    tests = {row[3].get('n'): row[0] for row in claimed if row[2] == 'test'}
+    await storage.complete_outbox(tests[1])
+    await storage.fail_outbox(tests[2], 'boom')
+    await storage.fail_outbox(tests[3], 'later', datetime.now().timestamp() - 1)
+    record('claimed retry', [row[1:] for row in await storage.claim_outbox(100, 60)])
+    record('outbox progress', await storage.get_outbox_progress('test:'))
+
+    # Журнал событий и снимки
+    events = await storage.get_user_events(1)
+    record('user events', [event[1:5] for event in events])
+    await storage.save_event_snapshots([(1, channel_id, {'active': 1}, events[-1][0])])
+    await storage.save_event_snapshots([(1, channel_id, {'active': 0}, events[-1][0])])
+    snapshots = await storage.get_event_snapshots([(1, channel_id), (2, channel_id)])
+    record('snapshots', {key: value[0] for key, value in snapshots.items()})
+    record('user snapshots', {key: value[0] for key, value in (await storage.get_user_snapshots(1)).items()})
+
+    # Статистика
+    counters, daily, monthly = await storage.get_stats()
+    record('counters', counters)
+    record('daily', sorted(daily))
+    record('monthly', sorted(monthly))
+
+    # Задачи
+    record('lease', await storage.acquire_lease('job', 'a', 60))
+    record('lease busy', await storage.acquire_lease('job', 'b', 60))
+    await storage.release_lease('job', 'a')
+    record('lease released', await storage.acquire_lease('job', 'b', 60))
+    record('last run empty', await storage.get_job_last_run('job'))
+    await storage.set_job_last_run('job', 1234.5)
+    record('last run', await storage.get_job_last_run('job'))
+    await storage.set_job_checkpoint('job', {'after': [far, 1, channel_id]})
+    record('checkpoint', await storage.get_job_checkpoint('job'))
+    await storage.set_job_checkpoint('job', None)
+    record('checkpoint cleared', await storage.get_job_checkpoint('job'))
+
+    # Перенос данных
+    for table in ('users', 'entitlements', 'promo_codes', 'referrals'):
+        rows = await collect(storage.export_rows(table, batch_size=2))
+        record(f'export {table}', sorted(rows, key=repr))
+
+    # Хранение
+    record('purge payments', await storage.purge_payments(far, 100))
+    record('purge outbox', await storage.purge_outbox(far, 100))
+    record('payment purged', await storage.get_payment('pay-1'))
+    return steps
+
+
+@unittest.skipUnless(DATABASE_URL and asyncpg, 'DATABASE_URL is not set or asyncpg is not installed')
+class StorageParityTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        from storage_postgres import PostgresStorage
+        self.schema = f"happyface_test_{os.getpid()}"
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            await conn.execute(f'DROP SCHEMA IF EXISTS {self.schema} CASCADE')
+            await conn.execute(f'CREATE SCHEMA {self.schema}')
+        finally:
+            await conn.close()
+        self.addAsyncCleanup(self.drop_schema)
+        # Неизвестные asyncpg параметры строки подключения становятся настройками сервера
+        separator = '&' if '?' in DATABASE_URL else '?'
+        self.postgres = PostgresStorage(f"{DATABASE_URL}{separator}search_path={self.schema}")
+        self.sqlite = SQLiteStorage(fresh_database('parity'))
+        for storage in (self.sqlite, self.postgres):
+            await storage.init()
+            self.addAsyncCleanup(storage.close)
+
+    async def drop_schema(self):
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            await conn.execute(f'DROP SCHEMA IF EXISTS {self.schema} CASCADE')
+        finally:
+            await conn.close()
+
+    def assertSame(self, expected, actual, path):
+        if isinstance(expected, str) and isinstance(actual, str) \
+                and DATE_RE.match(expected) and DATE_RE.match(actual):
+            delta = abs(datetime.strptime(expected, DATE_FORMAT) - datetime.strptime(actual, DATE_FORMAT))
+            self.assertLessEqual(delta, DATE_TOLERANCE, f"{path}: {expected!r} != {actual!r}")
+        elif isinstance(expected, float) or isinstance(actual, float):
+            self.assertAlmostEqual(expected, actual, places=2, msg=path)
+        elif isinstance(expected, list) and isinstance(actual, list):
+            self.assertEqual(len(expected), len(actual), f"{path}: {expected!r} != {actual!r}")
+            for index, (left, right) in enumerate(zip(expected, actual)):
+                self.assertSame(left, right, f"{path}[{index}]")
+        elif isinstance(expected, dict) and isinstance(actual, dict):
+            self.assertEqual(sorted(expected, key=repr), sorted(actual, key=repr), f"{path}: keys")
+            for key in expected:
+                self.assertSame(expected[key], actual[key], f"{path}[{key!r}]")
+        else:
+            self.assertEqual(expected, actual, path)
+
+    async def test_scenario_matches(self):
+        expected = await scenario(self.sqlite)
+        actual = await scenario(self.postgres)
+        self.assertEqual([name for name, value in expected], [name for name, value in actual])
+        for (name, left), (name, right) in zip(expected, actual):
+            with self.subTest(step=name):
+                self.assertSame(left, right, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
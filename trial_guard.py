@@ -0,0 +1,124 @@
+"""Признаки повторного пробного периода и фильтр Блума для быстрой проверки.
+
+Пробный период выдается каждому новому user_id, поэтому новый аккаунт получает его
+заново. Признаки, связывающие аккаунт с уже получавшим пробный период, хранятся
+в таблице trial_signals (ключ -> user_id прежнего аккаунта, вид признака):
+    * username:<имя> — имя пользователя, с которым аккаунт получил пробный период;
+      новый аккаунт с тем же именем — скорее всего, тот же человек;
+    * account:<user_id> — аккаунт вошел в канал по приглашению, созданному для
+      другого пользователя (приглашения называются invite_name(user_id)).
+
+Ключи всей таблицы загружены в фильтр Блума в памяти: для подавляющего большинства
+новых пользователей он отвечает «точно нет» без запроса к базе, и Storage.add_user
+проверяет в базе только ключи с положительным ответом фильтра — в той же транзакции,
+где создается пользователь. Пока фильтр не построен, проверяются все ключи.
+Фильтр строится и дополняется по trial_signals.created_at в bot.rebuild_trial_guard
+и bot.refresh_trial_guard.
+"""
+import hashlib
+import math
+from typing import Optional
+
+INVITE_PREFIX = 'user '
+# Фильтр рассчитан на запас: при переполнении он перестраивается вдвое большим
+MIN_CAPACITY = 100000
+ERROR_RATE = 0.001
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # Двойное хеширование: k позиций из двух половин одного blake2b
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+_filter = None
+
+
+def username_key(username: str) -> str:
+    return f"username:{username.lower()}"
+
+
+def account_key(user_id: int) -> str:
+    return f"account:{user_id}"
+
+
+def invite_name(user_id: int) -> str:
+    """Название приглашения: по нему событие входа в канал показывает, для кого оно создано."""
+    return f"{INVITE_PREFIX}{user_id}"
+
+
+def invite_owner(name: Optional[str]) -> Optional[int]:
+    if not name or not name.startswith(INVITE_PREFIX):
+        return None
+    try:
+        return int(name[len(INVITE_PREFIX):])
+    except ValueError:
+        return None
+
+
+def user_keys(user_id: int, username: str = None) -> list:
+    """Ключи признаков, по которым проверяется новый пользователь."""
+    keys = [account_key(user_id)]
+    if username:
+        keys.append(username_key(username))
+    return keys
+
+
+def is_ready() -> bool:
+    return _filter is not None
+
+
+def load(keys: list):
+    """Строит фильтр заново по всем ключам trial_signals."""
+    global _filter
+    bloom = BloomFilter(max(MIN_CAPACITY, 2 * len(keys)))
+    for key in keys:
+        bloom.add(key)
+    _filter = bloom
+
+
+def clear():
+    global _filter
+    _filter = None
+
+
+def add(key: str):
+    if _filter is not None:
+        _filter.add(key)
+
+
+def needs_rebuild() -> bool:
+    """Фильтр заполнен сверх расчетного: доля ложных срабатываний растет."""
+    return _filter is not None and _filter.count > _filter.capacity
+
+
+def suspect_keys(user_id: int, username: str = None) -> list:
+    """Ключи нового пользователя, которые надо проверить в базе."""
+    keys = user_keys(user_id, username)
+    if _filter is None:
+        return keys
+    return [key for key in keys if key in _filter]
+
+
+def size() -> dict:
+    if _filter is None:
+        return {'keys': 0, 'bytes': 0}
+    return {'keys': _filter.count, 'bytes': len(_filter.bits)}
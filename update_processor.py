@@ -0,0 +1,87 @@
+"""Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+Встроенный concurrent_updates PTB запускает обновления одного пользователя
+одновременно: две нажатые подряд кнопки «Статус платежа» гоняются в
+check_payment_status и update_subscription. Без него все пользователи ждут самого
+медленного. PerUserUpdateProcessor держит по блокировке на пользователя: его
+обновления выполняются по очереди в порядке поступления, а обновления разных
+пользователей — параллельно, не больше max_concurrent_updates одновременно.
+"""
+import asyncio
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько обновлений может одновременно ждать своей очереди (в том числе за
+# блокировкой пользователя), на каждый слот обработки
+PENDING_PER_SLOT = 8
+
+
+def update_key(update: object) -> Optional[int]:
+    """Ключ очереди: id пользователя, иначе id чата (посты каналов). None — без очереди."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений: по порядку для одного пользователя, параллельно для разных.
+
+    Семафор базового класса ограничивает число ожидающих обновлений, а собственный —
+    число выполняющихся. Слот выполнения занимается только после блокировки
+    пользователя, поэтому очередь одного пользователя не занимает слоты остальных.
+    """
+
+    __slots__ = ('_running', '_locks', '_tasks')
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates * PENDING_PER_SLOT)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # ключ -> [блокировка, число обновлений в очереди]; запись удаляется вместе с очередью
+        self._locks = {}
+        self._tasks = set()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._tasks.discard(task)
+
+    async def _process(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def cancel_running(self) -> int:
+        """Отменяет обработку всех обновлений в работе (по истечении срока остановки)."""
+        for task in self._tasks:
+            task.cancel()
+        return len(self._tasks)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
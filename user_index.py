@@ -0,0 +1,203 @@
+"""Компактный индекс доступов в памяти для горячих путей.
+
+check_access, rejoin, /start и handle_chat_member_update на каждое обновление
+читают доступ пользователя к каналу, и каждое чтение было запросом к базе. Индекс
+хранит по каждому каналу параллельные массивы, упорядоченные по user_id:
+    * user_ids — array('q'), поиск бинарный (bisect);
+    * ends — окончание доступа в секундах, array('d'), 0 — без окончания;
+    * plans — номер тарифа в общем списке _plan_ids, array('H');
+    * flags — байт на доступ: ACTIVE и TRIAL.
+Это около 19 байт на доступ вместо сотен байт на кортеж в словаре, а выборки по
+окончанию (cohort: «истекает в ближайшие сутки») — один проход по массивам.
+
+Время хранится как секунды от EPOCH «наивной» даты из базы, без перевода зон: даты
+в базе записаны по московскому времени без зоны, и такой перевод точно обратим.
+
+Индекс строится целиком (load) в bot.rebuild_user_index при запуске; пока он не готов,
+bot.py читает доступы из базы. Записи этого процесса сразу переносятся в индекс
+(put_user, deactivate), записи других процессов — по entitlements.updated_at раз в
+USER_INDEX_REFRESH секунд (bot.refresh_user_index).
+"""
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from operator import itemgetter
+from typing import Optional
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+ACTIVE = 1
+TRIAL = 2
+EPOCH = datetime(1970, 1, 1)
+
+
+class _Channel:
+    """Столбцы доступов одного канала."""
+
+    __slots__ = ('user_ids', 'ends', 'plans', 'flags')
+
+    def __init__(self, user_ids=(), ends=(), plans=(), flags=()):
+        self.user_ids = array('q', user_ids)
+        self.ends = array('d', ends)
+        self.plans = array('H', plans)
+        self.flags = bytearray(flags)
+
+    def find(self, user_id: int) -> int:
+        """Позиция user_id или -1."""
+        i = bisect_left(self.user_ids, user_id)
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            return i
+        return -1
+
+
+# channel_id -> _Channel
+_channels = {}
+# Номер тарифа -> plan_id; номер 0 — доступ без тарифа (пробный или перенесенный из users)
+_plan_ids = [None]
+_plan_codes = {None: 0}
+_ready = False
+
+
+def to_seconds(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    return (datetime.fromisoformat(value) - EPOCH).total_seconds()
+
+
+def to_text(seconds: float) -> Optional[str]:
+    if not seconds:
+        return None
+    return (EPOCH + timedelta(seconds=seconds)).strftime(DATE_FORMAT)
+
+
+def _plan_code(plan_id: Optional[str]) -> int:
+    code = _plan_codes.get(plan_id)
+    if code is None:
+        code = _plan_codes[plan_id] = len(_plan_ids)
+        _plan_ids.append(plan_id)
+    return code
+
+
+def _flags(is_trial, active) -> int:
+    return (ACTIVE if active else 0) | (TRIAL if is_trial else 0)
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+def load(rows: list):
+    """Строит индекс заново из строк (user_id, channel_id, plan_id, subscription_end, is_trial, active)
+    и заменяет им текущий. Вызывается в отдельном потоке: на миллион строк уходят секунды."""
+    global _channels, _ready
+    by_channel = {}
+    for row in rows:
+        by_channel.setdefault(row[1], []).append(row)
+    channels = {}
+    for channel_id, part in by_channel.items():
+        part.sort(key=itemgetter(0))
+        channels[channel_id] = _Channel(
+            (row[0] for row in part),
+            (to_seconds(row[3]) for row in part),
+            (_plan_code(row[2]) for row in part),
+            (_flags(row[4], row[5]) for row in part),
+        )
+    _channels = channels
+    _ready = True
+
+
+def clear():
+    global _channels, _ready
+    _channels = {}
+    _ready = False
+
+
+def put(user_id: int, channel_id: int, plan_id: Optional[str], subscription_end: Optional[str],
+        is_trial, active):
+    """Добавляет или заменяет доступ; новый user_id вставляется с сохранением порядка."""
+    channel = _channels.get(channel_id)
+    if channel is None:
+        channel = _channels[channel_id] = _Channel()
+    end, plan, flags = to_seconds(subscription_end), _plan_code(plan_id), _flags(is_trial, active)
+    i = bisect_left(channel.user_ids, user_id)
+    if i < len(channel.user_ids) and channel.user_ids[i] == user_id:
+        channel.ends[i] = end
+        channel.plans[i] = plan
+        channel.flags[i] = flags
+    else:
+        channel.user_ids.insert(i, user_id)
+        channel.ends.insert(i, end)
+        channel.plans.insert(i, plan)
+        channel.flags.insert(i, flags)
+
+
+def remove(user_id: int, channel_id: int):
+    channel = _channels.get(channel_id)
+    i = channel.find(user_id) if channel else -1
+    if i >= 0:
+        del channel.user_ids[i], channel.ends[i], channel.plans[i], channel.flags[i]
+
+
+def put_user(user_id: int, entitlements: list):
+    """Заменяет все доступы пользователя строками (channel_id, plan_id, subscription_end, is_trial, active)."""
+    present = {row[0] for row in entitlements}
+    for channel_id in list(_channels):
+        if channel_id not in present:
+            remove(user_id, channel_id)
+    for channel_id, plan_id, subscription_end, is_trial, active in entitlements:
+        put(user_id, channel_id, plan_id, subscription_end, is_trial, active)
+
+
+def deactivate(user_id: int, channel_id: int):
+    channel = _channels.get(channel_id)
+    i = channel.find(user_id) if channel else -1
+    if i >= 0:
+        channel.flags[i] &= ~ACTIVE
+
+
+def get(user_id: int, channel_id: int) -> Optional[tuple]:
+    """(plan_id, subscription_end, is_trial, active) или None — как Storage.get_entitlement."""
+    channel = _channels.get(channel_id)
+    i = channel.find(user_id) if channel else -1
+    if i < 0:
+        return None
+    flags = channel.flags[i]
+    return _plan_ids[channel.plans[i]], to_text(channel.ends[i]), bool(flags & TRIAL), bool(flags & ACTIVE)
+
+
+def get_user(user_id: int) -> list:
+    """Список (channel_id, plan_id, subscription_end, is_trial, active) — как Storage.get_user_entitlements."""
+    result = []
+    for channel_id, channel in _channels.items():
+        i = channel.find(user_id)
+        if i >= 0:
+            flags = channel.flags[i]
+            result.append((channel_id, _plan_ids[channel.plans[i]], to_text(channel.ends[i]),
+                           bool(flags & TRIAL), bool(flags & ACTIVE)))
+    return result
+
+
+def cohort(start: str, stop: str, channel_id: int = None) -> list:
+    """Активные доступы с окончанием в [start; stop): список (user_id, channel_id, is_trial)."""
+    low, high = to_seconds(start), to_seconds(stop)
+    result = []
+    for cid, channel in _channels.items():
+        if channel_id is not None and cid != channel_id:
+            continue
+        flags, user_ids = channel.flags, channel.user_ids
+        result.extend(
+            (user_ids[i], cid, bool(flags[i] & TRIAL))
+            for i, end in enumerate(channel.ends)
+            if low <= end < high and flags[i] & ACTIVE
+        )
+    return result
+
+
+def size() -> dict:
+    """Число доступов и память под массивы в байтах."""
+    entries = sum(len(channel.user_ids) for channel in _channels.values())
+    memory = sum(
+        channel.user_ids.itemsize * len(channel.user_ids) + channel.ends.itemsize * len(channel.ends)
+        + channel.plans.itemsize * len(channel.plans) + len(channel.flags)
+        for channel in _channels.values()
+    )
+    return {'entries': entries, 'bytes': memory, 'channels': len(_channels)}
@@ -0,0 +1,234 @@
+"""Многопроцессный режим: фронтовой процесс принимает вебхуки и раздает обновления
+N рабочим процессам.
+
+Фронт не импортирует bot.py и не ходит в базу: он только проверяет секрет вебхука,
+определяет пользователя и кладет JSON обновления в очередь рабочего процесса
+по хешу user_id. Поэтому обновления одного пользователя всегда обрабатываются одним
+процессом и по порядку. Плановые задачи запускает только процесс, держащий аренду
+в таблице job_state (см. bot.leader_only).
+
+Фронт следит за рабочими процессами: упавший процесс перезапускается с той же очередью,
+а пока он не работает, обновления его пользователей получают ответ 503, и Telegram
+присылает их повторно.
+
+Запуск:
+    python workers.py --workers 4
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import get_settings, load_env
+from server_config import load_server_config
+
+logger = logging.getLogger(__name__)
+
+# Проверка рабочих процессов раз в WORKER_CHECK_INTERVAL секунд. Упавший процесс
+# перезапускается через 5, 10, 20... секунд, не больше WORKER_RESTART_MAX_DELAY; если он
+# проработал дольше WORKER_STABLE_SECONDS, отсчет начинается заново
+WORKER_CHECK_INTERVAL = 1.0
+WORKER_RESTART_BASE = 5
+WORKER_RESTART_MAX_DELAY = 300
+WORKER_STABLE_SECONDS = 300
+
+# Поля обновления, в которых Telegram передает автора
+USER_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'chat_member', 'my_chat_member',
+    'chat_join_request', 'inline_query', 'chosen_inline_result', 'pre_checkout_query', 'shipping_query',
+)
+
+
+def routing_key(update: dict) -> int:
+    """Ключ маршрутизации: id пользователя, иначе id чата, иначе update_id."""
+    for field in USER_FIELDS:
+        payload = update.get(field)
+        if not payload:
+            continue
+        user = payload.get('from')
+        if user and 'id' in user:
+            return int(user['id'])
+        chat = payload.get('chat')
+        if chat and 'id' in chat:
+            return int(chat['id'])
+    return int(update.get('update_id', 0))
+
+
+def worker_index(update: dict, workers: int) -> int:
+    # crc32 вместо hash(): одинаковое распределение во всех процессах и запусках
+    return zlib.crc32(str(routing_key(update)).encode()) % workers
+
+
+def run_worker(index: int, workers: int, queue):
+    """Точка входа рабочего процесса."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import bot
+    from telegram import Update
+
+    bot.configure(worker=index)
+    # Свой снимок у каждого процесса: в нем ссылки только его пользователей. При другом
+    # числе процессов пользователи распределяются иначе, и снимки не подходят
+    name, ext = os.path.splitext(bot.SNAPSHOT_FILE)
+    bot.SNAPSHOT_FILE = f"{name}-{index}-of-{workers}{ext}"
+
+    async def serve():
+        application = bot.build_application(updater=False)
+        async with application:
+            # post_init/post_shutdown вызываются только в run_webhook/run_polling
+            await bot.on_startup(application)
+            await application.start()
+            bot.logger.info(f"Worker {index} ({bot.INSTANCE_ID}) started")
+            loop = asyncio.get_running_loop()
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            # Дожидаемся обновлений в работе (не дольше bot.SHUTDOWN_TIMEOUT) и сохраняем прогресс задач
+            bot.begin_shutdown(application)
+            await application.stop()
+            await bot.on_shutdown(application)
+            bot.logger.info(f"Worker {index} stopped")
+
+    asyncio.run(serve())
+
+
+def make_handler(queues, path: str, secret: str, alive=None):
+    """Обработчик вебхука: path и secret — путь и секрет вебхука из server_config.py,
+    alive — флаги работающих процессов (supervise)."""
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            if self.path.split('?')[0] != path:
+                self.send_response(404)
+                self.end_headers()
+                return
+            if secret and not hmac.compare_digest(
+                    self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                update = json.loads(self.rfile.read(length))
+            except (ValueError, json.JSONDecodeError):
+                self.send_response(400)
+                self.end_headers()
+                return
+            index = worker_index(update, len(queues))
+            if alive is not None and not alive[index]:
+                # Telegram повторит обновление, когда процесс перезапустится
+                self.send_response(503)
+                self.end_headers()
+                return
+            queues[index].put(update)
+            self.send_response(200)
+            self.end_headers()
+
+    return WebhookHandler
+
+
+def start_worker(context, index: int, workers: int, queue):
+    process = context.Process(target=run_worker, args=(index, workers, queue), name=f"bot-worker-{index}",
+                              daemon=True)
+    process.start()
+    return process
+
+
+def supervise(context, processes: list, queues: list, alive: list, stopping: threading.Event):
+    """Перезапускает упавшие рабочие процессы с их очередями, пока не выставлен stopping.
+    Обновления, уже взятые упавшим процессом из очереди, теряются; остальные дождутся нового."""
+    started = [time.monotonic()] * len(processes)
+    failures = [0] * len(processes)
+    restart_at = [None] * len(processes)
+    while not stopping.wait(WORKER_CHECK_INTERVAL):
+        for index, process in enumerate(processes):
+            if process.is_alive():
+                continue
+            if restart_at[index] is None:
+                alive[index] = False
+                if time.monotonic() - started[index] > WORKER_STABLE_SECONDS:
+                    failures[index] = 0
+                delay = min(WORKER_RESTART_BASE * 2 ** failures[index], WORKER_RESTART_MAX_DELAY)
+                failures[index] += 1
+                restart_at[index] = time.monotonic() + delay
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting in {delay}s")
+                continue
+            if time.monotonic() < restart_at[index]:
+                continue
+            processes[index] = start_worker(context, index, len(processes), queues[index])
+            started[index] = time.monotonic()
+            restart_at[index] = None
+            alive[index] = True
+            logger.info(f"Worker {index} restarted")
+
+
+async def set_webhook(server):
+    from telegram import Bot, Update
+    async with Bot(get_settings().token, base_url=server.base_url) as telegram_bot:
+        await telegram_bot.set_webhook(url=server.webhook_url, secret_token=server.secret_token,
+                                       max_connections=server.max_connections,
+                                       allowed_updates=server.allowed_updates or Update.ALL_TYPES,
+                                       drop_pending_updates=server.drop_pending_updates)
+
+
+def main():
+    load_env()
+    # Адрес, путь и секрет вебхука — общие с bot.py настройки из server_config.py
+    server_config = load_server_config()
+    parser = argparse.ArgumentParser(description="HappyFaceBot: фронт вебхуков и N рабочих процессов")
+    parser.add_argument('--workers', type=int, default=server_config.workers)
+    parser.add_argument('--no-set-webhook', action='store_true', help='Не вызывать setWebhook при запуске')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(args.workers)]
+    processes = [start_worker(context, i, args.workers, q) for i, q in enumerate(queues)]
+    alive = [True] * args.workers
+    stopping = threading.Event()
+    supervisor = threading.Thread(target=supervise, args=(context, processes, queues, alive, stopping),
+                                  name='worker-supervisor', daemon=True)
+    supervisor.start()
+
+    if not args.no_set_webhook:
+        asyncio.run(set_webhook(server_config))
+
+    server = ThreadingHTTPServer((server_config.listen, server_config.port),
+                                 make_handler(queues, server_config.url_path, server_config.secret_token or '',
+                                              alive))
+
+    def stop(signum, frame):
+        # shutdown() блокируется до выхода из serve_forever, поэтому вызываем его из другого потока
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Webhook front listening on {server_config.listen}:{server_config.port}{server_config.url_path}, "
+                f"{args.workers} workers")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        # Процессы, останавливаемые ниже, перезапускать уже не нужно
+        stopping.set()
+        supervisor.join()
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+        logger.info("All workers stopped")
+
+
+if __name__ == "__main__":
+    main()